@@ -196,6 +196,10 @@ init_scim_fifo_pool(app)
 app.app_config = config
 app.app_config["profile"] = profile
 
+from server.scim.circuit_breaker import configure_circuit_breakers  # noqa: E402
+
+configure_circuit_breakers(config.get("scim_circuit_breaker"))
+
 init_swagger(app)
 
 Migrate(app, db)
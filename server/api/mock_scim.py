@@ -95,8 +95,8 @@ def _find_scim_object(collection_name):
     resources = list(service[collection_name].values())
     if not filter_param:
         return {"totalResults": len(resources), "Resources": resources}
-    external_id = re.search(r"externalId eq \"(.*)\"", filter_param).groups()[0]
-    res = list(filter(lambda obj: obj["externalId"] == external_id, resources))
+    external_ids = re.findall(r"externalId eq \"([^\"]*)\"", filter_param)
+    res = list(filter(lambda obj: obj["externalId"] in external_ids, resources))
     return {"totalResults": len(res), "Resources": res}
 
 
@@ -1,329 +1,714 @@
+import base64
 import datetime
-
-import pytz
-from flask import Blueprint, jsonify, Response, current_app, stream_with_context
-from sqlalchemy import text
-
-from server.api.base import json_endpoint, auth_filter
+import functools
+import hashlib
+import itertools
+import json
+import operator
+import re
+import types
+import zlib
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from flask import Blueprint, Response, current_app, jsonify, request as current_request, stream_with_context
+from sqlalchemy import text, bindparam
+from werkzeug.exceptions import BadRequest
+
+from server.api.base import json_endpoint, auth_filter, query_param
 from server.auth.security import confirm_read_access
+from server.db.audit_mixin import ACTION_DELETE
+from server.db.data_version import data_version
 from server.db.db import db
 from server.db.logo_mixin import logo_url
-from server.tools import dt_today, inactivity
+from server.tools import dt_today, sram_inactive_days
 
 plsc_api = Blueprint("plsc_api", __name__, url_prefix="/api/plsc")
 
+CURSOR_HEADER = "X-Sync-Cursor"
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+SNAPSHOT_KEY = "plsc_snapshot"
+
+_snapshot_fields = ["version", "etag", "cursor"]
+
+# SAFE-STRING of RFC 2849, other values are base64 encoded
+_ldif_safe_string = re.compile(r"^([\x01-\x09\x0b\x0c\x0e-\x1f\x21-\x39\x3b\x3d-\x7f][\x01-\x09\x0b\x0c\x0e-\x7f]*)?$")
+
+_tombstone_types = ["organisations", "collaborations", "groups", "services", "users"]
+
+
+def _group_by(seq, fk):
+    grouped = defaultdict(list)
+    for row in seq:
+        grouped[row[fk]].append(row)
+    return grouped
+
+
+def _rows_by_key(rows):
+    """
+    Return a function which returns the rows of a key, for rows ordered by their key in the first column. The
+    function must be called with ascending keys, and the rows of keys it is not called with are skipped.
+    """
+    groups = ((key, list(group)) for key, group in itertools.groupby(rows, key=operator.itemgetter(0)))
+    current = next(groups, None)
+
+    def rows_of(key):
+        nonlocal current
+        while current is not None and current[0] < key:
+            current = next(groups, None)
+        if current is None or current[0] != key:
+            return []
+        key_rows = current[1]
+        current = next(groups, None)
+        return key_rows
+
+    return rows_of
+
+
+def _execute(conn, sql, conditions=(), order_by=None, stream=False):
+    """
+    Execute the SQL with the conditions - tuples of clause and expanding IN parameters - as WHERE clause. If stream
+    is True the rows are fetched with a server-side cursor, and no other query may be executed on the connection
+    until all rows are consumed.
+    """
+    if conditions:
+        sql += " WHERE " + " AND ".join(clause for clause, _ in conditions)
+    if order_by:
+        sql += f" ORDER BY {order_by}"
+    params = {name: list(values) for _, parameters in conditions for name, values in parameters.items()}
+    statement = text(sql).bindparams(*[bindparam(name, expanding=True) for name in params])
+    if stream:
+        statement = statement.execution_options(stream_results=True)
+    return conn.execute(statement, params)
+
+
+def _in(column, name, values):
+    return [] if values is None else [(f"{column} IN :{name}", {name: values})]
+
+
+def _collaboration_conditions(column, organisation_ids, collaboration_ids):
+    conditions = _in(column, "collaboration_ids", collaboration_ids)
+    if organisation_ids is not None:
+        conditions.append((f"{column} IN (SELECT id FROM collaborations WHERE organisation_id IN :organisation_ids)",
+                           {"organisation_ids": organisation_ids}))
+    return conditions
+
+
+def _sync_services(conn, service_ids=None):
+    # Fetch services with fallback contact_email from service_memberships
+    # This eliminates N+1 queries for services without contact_email
+    rs = _execute(
+        conn,
+        """
+             SELECT s.id,
+                    s.name,
+                    s.entity_id,
+                    s.contact_email,
+                    s.uuid4,
+                    s.ldap_password,
+                    s.accepted_user_policy,
+                    s.support_email,
+                    s.security_email,
+                    s.privacy_policy,
+                    s.ldap_enabled,
+                    s.ldap_identifier,
+                    s.abbreviation,
+                    COALESCE(s.contact_email, (SELECT u.email
+                                               FROM service_memberships sm
+                                                        JOIN users u ON u.id = sm.user_id
+                                               WHERE sm.service_id = s.id
+                                               LIMIT 1)) as effective_contact_email
+             FROM services s
+             """,
+        _in("s.id", "service_ids", service_ids),
+        stream=True
+    )
+    for row in rs:
+        yield {
+            "id": row[0],
+            "name": row[1],
+            "entity_id": row[2],
+            "contact_email": row[
+                13
+            ],  # Use the effective_contact_email from COALESCE
+            "logo": logo_url("services", row[4]),
+            "ldap_password": row[5],
+            "accepted_user_policy": row[6],
+            "support_email": row[7],
+            "security_email": row[8],
+            "privacy_policy": row[9],
+            "ldap_enabled": row[10],
+            "ldap_identifier": row[11],
+            "abbreviation": row[12],
+        }
+
+
+def _sync_organisations(conn, organisation_ids=None, collaboration_ids=None):
+    # The rows which grow with the number of collaborations are indexed in memory. The memberships, which grow with
+    # the number of users, are ordered by organisation, streamed - each over its own connection - and merged per
+    # organisation, which is emitted with its collaborations and released thereafter.
+    collaboration_conditions = _collaboration_conditions("collaboration_id", organisation_ids, collaboration_ids)
+    rs = _execute(conn, "SELECT name, organisation_id FROM schac_home_organisations",
+                  _in("organisation_id", "organisation_ids", organisation_ids))
+    schac_home_organisations = [
+        {"name": row[0], "organisation_id": row[1]} for row in rs
+    ]
+    rs = _execute(conn, "SELECT service_id, collaboration_id FROM services_collaborations",
+                  collaboration_conditions)
+    services_collaborations = [
+        {"service_id": row[0], "collaboration_id": row[1]} for row in rs
+    ]
+    rs = _execute(
+        conn,
+        "SELECT id, identifier, name, short_name, global_urn, organisation_id, status, description, "
+        "uuid4, website_url from collaborations",
+        _in("id", "collaboration_ids", collaboration_ids) + _in("organisation_id", "organisation_ids",
+                                                                organisation_ids)
+    )
+    sbs_url_prefix = f"{current_app.app_config.base_url}/collaborations/"
+    collaborations = [
+        {
+            "id": row[0],
+            "identifier": row[1],
+            "name": row[2],
+            "short_name": row[3],
+            "global_urn": row[4],
+            "organisation_id": row[5],
+            "status": row[6],
+            "description": row[7],
+            "logo": logo_url("collaborations", row[8]),
+            "website_url": row[9],
+            "sbs_url": f"{sbs_url_prefix}{row[1]}",
+        }
+        for row in rs
+    ]
+    rs = _execute(
+        conn,
+        "SELECT id, name, short_name, global_urn, identifier, collaboration_id, description FROM `groups`",
+        collaboration_conditions
+    )
+    groups = [
+        {
+            "id": row[0],
+            "name": row[1],
+            "short_name": row[2],
+            "global_urn": row[3],
+            "identifier": row[4],
+            "collaboration_id": row[5],
+            "description": row[6],
+        }
+        for row in rs
+    ]
+    rs = _execute(
+        conn,
+        "SELECT ct.collaboration_id, t.tag_value FROM collaboration_tags ct "
+        "INNER JOIN tags t ON t.id = ct.tag_id",
+        _collaboration_conditions("ct.collaboration_id", organisation_ids, collaboration_ids)
+    )
+    tags = [{"collaboration_id": row[0], "tag_value": row[1]} for row in rs]
+
+    rs = _execute(conn, "SELECT name, organisation_id from units",
+                  _in("organisation_id", "organisation_ids", organisation_ids))
+    units = [{"name": row[0], "organisation_id": row[1]} for row in rs]
 
-def _find_user_id(collaboration_memberships, collaboration_membership_id):
-    user_ids = [
-        cm["user_id"]
-        for cm in collaboration_memberships
-        if cm["id"] == collaboration_membership_id
+    rs = _execute(
+        conn,
+        "SELECT cu.collaboration_id, u.name from collaboration_units cu "
+        "inner join units u on u.id = cu.unit_id",
+        _collaboration_conditions("cu.collaboration_id", organisation_ids, collaboration_ids)
+    )
+    collaboration_units = [
+        {"collaboration_id": row[0], "name": row[1]} for row in rs
     ]
-    return user_ids[0]
 
+    # Index all rows once on their foreign keys, to prevent linear scans for each collaboration / group
+    groups_by_collaboration = _group_by(groups, "collaboration_id")
+    service_ids_by_collaboration = defaultdict(set)
+    for sc in services_collaborations:
+        service_ids_by_collaboration[sc["collaboration_id"]].add(sc["service_id"])
+    tags_by_collaboration = _group_by(tags, "collaboration_id")
+    units_by_collaboration = _group_by(collaboration_units, "collaboration_id")
+    schac_home_organisations_by_organisation = _group_by(schac_home_organisations, "organisation_id")
+    collaborations_by_organisation = _group_by(collaborations, "organisation_id")
+    units_by_organisation = _group_by(units, "organisation_id")
+
+    with db.engine.connect() as organisation_memberships_conn, db.engine.connect() as memberships_conn, \
+            db.engine.connect() as memberships_groups_conn:
+        organisation_memberships = _rows_by_key(_execute(
+            organisation_memberships_conn,
+            "SELECT organisation_id, role, user_id FROM organisation_memberships",
+            _in("organisation_id", "organisation_ids", organisation_ids),
+            order_by="organisation_id, id",
+            stream=True
+        ))
+        collaboration_memberships = _rows_by_key(_execute(
+            memberships_conn,
+            "SELECT c.organisation_id, cm.id, cm.role, cm.user_id, cm.collaboration_id, cm.status FROM "
+            "collaboration_memberships cm "
+            "INNER JOIN users u ON u.id = cm.user_id "
+            "INNER JOIN collaborations c ON c.id = cm.collaboration_id",
+            _collaboration_conditions("cm.collaboration_id", organisation_ids, collaboration_ids),
+            order_by="c.organisation_id, cm.id",
+            stream=True
+        ))
+        collaboration_memberships_groups = _rows_by_key(_execute(
+            memberships_groups_conn,
+            "SELECT c.organisation_id, cmg.collaboration_membership_id, cmg.group_id, cm.user_id FROM "
+            "collaboration_memberships_groups cmg "
+            "INNER JOIN collaboration_memberships cm ON cm.id = cmg.collaboration_membership_id "
+            "INNER JOIN `groups` g ON g.id = cmg.group_id "
+            "INNER JOIN collaborations c ON c.id = g.collaboration_id",
+            _collaboration_conditions("g.collaboration_id", organisation_ids, collaboration_ids),
+            order_by="c.organisation_id, cmg.group_id, cmg.id",
+            stream=True
+        ))
+
+        rs = _execute(conn, "SELECT id, name, identifier, short_name, uuid4 FROM organisations",
+                      _in("id", "organisation_ids", organisation_ids), order_by="id", stream=True)
+        for row in rs:
+            organisation_id = row[0]
+            memberships_by_collaboration = _group_by([
+                {
+                    "id": membership[1],
+                    "role": membership[2],
+                    "user_id": membership[3],
+                    "collaboration_id": membership[4],
+                    "status": membership[5],
+                }
+                for membership in collaboration_memberships(organisation_id)
+            ], "collaboration_id")
+            memberships_groups_by_group = _group_by([
+                {"collaboration_membership_id": mg[1], "group_id": mg[2], "user_id": mg[3]}
+                for mg in collaboration_memberships_groups(organisation_id)
+            ], "group_id")
+
+            def complete_collaboration(coll):
+                collaboration_id = coll["id"]
+                coll["groups"] = groups_by_collaboration.get(collaboration_id, [])
+                for group in coll["groups"]:
+                    group["collaboration_memberships"] = memberships_groups_by_group.get(group["id"], [])
+                coll["services"] = sorted(service_ids_by_collaboration.get(collaboration_id, []))
+                coll["collaboration_memberships"] = memberships_by_collaboration.get(collaboration_id, [])
+                coll["tags"] = [tag["tag_value"] for tag in tags_by_collaboration.get(collaboration_id, [])]
+                coll["units"] = [u["name"] for u in units_by_collaboration.get(collaboration_id, [])]
+                return coll
+
+            yield {
+                "id": organisation_id,
+                "name": row[1],
+                "identifier": row[2],
+                "short_name": row[3],
+                "logo": logo_url("organisations", row[4]),
+                "schac_home_organisations": schac_home_organisations_by_organisation.get(organisation_id, []),
+                "organisation_memberships": [{"role": om[1], "user_id": om[2], "organisation_id": om[0]}
+                                             for om in organisation_memberships(organisation_id)],
+                "collaborations": [complete_collaboration(coll) for coll in
+                                   collaborations_by_organisation.pop(organisation_id, [])],
+                "units": [u["name"] for u in units_by_organisation.get(organisation_id, [])],
+            }
 
-def _find_by_id(seq, fk, value):
-    return [row for row in seq if row[fk] == value]
 
+def _sync_users(conn, user_ids=None):
+    # The SSH keys and service AUPs are fetched in separate queries, as joining them with the users returns
+    # |ssh_keys| x |service_aups| rows per user. All rows are ordered by user, streamed - each over its own
+    # connection, as a connection streams one result at the time - and merged on the user_id.
+    user_conditions = [("user_id IS NOT NULL", {})] + _in("user_id", "user_ids", user_ids)
+    with db.engine.connect() as ssh_keys_conn, db.engine.connect() as service_aups_conn:
+        ssh_keys = _rows_by_key(_execute(ssh_keys_conn, "SELECT user_id, ssh_value FROM ssh_keys", user_conditions,
+                                         order_by="user_id, id", stream=True))
+        service_aups = _rows_by_key(_execute(service_aups_conn,
+                                             "SELECT user_id, aup_url, service_id, agreed_at FROM service_aups",
+                                             user_conditions, order_by="user_id, id", stream=True))
+        yield from _merge_users(conn, user_ids, ssh_keys, service_aups)
+
+
+# Merge the users with the rows of their ssh_keys and service AUPs, returned by user_id
+def _merge_users(conn, user_ids, ssh_keys, service_aups):
+    rs = _execute(
+        conn,
+        """
+             SELECT u.id,
+                    u.uid,
+                    u.name,
+                    u.given_name,
+                    u.family_name,
+                    u.email,
+                    u.scoped_affiliation,
+                    u.eduperson_principal_name,
+                    u.username,
+                    u.last_login_date,
+                    u.suspended
+             FROM users u
+             """,
+        _in("u.id", "user_ids", user_ids),
+        order_by="u.id",
+        stream=True
+    )
 
-def _find_by_identifiers(seq, fk, values):
-    return [row for row in seq if row[fk] in values]
+    today = dt_today()
+
+    for row in rs:
+        user_id = row[0]
+        rounded_inactive_days_nbr = sram_inactive_days(row[9], today)
+
+        user_ssh_keys = ssh_keys(user_id)
+        user_service_aups = service_aups(user_id)
+        # Duplicates are removed preserving the order
+        accepted_aups = dict.fromkeys((aup[1], aup[2], str(aup[3])) for aup in user_service_aups)
+
+        yield {
+            "id": user_id,
+            "uid": row[1],
+            "name": row[2],
+            "given_name": row[3],
+            "family_name": row[4],
+            "email": row[5],
+            "scoped_affiliation": row[6],
+            "eduperson_principal_name": row[7],
+            "username": row[8],
+            "sram_inactive_days": rounded_inactive_days_nbr,
+            "status": "suspended" if row[10] else "active",
+            "ssh_keys": list(dict.fromkeys(ssh_key[1] for ssh_key in user_ssh_keys if ssh_key[1])),
+            "accepted_aups": [{"url": url, "service_id": service_id, "agreed_at": agreed_at}
+                              for url, service_id, agreed_at in accepted_aups],
+        }
+
+
+def _sync_parts(conn, organisation_ids=None, collaboration_ids=None, user_ids=None, service_ids=None):
+    """
+    Return generators for the organisations, services and users of the PLSC tree. The generators share the
+    connection and must be consumed one after the other.
+    """
+    return {
+        "organisations": _sync_organisations(conn, organisation_ids, collaboration_ids),
+        "services": _sync_services(conn, service_ids),
+        "users": _sync_users(conn, user_ids),
+    }
+
+
+def internal_sync(organisation_ids=None, collaboration_ids=None, user_ids=None, service_ids=None):
+    """
+    Return the PLSC tree. Each filter, if not None, restricts the tree to the organisations, collaborations,
+    users and services with the given identifiers. All filters are applied in the SQL queries.
+    """
+    with db.engine.connect() as conn:
+        parts = _sync_parts(conn, organisation_ids, collaboration_ids, user_ids, service_ids)
+        return {key: list(generator) for key, generator in parts.items()}
+
+
+def _chunks(strings):
+    """Encode and join the strings in chunks of about STREAM_CHUNK_SIZE"""
+    buffer, size = [], 0
+    for string in strings:
+        buffer.append(string)
+        size += len(string)
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def _json_strings(parts):
+    dumps = functools.partial(current_app.json.dumps, separators=(",", ":"))
+    yield "{"
+    for index, key in enumerate(sorted(parts)):
+        value = parts[key]
+        yield f"{',' if index else ''}{dumps(key)}:"
+        if not isinstance(value, types.GeneratorType):
+            yield dumps(value)
+            continue
+        yield "["
+        for item_index, item in enumerate(value):
+            yield f"{',' if item_index else ''}{dumps(item)}"
+        yield "]"
+    yield "}\n"
+
+
+def _stream_json(parts):
+    """
+    Encode the dict as JSON in chunks, like jsonify does. Generator values are encoded as lists, item by item, so
+    the complete document is never in memory.
+    """
+    return _chunks(_json_strings(parts))
+
+
+def _ldif_line(name, value):
+    value = str(value)
+    if _ldif_safe_string.match(value) and not value.endswith(" "):
+        return f"{name}: {value}\n"
+    return f"{name}:: {base64.b64encode(value.encode()).decode()}\n"
+
+
+def _ldif_entry(dn, attributes):
+    """Return the LDIF record of the entry, the attributes are (name, value) tuples and empty values are skipped"""
+    lines = [_ldif_line("dn", dn)] + [_ldif_line(name, value) for name, value in attributes
+                                      if value is not None and value != ""]
+    return "".join(lines) + "\n"
+
+
+def _dn(name, value, parent_dn):
+    # Escape the special characters of the attribute value of the RDN, see RFC 4514
+    value = re.sub(r'([\\,+"<>;=])', r"\\\1", str(value))
+    value = re.sub(r"^([ #])", r"\\\1", value)
+    value = re.sub(r" $", r"\\ ", value)
+    return f"{name}={value},{parent_dn}"
+
+
+def _ldif_records(parts, base_dn):
+    """
+    Yield the LDIF records of the PLSC tree: users under ou=People, collaborations and groups under ou=Groups and
+    services under ou=Services. Only the active collaboration memberships are members of the collaborations and
+    groups, and the services have the collaborations they are connected to as member.
+    """
+    people_dn, groups_dn, services_dn = (_dn("ou", ou, base_dn) for ou in ("People", "Groups", "Services"))
+    for ou, dn in (("People", people_dn), ("Groups", groups_dn), ("Services", services_dn)):
+        yield _ldif_entry(dn, [("objectClass", "organizationalUnit"), ("ou", ou)])
+
+    user_dns = {}
+    for user in parts["users"]:
+        if not user["username"]:
+            continue
+        dn = user_dns[user["id"]] = _dn("uid", user["username"], people_dn)
+        yield _ldif_entry(dn, [
+            ("objectClass", "inetOrgPerson"),
+            ("objectClass", "ldapPublicKey"),
+            ("uid", user["username"]),
+            ("cn", user["name"] or user["username"]),
+            ("sn", user["family_name"] or user["name"] or user["username"]),
+            ("givenName", user["given_name"]),
+            ("displayName", user["name"]),
+            ("mail", user["email"]),
+        ] + [("sshPublicKey", ssh_key) for ssh_key in user["ssh_keys"]])
+
+    collaboration_dns_by_service = defaultdict(list)
+    for organisation in parts["organisations"]:
+        for collaboration in organisation["collaborations"]:
+            if not collaboration["global_urn"]:
+                continue
+            dn = _dn("cn", collaboration["global_urn"], groups_dn)
+            for service_id in collaboration["services"]:
+                collaboration_dns_by_service[service_id].append(dn)
+            active_memberships = {m["id"]: m["user_id"] for m in collaboration["collaboration_memberships"]
+                                  if m["status"] == "active" and m["user_id"] in user_dns}
+            yield _ldif_entry(dn, [
+                ("objectClass", "groupOfMembers"),
+                ("cn", collaboration["global_urn"]),
+                ("o", organisation["name"]),
+                ("description", collaboration["description"]),
+            ] + [("member", user_dns[user_id]) for user_id in active_memberships.values()])
+            for group in collaboration["groups"]:
+                if not group["global_urn"]:
+                    continue
+                yield _ldif_entry(_dn("cn", group["global_urn"], groups_dn), [
+                    ("objectClass", "groupOfMembers"),
+                    ("cn", group["global_urn"]),
+                    ("o", organisation["name"]),
+                    ("description", group["description"]),
+                ] + [("member", user_dns[m["user_id"]]) for m in group["collaboration_memberships"]
+                     if m["collaboration_membership_id"] in active_memberships])
+
+    for service in parts["services"]:
+        cn = service["ldap_identifier"] or service["entity_id"]
+        yield _ldif_entry(_dn("cn", cn, services_dn), [
+            ("objectClass", "applicationProcess"),
+            ("objectClass", "extensibleObject"),
+            ("cn", cn),
+            ("description", service["name"]),
+            ("labeledURI", service["entity_id"]),
+            ("mail", service["contact_email"]),
+        ] + [("member", dn) for dn in collaboration_dns_by_service.get(service["id"], [])])
+
+
+def _encode_cursor(since, audit_log_id):
+    cursor = json.dumps({"since": since, "audit_log_id": audit_log_id})
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def _decode_cursor(cursor):
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        since = datetime.datetime.strptime(decoded["since"], "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+        return since, int(decoded["audit_log_id"])
+    except (ValueError, TypeError, KeyError):
+        raise BadRequest(f"Invalid cursor {cursor}")
+
+
+def _current_cursor():
+    """Return an opaque cursor marking the current state of the database, to be used for a next delta sync"""
+    with db.engine.connect() as conn:
+        now = conn.execute(text("SELECT CURRENT_TIMESTAMP")).scalar()
+        audit_log_id = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM audit_logs")).scalar()
+    since = now if isinstance(now, str) else now.strftime("%Y-%m-%d %H:%M:%S")
+    return _encode_cursor(since, audit_log_id)
 
 
-def _identifiers_only(seq):
-    return [r["id"] for r in seq]
+def _identifiers(conn, sql, params):
+    statement = text(sql).bindparams(*[bindparam(name, expanding=True) for name, value in params.items()
+                                       if isinstance(value, list)])
+    return {row[0] for row in conn.execute(statement, params) if row[0] is not None}
 
 
-def internal_sync():
-    result = {"organisations": [], "users": []}
+def _delta_filters(cursor):
+    """
+    Return the filters for internal_sync selecting the entities created or updated since the cursor, and the
+    tombstones of the entities deleted since the cursor.
+    """
+    since, audit_log_id = _decode_cursor(cursor)
+    params = {"since": since, "audit_log_id": audit_log_id}
     with db.engine.connect() as conn:
-        rs = conn.execute(
-            text("SELECT name, organisation_id FROM schac_home_organisations")
-        )
-        schac_home_organisations = [
-            {"name": row[0], "organisation_id": row[1]} for row in rs
-        ]
-
-        # Fetch services with fallback contact_email from service_memberships
-        # This eliminates N+1 queries for services without contact_email
-        rs = conn.execute(
-            text("""
-                 SELECT s.id,
-                        s.name,
-                        s.entity_id,
-                        s.contact_email,
-                        s.uuid4,
-                        s.ldap_password,
-                        s.accepted_user_policy,
-                        s.support_email,
-                        s.security_email,
-                        s.privacy_policy,
-                        s.ldap_enabled,
-                        s.ldap_identifier,
-                        s.abbreviation,
-                        COALESCE(s.contact_email, (SELECT u.email
-                                                   FROM service_memberships sm
-                                                            JOIN users u ON u.id = sm.user_id
-                                                   WHERE sm.service_id = s.id
-                                                   LIMIT 1)) as effective_contact_email
-                 FROM services s
-                 """)
-        )
-        services = [
-            {
-                "id": row[0],
-                "name": row[1],
-                "entity_id": row[2],
-                "contact_email": row[
-                    13
-                ],  # Use the effective_contact_email from COALESCE
-                "logo": logo_url("services", row[4]),
-                "ldap_password": row[5],
-                "accepted_user_policy": row[6],
-                "support_email": row[7],
-                "security_email": row[8],
-                "privacy_policy": row[9],
-                "ldap_enabled": row[10],
-                "ldap_identifier": row[11],
-                "abbreviation": row[12],
-            }
-            for row in rs
-        ]
-        rs = conn.execute(
-            text("SELECT service_id, collaboration_id FROM services_collaborations")
-        )
-        services_collaborations = [
-            {"service_id": row[0], "collaboration_id": row[1]} for row in rs
-        ]
-        rs = conn.execute(
-            text("SELECT role, user_id, organisation_id FROM organisation_memberships")
-        )
-        organisation_memberships = [
-            {"role": row[0], "user_id": row[1], "organisation_id": row[2]} for row in rs
-        ]
-        rs = conn.execute(
-            text(
-                "SELECT cm.id, cm.role, cm.user_id, collaboration_id, cm.status FROM "
-                "collaboration_memberships cm "
-                "INNER JOIN users u ON u.id = cm.user_id"
-            )
-        )
-        collaboration_memberships = [
-            {
-                "id": row[0],
-                "role": row[1],
-                "user_id": row[2],
-                "collaboration_id": row[3],
-                "status": row[4],
-            }
-            for row in rs
-        ]
-        rs = conn.execute(
-            text(
-                "SELECT collaboration_membership_id, group_id FROM collaboration_memberships_groups"
-            )
-        )
-        collaboration_memberships_groups = [
-            {"collaboration_membership_id": row[0], "group_id": row[1]} for row in rs
-        ]
-        rs = conn.execute(
-            text(
-                "SELECT id, identifier, name, short_name, global_urn, organisation_id, status, description, "
-                "uuid4, website_url from collaborations"
-            )
-        )
-        sbs_url_prefix = f"{current_app.app_config.base_url}/collaborations/"
-        collaborations = [
-            {
-                "id": row[0],
-                "identifier": row[1],
-                "name": row[2],
-                "short_name": row[3],
-                "global_urn": row[4],
-                "organisation_id": row[5],
-                "status": row[6],
-                "description": row[7],
-                "logo": logo_url("collaborations", row[8]),
-                "website_url": row[9],
-                "sbs_url": f"{sbs_url_prefix}{row[1]}",
-            }
-            for row in rs
-        ]
-        rs = conn.execute(
-            text(
-                "SELECT id, name, short_name, global_urn, identifier, collaboration_id, description FROM `groups`"
-            )
-        )
-        groups = [
-            {
-                "id": row[0],
-                "name": row[1],
-                "short_name": row[2],
-                "global_urn": row[3],
-                "identifier": row[4],
-                "collaboration_id": row[5],
-                "description": row[6],
-            }
-            for row in rs
-        ]
-        rs = conn.execute(
-            text(
-                "SELECT ct.collaboration_id, t.tag_value FROM collaboration_tags ct "
-                "INNER JOIN tags t ON t.id = ct.tag_id"
-            )
-        )
-        tags = [{"collaboration_id": row[0], "tag_value": row[1]} for row in rs]
-
-        rs = conn.execute(text("SELECT name, organisation_id from units"))
-        units = [{"name": row[0], "organisation_id": row[1]} for row in rs]
-
-        rs = conn.execute(
-            text(
-                "SELECT cu.collaboration_id, u.name from collaboration_units cu "
-                "inner join units u on u.id = cu.unit_id"
-            )
-        )
-        collaboration_units = [
-            {"collaboration_id": row[0], "name": row[1]} for row in rs
-        ]
-
-        for coll in collaborations:
-            collaboration_id = coll["id"]
-            coll["groups"] = _find_by_id(groups, "collaboration_id", collaboration_id)
-            for group in coll["groups"]:
-                group["collaboration_memberships"] = _find_by_id(
-                    collaboration_memberships_groups, "group_id", group["id"]
-                )
-                for collaboration_membership in group["collaboration_memberships"]:
-                    collaboration_membership["user_id"] = _find_user_id(
-                        collaboration_memberships,
-                        collaboration_membership["collaboration_membership_id"],
-                    )
-            service_identifiers = _find_by_id(
-                services_collaborations, "collaboration_id", collaboration_id
-            )
-            coll["services"] = _identifiers_only(
-                _find_by_identifiers(
-                    services, "id", [si["service_id"] for si in service_identifiers]
-                )
-            )
-            coll["collaboration_memberships"] = _find_by_id(
-                collaboration_memberships, "collaboration_id", collaboration_id
-            )
-            coll["tags"] = [
-                tag["tag_value"]
-                for tag in tags
-                if tag["collaboration_id"] == collaboration_id
-            ]
-            coll["units"] = [
-                u["name"]
-                for u in collaboration_units
-                if u["collaboration_id"] == collaboration_id
-            ]
-
-        rs = conn.execute(
-            text("SELECT id, name, identifier, short_name, uuid4 FROM organisations")
-        )
-        for row in rs:
-            organisation_id = row[0]
-            result["organisations"].append(
-                {
-                    "id": organisation_id,
-                    "name": row[1],
-                    "identifier": row[2],
-                    "short_name": row[3],
-                    "logo": logo_url("organisations", row[4]),
-                    "schac_home_organisations": _find_by_id(
-                        schac_home_organisations, "organisation_id", organisation_id
-                    ),
-                    "organisation_memberships": _find_by_id(
-                        organisation_memberships, "organisation_id", organisation_id
-                    ),
-                    "collaborations": _find_by_id(
-                        collaborations, "organisation_id", organisation_id
-                    ),
-                    "units": [
-                        u["name"]
-                        for u in units
-                        if u["organisation_id"] == organisation_id
-                    ],
-                }
-            )
-        result["services"] = services
-
-        # Fetch all users with their SSH keys and service AUPs in a single query using LEFT JOINs
-        # This eliminates the N+1 query problem (1 query instead of 1 + N*2 queries)
-        rs = conn.execute(
-            text("""
-                 SELECT u.id,
-                        u.uid,
-                        u.name,
-                        u.given_name,
-                        u.family_name,
-                        u.email,
-                        u.scoped_affiliation,
-                        u.eduperson_principal_name,
-                        u.username,
-                        u.last_login_date,
-                        u.suspended,
-                        sk.ssh_value,
-                        sa.aup_url,
-                        sa.service_id,
-                        sa.agreed_at
-                 FROM users u
-                          LEFT JOIN ssh_keys sk ON sk.user_id = u.id
-                          LEFT JOIN service_aups sa ON sa.user_id = u.id
-                 """)
-        )
-
-        # Build users dictionary, grouping SSH keys and AUPs by user_id
-        users_dict = {}
-        today = dt_today()
-
+        collaboration_ids = _identifiers(conn, """
+            SELECT id FROM collaborations WHERE updated_at >= :since
+            UNION SELECT collaboration_id FROM `groups` WHERE updated_at >= :since
+            UNION SELECT target_id FROM audit_logs WHERE id > :audit_log_id AND target_type = 'collaborations'
+            UNION SELECT parent_id FROM audit_logs WHERE id > :audit_log_id AND parent_name = 'collaborations'
+            UNION SELECT g.collaboration_id FROM audit_logs a INNER JOIN `groups` g ON g.id = a.parent_id
+                WHERE a.id > :audit_log_id AND a.parent_name = 'groups'
+            """, params)
+        organisation_ids = _identifiers(conn, """
+            SELECT id FROM organisations WHERE updated_at >= :since
+            UNION SELECT target_id FROM audit_logs WHERE id > :audit_log_id AND target_type = 'organisations'
+            UNION SELECT parent_id FROM audit_logs WHERE id > :audit_log_id AND parent_name = 'organisations'
+            """, params)
+        if collaboration_ids:
+            organisation_ids.update(_identifiers(conn,
+                                                 "SELECT organisation_id FROM collaborations WHERE id IN :collaboration_ids",
+                                                 {"collaboration_ids": list(collaboration_ids)}))
+        service_ids = _identifiers(conn, """
+            SELECT id FROM services WHERE updated_at >= :since
+            UNION SELECT target_id FROM audit_logs WHERE id > :audit_log_id AND target_type = 'services'
+            UNION SELECT parent_id FROM audit_logs WHERE id > :audit_log_id AND parent_name = 'services'
+            """, params)
+        user_ids = _identifiers(conn, """
+            SELECT id FROM users WHERE updated_at >= :since
+            UNION SELECT subject_id FROM audit_logs WHERE id > :audit_log_id
+                AND target_type IN ('ssh_keys', 'service_aups')
+            """, params)
+        deleted = {target_type: [] for target_type in _tombstone_types}
+        rs = conn.execute(text("SELECT target_type, target_id FROM audit_logs WHERE id > :audit_log_id "
+                               "AND action = :action ORDER BY id"), {**params, "action": ACTION_DELETE})
         for row in rs:
-            user_id = row[0]
-
-            # Create user entry if not exists
-            if user_id not in users_dict:
-                last_login_date = pytz.utc.localize(
-                    row[9] if row[9] else datetime.datetime(2000, 1, 1, 0, 0, 0, 0)
-                )
-                inactive_days = today - last_login_date
-                rounded_inactive_days_nbr = inactivity(inactive_days.days)
-
-                users_dict[user_id] = {
-                    "id": user_id,
-                    "uid": row[1],
-                    "name": row[2],
-                    "given_name": row[3],
-                    "family_name": row[4],
-                    "email": row[5],
-                    "scoped_affiliation": row[6],
-                    "eduperson_principal_name": row[7],
-                    "username": row[8],
-                    "sram_inactive_days": rounded_inactive_days_nbr,
-                    "status": "suspended" if row[10] else "active",
-                    "ssh_keys": [],
-                    "accepted_aups": [],
-                }
-
-            # Append SSH key if present (avoiding duplicates)
-            if row[11] and row[11] not in users_dict[user_id]["ssh_keys"]:
-                users_dict[user_id]["ssh_keys"].append(row[11])
+            if row[0] in deleted and row[1] not in deleted[row[0]]:
+                deleted[row[0]].append(row[1])
+
+    filters = {"organisation_ids": organisation_ids, "collaboration_ids": collaboration_ids, "user_ids": user_ids,
+               "service_ids": service_ids}
+    return filters, deleted
+
+
+def internal_delta_sync(cursor):
+    """
+    Return the entities created, updated or deleted since the cursor. Organisations are returned with only their
+    changed collaborations. The updated_at columns are compared to the cursor with second precision, so entities
+    changed in the second of the cursor are returned again in the next delta. Deletions are returned as tombstones
+    taken from the DELETE actions in the audit_logs.
+    """
+    filters, deleted = _delta_filters(cursor)
+    result = internal_sync(**filters)
+    result["deleted"] = deleted
+    return result
 
-            # Append service AUP if present (avoiding duplicates)
-            if row[12]:
-                aup_entry = {
-                    "url": row[12],
-                    "service_id": row[13],
-                    "agreed_at": str(row[14]),
-                }
-                # Check if this AUP is already added (to avoid duplicates from JOIN)
-                if aup_entry not in users_dict[user_id]["accepted_aups"]:
-                    users_dict[user_id]["accepted_aups"].append(aup_entry)
 
-        result["users"] = list(users_dict.values())
-    return result
+def _shard_organisation_ids():
+    """
+    Return the identifiers of the organisations of the shard requested with either the organisation_ids or the
+    shard - index/count - query parameter, or None if no shard is requested
+    """
+    organisation_ids = query_param("organisation_ids", required=False)
+    shard = query_param("shard", required=False)
+    if organisation_ids and shard:
+        raise BadRequest("Specify either organisation_ids or shard")
+    if organisation_ids:
+        try:
+            return [int(organisation_id) for organisation_id in organisation_ids.split(",")]
+        except ValueError:
+            raise BadRequest(f"Invalid organisation_ids {organisation_ids}")
+    if shard:
+        try:
+            index, count = (int(part) for part in shard.split("/"))
+            if not 0 <= index < count:
+                raise ValueError()
+        except ValueError:
+            raise BadRequest(f"Invalid shard {shard}")
+        with db.engine.connect() as conn:
+            return sorted(_identifiers(conn, "SELECT id FROM organisations WHERE MOD(id, :count) = :index",
+                                       {"count": count, "index": index}))
+    return None
+
+
+def _shard_filters(organisation_ids):
+    """Return the filters for internal_sync selecting the organisations and the users and services they reference"""
+    params = {"organisation_ids": organisation_ids}
+    with db.engine.connect() as conn:
+        user_ids = _identifiers(conn, """
+            SELECT user_id FROM organisation_memberships WHERE organisation_id IN :organisation_ids
+            UNION SELECT cm.user_id FROM collaboration_memberships cm
+                INNER JOIN collaborations c ON c.id = cm.collaboration_id
+                WHERE c.organisation_id IN :organisation_ids
+            """, params)
+        service_ids = _identifiers(conn, """
+            SELECT sc.service_id FROM services_collaborations sc
+                INNER JOIN collaborations c ON c.id = sc.collaboration_id
+                WHERE c.organisation_id IN :organisation_ids
+            """, params)
+    return {"organisation_ids": organisation_ids, "user_ids": user_ids, "service_ids": service_ids}
+
+
+def internal_shard_sync(organisation_ids):
+    """
+    Return the PLSC tree of the organisations, with only the users and services referenced by the organisations
+    and their collaborations
+    """
+    return internal_sync(**_shard_filters(organisation_ids))
+
+
+def _snapshot_version():
+    # The sram_inactive_days of the users depend on the current day
+    return f"{data_version()}-{dt_today().strftime('%Y%m%d')}"
+
+
+def _cached_snapshot(version, with_data=False):
+    """Return the cached snapshot of the full sync if it is of the given version, otherwise None"""
+    fields = _snapshot_fields + (["data"] if with_data else [])
+    values = current_app.redis_client.hmget(SNAPSHOT_KEY, fields)
+    if values[0] is None or values[0].decode() != version or None in values:
+        return None
+    snapshot = {field: value.decode() for field, value in zip(_snapshot_fields, values)}
+    if with_data:
+        snapshot["data"] = zlib.decompress(values[-1])
+    return snapshot
+
+
+def _store_snapshot(version, cursor, etag, compressed):
+    snapshot = {"version": version, "etag": etag, "cursor": cursor}
+    with current_app.redis_client.pipeline() as pipe:
+        pipe.hset(SNAPSHOT_KEY, mapping={**snapshot, "data": compressed})
+        pipe.expire(SNAPSHOT_KEY, current_app.app_config.plsc.snapshot_ttl_seconds)
+        pipe.execute()
+    return snapshot
+
+
+def _snapshot_stream(chunks, version, cursor):
+    """Yield the chunks of the full sync and store them as the snapshot of the version after the last chunk"""
+    compressor = zlib.compressobj()
+    digest = hashlib.sha256()
+    compressed = []
+    for chunk in chunks:
+        digest.update(chunk)
+        compressed.append(compressor.compress(chunk))
+        yield chunk
+    compressed.append(compressor.flush())
+    _store_snapshot(version, cursor, digest.hexdigest(), b"".join(compressed))
+
+
+def _not_modified(snapshot):
+    return current_request.if_none_match.contains(snapshot["etag"])
+
+
+def _snapshot_headers(snapshot):
+    return {CURSOR_HEADER: snapshot["cursor"], "ETag": f"\"{snapshot['etag']}\""}
 
 
 @plsc_api.route("/sync", methods=["GET"], strict_slashes=False)
@@ -331,18 +716,43 @@ def sync():
     auth_filter(current_app.app_config)
     confirm_read_access()
 
+    cursor = query_param("since", required=False)
+    organisation_ids = _shard_organisation_ids()
+    version = None
+    if cursor:
+        if organisation_ids is not None:
+            raise BadRequest("A delta sync can not be sharded")
+        # Validate the cursor before the headers are written
+        _decode_cursor(cursor)
+    elif organisation_ids is None:
+        version = _snapshot_version()
+        snapshot = _cached_snapshot(version)
+        if snapshot and _not_modified(snapshot):
+            return Response(status=304, headers=_snapshot_headers(snapshot))
+        snapshot = _cached_snapshot(version, with_data=True) if snapshot else None
+        if snapshot:
+            return Response(snapshot["data"], mimetype="application/json", headers=_snapshot_headers(snapshot))
+    next_cursor = _current_cursor()
+
     def do_sync():
         # Yielding the first (empty) bytes will force to write the headers
         yield b""
 
-        result = internal_sync()
-
-        yield jsonify(result).data
+        filters, extra = {}, {}
+        if cursor:
+            filters, deleted = _delta_filters(cursor)
+            extra = {"deleted": deleted, "cursor": next_cursor}
+        elif organisation_ids is not None:
+            filters = _shard_filters(organisation_ids)
+        with db.engine.connect() as conn:
+            chunks = _stream_json({**_sync_parts(conn, **filters), **extra})
+            yield from (_snapshot_stream(chunks, version, next_cursor) if version else chunks)
 
     return Response(
         stream_with_context(do_sync()),
         content_type="application/json",
         mimetype="application/json",
+        headers={CURSOR_HEADER: next_cursor},
         status=200,
     )
 
@@ -352,4 +762,60 @@ def sync():
 def syncing():
     confirm_read_access()
 
-    return internal_sync(), 200
+    cursor = query_param("since", required=False)
+    organisation_ids = _shard_organisation_ids()
+    status = 200
+    if cursor:
+        if organisation_ids is not None:
+            raise BadRequest("A delta sync can not be sharded")
+        next_cursor = _current_cursor()
+        result = internal_delta_sync(cursor)
+        result["cursor"] = next_cursor
+        headers = {CURSOR_HEADER: next_cursor}
+    elif organisation_ids is not None:
+        next_cursor = _current_cursor()
+        result = internal_shard_sync(organisation_ids)
+        headers = {CURSOR_HEADER: next_cursor}
+    else:
+        version = _snapshot_version()
+        snapshot = _cached_snapshot(version)
+        if snapshot and _not_modified(snapshot):
+            result, status = {}, 304
+        elif snapshot and (cached := _cached_snapshot(version, with_data=True)):
+            snapshot, result = cached, json.loads(cached["data"])
+        else:
+            next_cursor = _current_cursor()
+            result = internal_sync()
+            data = jsonify(result).data
+            snapshot = _store_snapshot(version, next_cursor, hashlib.sha256(data).hexdigest(), zlib.compress(data))
+        headers = _snapshot_headers(snapshot)
+
+    def response_header(response: Response):
+        for name, value in headers.items():
+            response.headers.set(name, value)
+        return status
+
+    return result, response_header
+
+
+@plsc_api.route("/ldif", methods=["GET"], strict_slashes=False)
+def ldif():
+    auth_filter(current_app.app_config)
+    confirm_read_access()
+
+    organisation_ids = _shard_organisation_ids()
+    base_dn = urlparse(current_app.app_config.ldap.url).path.lstrip("/")
+
+    def do_ldif():
+        # Yielding the first (empty) bytes will force to write the headers
+        yield b""
+
+        filters = _shard_filters(organisation_ids) if organisation_ids is not None else {}
+        with db.engine.connect() as conn:
+            yield from _chunks(_ldif_records(_sync_parts(conn, **filters), base_dn))
+
+    return Response(
+        stream_with_context(do_ldif()),
+        mimetype="text/plain",
+        status=200,
+    )
@@ -1,16 +1,12 @@
-import re
 import traceback
 import urllib.parse
-from typing import Union
-
 import requests
 from cryptography.exceptions import InvalidTag
 from flasgger import swag_from
-from flask import Blueprint, Response
-from sqlalchemy import func
+from flask import Blueprint, Response, current_app, request as current_request
 from werkzeug.exceptions import Unauthorized, BadRequest
 
-from server.api.base import json_endpoint, query_param, send_error_mail
+from server.api.base import json_endpoint, query_param, send_error_mail, auth_filter
 from server.auth.security import confirm_write_access, is_service_admin
 from server.auth.tokens import validate_service_token
 from server.db.db import db
@@ -19,7 +15,16 @@ from server.db.domain import User, Collaboration, Group, Service
 from server.logger.context_logger import ctx_logger
 from server.scim import SCIM_URL_PREFIX, EXTERNAL_ID_POST_FIX
 from server.scim.group_template import find_groups_template, find_group_by_id_template
-from server.scim.repo import all_scim_users_by_service, all_scim_groups_by_service
+from server.scim.circuit_breaker import circuit_breaker_statistics
+from server.scim.fifo_pool import prometheus_metrics
+from server.scim.outbox import outbox_statistics, prometheus_outbox_statistics
+from server.scim.session import scim_request_metrics, prometheus_request_metrics
+from server.scim.list_request import list_paging, list_sorting, AttributeProjection
+from server.scim.filter import parse_scim_filter, filter_attributes, scim_filter_criteria
+from server.scim.repo import scim_users_query, paged_scim_users, paged_scim_groups, USER_SORT_COLUMNS, \
+    GROUP_SORT_COLUMNS, user_filter_columns, group_filter_columns, scim_users_aggregate, scim_groups_aggregate, \
+    scim_user_version, scim_group_version, scim_user_options, scim_group_options, scim_user_versions, \
+    scim_group_versions
 from server.scim.resource_type_template import resource_type_template, resource_type_user_template, \
     resource_type_group_template
 from server.scim.schema_template import schemas_template, \
@@ -28,19 +33,24 @@ from server.scim.schema_template import schemas_template, \
     get_scim_schema_sram_user, get_scim_schema_sram_group, \
     SCIM_SCHEMA_CORE_USER, SCIM_SCHEMA_CORE_GROUP
 from server.scim.sweep import perform_sweep
-from server.scim.user_template import find_users_template, find_user_by_id_template, version_value
+from server.scim.user_template import find_users_template, find_user_by_id_template
 
 scim_api = Blueprint("scim_api", __name__, url_prefix=SCIM_URL_PREFIX)
 
 
-def _add_etag_header(scim_object: Union[User, Group, Collaboration]):
+def _add_etag_header(version: str, status: int = 200):
     def response_header(response: Response):
-        response.headers.set("Etag", version_value(scim_object))
-        return 200
+        response.headers.set("Etag", version)
+        return status
 
     return response_header
 
 
+def _not_modified(version: str):
+    # The SCIM clients revalidate with If-None-Match, see https://www.rfc-editor.org/rfc/rfc7644#section-3.14
+    return current_request.if_none_match.contains_weak(version)
+
+
 @scim_api.route(f"/Schemas/{SCIM_SCHEMA_CORE_USER}", methods=["GET"], strict_slashes=False)
 @json_endpoint
 def schema_core_user():
@@ -97,16 +107,27 @@ def resource_types():
 def service_users():
     service = validate_service_token("scim_client_enabled", SERVICE_TOKEN_SCIM)
     filter_param = query_param("filter", required=False)
-    # note: we only support "eq" here.
+    users_query = scim_users_query(service)
     if filter_param:
-        query = urllib.parse.unquote(filter_param)
-        if not query.lower().startswith(f"{get_scim_schema_sram_user()}.eduPersonUniqueId".lower()):
-            raise NotImplementedError(f"Not supported filter {query}")
-        uid = re.search(r"(?:'|\")(.*)(?:'|\")", query).group(1)
-        users = User.query.filter(func.lower(User.uid) == func.lower(uid)).all()
-    else:
-        users = all_scim_users_by_service(service)
-    return find_users_template(users), 200
+        extension_schemas = [get_scim_schema_sram_user()]
+        tree = parse_scim_filter(urllib.parse.unquote(filter_param))
+        attributes = filter_attributes(tree, SCIM_SCHEMA_CORE_USER, extension_schemas)
+        # The lookup by eduPersonUniqueId is not restricted to the users of the service
+        if attributes == {f"{get_scim_schema_sram_user().lower()}:edupersonuniqueid"}:
+            users_query = User.query
+        users_query = users_query.filter(
+            scim_filter_criteria(tree, user_filter_columns(), SCIM_SCHEMA_CORE_USER, extension_schemas))
+    start_index, count = list_paging()
+    sort_column, descending = list_sorting(USER_SORT_COLUMNS, SCIM_SCHEMA_CORE_USER)
+    projection = AttributeProjection(SCIM_SCHEMA_CORE_USER, [get_scim_schema_sram_user()])
+    total_results, version = scim_users_aggregate(users_query)
+    if _not_modified(version):
+        return {}, _add_etag_header(version, 304)
+    users, total_results = paged_scim_users(users_query, start_index, count, sort_column, descending,
+                                            with_ssh_keys=projection.returned("x509Certificates"),
+                                            total_results=total_results)
+    versions = scim_user_versions([user.id for user in users])
+    return find_users_template(users, total_results, start_index, projection, versions), _add_etag_header(version)
 
 
 @scim_api.route("/Users/<user_external_id>", methods=["GET"], strict_slashes=False)
@@ -115,8 +136,21 @@ def service_users():
 def service_user_by_external_id(user_external_id: str):
     validate_service_token("scim_client_enabled", SERVICE_TOKEN_SCIM)
     stripped_external_id = user_external_id.replace(EXTERNAL_ID_POST_FIX, "")
-    user = User.query.filter(User.external_id == stripped_external_id).one()
-    return find_user_by_id_template(user), _add_etag_header(user)
+    version = scim_user_version(stripped_external_id)
+    if _not_modified(version):
+        return {}, _add_etag_header(version, 304)
+    user = User.query.filter(User.external_id == stripped_external_id).options(*scim_user_options()).one()
+    return find_user_by_id_template(user, version), _add_etag_header(version)
+
+
+# The filter is applied to both the collaborations and the groups
+def _group_filter_criteria(filter_param: str):
+    if not filter_param:
+        return None
+    extension_schemas = [get_scim_schema_sram_group()]
+    tree = parse_scim_filter(urllib.parse.unquote(filter_param))
+    return lambda model: scim_filter_criteria(tree, group_filter_columns(model), SCIM_SCHEMA_CORE_GROUP,
+                                              extension_schemas)
 
 
 @scim_api.route("/Groups", methods=["GET"], strict_slashes=False)
@@ -124,8 +158,19 @@ def service_user_by_external_id(user_external_id: str):
 @json_endpoint
 def service_groups():
     service = validate_service_token("scim_client_enabled", SERVICE_TOKEN_SCIM)
-    all_scim_groups = all_scim_groups_by_service(service)
-    return find_groups_template(all_scim_groups), 200
+    criteria = _group_filter_criteria(query_param("filter", required=False))
+    start_index, count = list_paging()
+    sort_column_name, descending = list_sorting(GROUP_SORT_COLUMNS, SCIM_SCHEMA_CORE_GROUP)
+    projection = AttributeProjection(SCIM_SCHEMA_CORE_GROUP, [get_scim_schema_sram_group()])
+    total_results, version = scim_groups_aggregate(service, criteria)
+    if _not_modified(version):
+        return {}, _add_etag_header(version, 304)
+    groups, total_results = paged_scim_groups(service, start_index, count, sort_column_name, descending,
+                                              with_members=projection.returned("members"), criteria=criteria,
+                                              total_results=total_results)
+    versions = {(model, key): group_version for model in [Collaboration, Group] for key, group_version in
+                scim_group_versions(model, [group.id for group in groups if isinstance(group, model)]).items()}
+    return find_groups_template(groups, total_results, start_index, projection, versions), _add_etag_header(version)
 
 
 @scim_api.route("/Groups/<group_external_id>", methods=["GET"], strict_slashes=False)
@@ -134,10 +179,19 @@ def service_groups():
 def service_group_by_identifier(group_external_id: str):
     validate_service_token("scim_client_enabled", SERVICE_TOKEN_SCIM)
     stripped_group_identifier = group_external_id.replace(EXTERNAL_ID_POST_FIX, "")
-    group = Collaboration.query.filter(Collaboration.identifier == stripped_group_identifier).first()
+    version = scim_group_version(stripped_group_identifier)
+    if _not_modified(version):
+        return {}, _add_etag_header(version, 304)
+    group = Collaboration.query \
+        .filter(Collaboration.identifier == stripped_group_identifier) \
+        .options(*scim_group_options(Collaboration)) \
+        .first()
     if not group:
-        group = Group.query.filter(Group.identifier == stripped_group_identifier).one()
-    return find_group_by_id_template(group), _add_etag_header(group)
+        group = Group.query \
+            .filter(Group.identifier == stripped_group_identifier) \
+            .options(*scim_group_options(Group)) \
+            .one()
+    return find_group_by_id_template(group, version), _add_etag_header(version)
 
 
 @scim_api.route("/sweep", methods=["PUT"], strict_slashes=False)
@@ -185,3 +239,56 @@ def sweep():
 def scim_service():
     confirm_write_access()
     return Service.query.filter(Service.scim_enabled == True).all(), 200  # noqa: E712
+
+
+@scim_api.route("/circuit-breakers", methods=["GET"], strict_slashes=False)
+@json_endpoint
+def scim_circuit_breakers():
+    confirm_write_access()
+    return circuit_breaker_statistics(), 200
+
+
+@scim_api.route("/fifo-pool", methods=["GET"], strict_slashes=False)
+@json_endpoint
+def scim_fifo_pool():
+    # The drains of the outbox per endpoint, see /requests for the SCIM requests they send
+    confirm_write_access()
+    return current_app.scim_fifo_pool.metrics(), 200
+
+
+@scim_api.route("/fifo-pool/metrics", methods=["GET"], strict_slashes=False)
+def scim_fifo_pool_prometheus():
+    auth_filter(current_app.app_config)
+    confirm_write_access()
+    return Response(prometheus_metrics(current_app.scim_fifo_pool.metrics()),
+                    mimetype="text/plain; version=0.0.4", status=200)
+
+
+@scim_api.route("/requests", methods=["GET"], strict_slashes=False)
+@json_endpoint
+def scim_requests():
+    confirm_write_access()
+    return scim_request_metrics(), 200
+
+
+@scim_api.route("/requests/metrics", methods=["GET"], strict_slashes=False)
+def scim_requests_prometheus():
+    auth_filter(current_app.app_config)
+    confirm_write_access()
+    return Response(prometheus_request_metrics(scim_request_metrics()),
+                    mimetype="text/plain; version=0.0.4", status=200)
+
+
+@scim_api.route("/outbox", methods=["GET"], strict_slashes=False)
+@json_endpoint
+def scim_outbox():
+    confirm_write_access()
+    return outbox_statistics(), 200
+
+
+@scim_api.route("/outbox/metrics", methods=["GET"], strict_slashes=False)
+def scim_outbox_prometheus():
+    auth_filter(current_app.app_config)
+    confirm_write_access()
+    return Response(prometheus_outbox_statistics(outbox_statistics()),
+                    mimetype="text/plain; version=0.0.4", status=200)
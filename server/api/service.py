@@ -647,7 +647,8 @@ def update_service():
         for attr in [fb for fb in forbidden if fb in data]:
             data[attr] = getattr(service, attr)
 
-    for attr in ["sweep_scim_last_run", "ldap_password", "scim_bearer_token", "oidc_client_secret", "exported_at"]:
+    for attr in ["sweep_scim_last_run", "sweep_scim_last_incremental_run", "ldap_password", "scim_bearer_token",
+                 "oidc_client_secret", "exported_at"]:
         if attr in data:
             del data[attr]
 
@@ -674,6 +675,7 @@ def update_service():
         data["sweep_scim_enabled"] = False
         data["sweep_remove_orphans"] = False
         data["sweep_scim_daily_rate"] = None
+        data["sweep_scim_concurrency"] = None
 
     res = update(Service, custom_json=data, allow_child_cascades=False)
     service = res[0]
@@ -5,10 +5,9 @@ from flask import Blueprint, request as current_request, current_app
 
 from server.api.base import json_endpoint
 from server.auth.secrets import secure_hash
-from server.auth.service_access import collaboration_memberships_for_service, has_user_access_to_service
+from server.auth.entitlements import service_entitlements, has_service_access
 from server.auth.tokens import validate_service_token
-from server.auth.user_claims import user_memberships
-from server.db.activity import update_last_activity_date
+from server.db.activity import update_last_activity_dates
 from server.db.db import db
 from server.db.defaults import USER_TOKEN_INTROSPECT, SERVICE_TOKEN_INTROSPECTION
 from server.db.domain import UserToken
@@ -48,20 +47,16 @@ def introspect():
     if user.suspended:
         return failed_login("user-suspended", service, user_token)
 
-    if not has_user_access_to_service(service, user):
+    entitlements = service_entitlements(service, user)
+    if not has_service_access(service, user, entitlements):
         return failed_login("token-not-connected", service, user_token)
 
-    memberships = collaboration_memberships_for_service(service, user_token.user)
-    connected_collaborations = [cm.collaboration for cm in memberships]
-
-    for collaboration in connected_collaborations:
-        update_last_activity_date(collaboration.id)
+    update_last_activity_dates(entitlements["collaboration_ids"])
     current_time = dt_now()
     user_token.last_used_date = current_time
     db.session.merge(user_token)
 
     epoch = int(current_time.timestamp())
-    entitlements = user_memberships(user, connected_collaborations)
     result = {
         "active": True,
         "status": "token-valid",
@@ -82,7 +77,7 @@ def introspect():
             "voperson_external_affiliation": user.scoped_affiliation,
             "uid": user.uid,
             "username": user.username,
-            "eduperson_entitlement": list(entitlements)
+            "eduperson_entitlement": entitlements["memberships"]
         }
     }
     log_user_login(USER_TOKEN_INTROSPECT, True, user, user.uid, service, service.entity_id, status="token-valid")
@@ -6,13 +6,12 @@ from flask import Blueprint, current_app, request as current_request, redirect,
 from sqlalchemy import or_
 from werkzeug.exceptions import Forbidden, NotFound
 
-from server import tools
 from server.api.base import json_endpoint, send_error_mail, query_param
 from server.api.service_aups import has_agreed_with
+from server.auth.entitlements import service_entitlements, has_service_access
 from server.auth.mfa import user_requires_sram_mfa, store_user_in_session
-from server.auth.service_access import has_user_access_to_service, collaboration_memberships_for_service
-from server.auth.user_claims import user_memberships, co_tags
 from server.auth.user_codes import UserCode
+from server.db.activity import update_last_activity_dates
 from server.db.db import db
 from server.db.defaults import PROXY_AUTHZ_EB
 from server.db.domain import User, Service, UserNonce
@@ -21,18 +20,14 @@ from server.db.models import log_user_login
 user_login_eb = Blueprint("user_login_eb", __name__, url_prefix="/api/users")
 
 
-def user_attributes(service: Service, user: User):
+def user_attributes(service: Service, user: User, entitlements: dict = None):
     # All is well, we collect all memberships and return authorized
     user.successful_login()
     user = db.session.merge(user)
-    memberships = collaboration_memberships_for_service(service, user)
-    connected_collaborations = [cm.collaboration for cm in memberships]
-    for coll in connected_collaborations:
-        coll.last_activity_date = tools.dt_now()
-        db.session.merge(coll)
-    all_memberships = user_memberships(user, connected_collaborations)
-    all_tags = co_tags(connected_collaborations)
-    all_attributes = all_memberships.union(all_tags)
+    if entitlements is None:
+        entitlements = service_entitlements(service, user)
+    update_last_activity_dates(entitlements["collaboration_ids"])
+    all_attributes = set(entitlements["memberships"]).union(entitlements["labels"])
 
     log_user_login(PROXY_AUTHZ_EB, True, user, user.uid, service, service.entity_id, "AUTHORIZED")
 
@@ -94,6 +89,7 @@ def proxy_authz_eb():
     user_nonce = UserNonce(user=user, service=service, nonce=nonce, continue_url=continue_url, issuer_id=issuer_id,
                            requested_service_entity_id=service_entity_id,
                            requested_user_id=user.uid if user else collab_person_id)
+    entitlements = service_entitlements(service, user) if service and user else None
     # Unknown service is dead end, but we return interrupt
     if not service:
         msg = f"Returning interrupt for user {collab_person_id} and service_entity_id {service_entity_id} " \
@@ -127,7 +123,7 @@ def proxy_authz_eb():
                 "message": UserCode.USER_UNKNOWN.name
             }
     # if none of CO's are not active, then this is the same as none of the CO's are not connected to the Service
-    elif not has_user_access_to_service(service, user):
+    elif not has_service_access(service, user, entitlements):
         logger.debug(f"Returning unauthorized for user {user.uid} and service_entity_id {service_entity_id} "
                      "because the service is not connected to any active CO's")
         user_nonce.error_status = UserCode.SERVICE_NOT_CONNECTED.value
@@ -165,7 +161,7 @@ def proxy_authz_eb():
             "message": UserCode.AUP_NOT_AGREED.name
         }
     else:
-        attributes = user_attributes(service, user)
+        attributes = user_attributes(service, user, entitlements)
         return attributes, 200
 
     # Once we got here, we need to store the UserNonce
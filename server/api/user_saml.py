@@ -2,13 +2,13 @@ from urllib.parse import urlencode
 
 from flask import Blueprint, current_app, request as current_request
 
-from server import tools
 from server.api.base import json_endpoint, send_error_mail
 from server.api.service_aups import has_agreed_with
+from server.auth.authz_decisions import cached_authz_decision, store_authz_decision, authz_decision_generations
+from server.auth.entitlements import service_entitlements, has_service_access
 from server.auth.mfa import user_requires_sram_mfa
-from server.auth.service_access import has_user_access_to_service, collaboration_memberships_for_service
-from server.auth.user_claims import user_memberships, co_tags
 from server.auth.user_codes import UserCode
+from server.db.activity import update_last_activity_dates
 from server.db.db import db
 from server.db.defaults import PROXY_AUTHZ
 from server.db.domain import User, Service
@@ -18,6 +18,22 @@ from server.logger.context_logger import ctx_logger
 user_saml_api = Blueprint("user_saml_api", __name__, url_prefix="/api/users")
 
 
+def _replay_authz_decision(decision: dict, uid: str, service_entity_id: str):
+    response = decision["response"]
+    if response["status"]["result"] != "authorized":
+        return response
+    user = db.session.get(User, decision["user_id"])
+    if user is None:
+        return None
+    # The decision is cached, the login itself is not
+    user.successful_login()
+    user = db.session.merge(user)
+    update_last_activity_dates(decision["collaboration_ids"])
+    service = db.session.get(Service, decision["service_id"])
+    log_user_login(PROXY_AUTHZ, True, user, uid, service, service_entity_id, "AUTHORIZED")
+    return response
+
+
 # Endpoint for eduTEAMS
 @user_saml_api.route("/proxy_authz", methods=["POST"], strict_slashes=False)
 @json_endpoint
@@ -37,6 +53,13 @@ def proxy_authz_edu_teams():
         logger.debug(f"Return authorized to start SBS login flow, service_entity_id={service_entity_id}")
         return {"status": {"result": "authorized"}}, 200
 
+    decision = cached_authz_decision(uid, service_entity_id, issuer_id)
+    response = _replay_authz_decision(decision, uid, service_entity_id) if decision else None
+    if response is not None:
+        logger.debug(f"Returning cached {response['status']['result']} for user {uid} and service_entity_id "
+                     f"{service_entity_id}")
+        return response, 200
+
     parameters = {"service_name": service_entity_id, "entity_id": service_entity_id, "issuer_id": issuer_id,
                   "user_id": uid}
     service = Service.query.filter(Service.entity_id == service_entity_id).first()
@@ -60,6 +83,8 @@ def proxy_authz_edu_teams():
     parameters["service_name"] = service.name
 
     user = User.query.filter(User.uid == uid).first()
+    # Read before the decision is computed, so a decision computed from the data before a change is not stored
+    generations = authz_decision_generations(user, service) if user else None
     if not user:
         free_rider = service.non_member_users_access_allowed
         user_code = UserCode.NEW_FREE_RIDE_USER if free_rider else UserCode.USER_UNKNOWN
@@ -100,18 +125,22 @@ def proxy_authz_edu_teams():
         }, 200
 
     # if none of CO's are not active, then this is the same as none of the CO's are not connected to the Service
-    if not has_user_access_to_service(service, user):
+    entitlements = service_entitlements(service, user)
+    if not has_service_access(service, user, entitlements):
         logger.debug(f"Returning unauthorized for user {uid} and service_entity_id {service_entity_id} "
                      "because the service is not connected to any active CO's")
         parameters["error_status"] = UserCode.SERVICE_NOT_CONNECTED.value
-        return {
+        response = {
             "status": {
                 "result": "unauthorized",
                 "redirect_url": f"{client_base_url}/service-denied?{urlencode(parameters)}",
                 "error_status": UserCode.SERVICE_NOT_CONNECTED.value,
                 "info": UserCode.SERVICE_NOT_CONNECTED.name
             }
-        }, 200
+        }
+        # Stable until the user, the memberships or the service change, unlike the interrupts
+        store_authz_decision(uid, service_entity_id, issuer_id, user, service, generations, response)
+        return response, 200
 
     if not has_agreed_with(user, service):
         logger.debug(f"Returning interrupt for user {uid} and service_entity_id {service_entity_id} to accept "
@@ -140,18 +169,12 @@ def proxy_authz_edu_teams():
     # All is well, we collect all memberships and return authorized
     user.successful_login()
     user = db.session.merge(user)
-    memberships = collaboration_memberships_for_service(service, user)
-    connected_collaborations = [cm.collaboration for cm in memberships]
-    for coll in connected_collaborations:
-        coll.last_activity_date = tools.dt_now()
-        db.session.merge(coll)
-    all_memberships = user_memberships(user, connected_collaborations)
-    all_tags = co_tags(connected_collaborations)
-    all_attributes = all_memberships.union(all_tags)
+    update_last_activity_dates(entitlements["collaboration_ids"])
+    all_attributes = set(entitlements["memberships"]).union(entitlements["labels"])
 
     log_user_login(PROXY_AUTHZ, True, user, uid, service, service_entity_id, "AUTHORIZED")
 
-    return {
+    response = {
         "status": {
             "result": "authorized",
         },
@@ -161,4 +184,7 @@ def proxy_authz_edu_teams():
             "uid": [user.username],
             "sshkey": [ssh_key.ssh_value for ssh_key in user.ssh_keys]
         }
-    }, 200
+    }
+    store_authz_decision(uid, service_entity_id, issuer_id, user, service, generations, response,
+                         entitlements["collaboration_ids"])
+    return response, 200
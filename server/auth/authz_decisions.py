@@ -0,0 +1,136 @@
+import hashlib
+import itertools
+import json
+import logging
+from typing import Iterable, List, Optional
+
+from flask import current_app
+from redis.exceptions import RedisError
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from server.db.audit_mixin import ignore_attributes
+from server.db.domain import User, Service, Aup, ServiceAup, SshKey, SuspendNotification, SchacHomeOrganisation
+from server.db.redis import read_generations, bump_generations, store_unless_invalidated
+
+DECISION_KEY_PREFIX = "proxy_authz_decision_"
+DECISION_GENERATION_KEY_PREFIX = f"{DECISION_KEY_PREFIX}generation_"
+USER_DECISIONS_KEY_PREFIX = "proxy_authz_decisions_user_"
+SERVICE_DECISIONS_KEY_PREFIX = "proxy_authz_decisions_service_"
+DECISIONS_CHANGED = "authz_decisions_changed"
+
+# The entities of a user which are part of the proxy_authz decision
+_user_entities = (Aup, ServiceAup, SshKey, SuspendNotification)
+
+
+def _decision_key(uid: str, service_entity_id: str, issuer_id: str):
+    identity = json.dumps([uid, service_entity_id, issuer_id])
+    return f"{DECISION_KEY_PREFIX}{hashlib.sha256(identity.encode('utf-8')).hexdigest()}"
+
+
+def _generation_keys(user_ids: Iterable[int] = (), service_ids: Iterable[int] = ()) -> List[str]:
+    return [f"{DECISION_GENERATION_KEY_PREFIX}user_{user_id}" for user_id in user_ids] + \
+        [f"{DECISION_GENERATION_KEY_PREFIX}service_{service_id}" for service_id in service_ids]
+
+
+def authz_decision_generations(user: User, service: Service) -> List[bytes]:
+    """The generations of the decisions of the user and the service, read before the decision is computed"""
+    return read_generations(current_app.redis_client, _generation_keys([user.id], [service.id]),
+                            current_app.app_config.proxy_authz.decision_ttl_seconds)
+
+
+def cached_authz_decision(uid: str, service_entity_id: str, issuer_id: str) -> Optional[dict]:
+    cached = current_app.redis_client.get(_decision_key(uid, service_entity_id, issuer_id))
+    return json.loads(cached) if cached is not None else None
+
+
+def store_authz_decision(uid: str, service_entity_id: str, issuer_id: str, user: User, service: Service,
+                         generations: List[bytes], response: dict, collaboration_ids: Iterable[int] = ()):
+    """
+    Store the authorized or the - stable - unauthorized decision of proxy_authz for proxy_authz.decision_ttl_seconds.
+    The decision is removed after each commit that changed the user, the entitlements of the user or the service, and
+    it is not stored if the decisions of the user or the service were removed since the generations were read.
+    """
+    ttl = current_app.app_config.proxy_authz.decision_ttl_seconds
+    decision_key = _decision_key(uid, service_entity_id, issuer_id)
+    decision = {"user_id": user.id, "service_id": service.id, "collaboration_ids": list(collaboration_ids),
+                "response": response}
+    user_decisions_key = f"{USER_DECISIONS_KEY_PREFIX}{user.id}"
+    service_decisions_key = f"{SERVICE_DECISIONS_KEY_PREFIX}{service.id}"
+
+    def store(pipe):
+        pipe.set(decision_key, json.dumps(decision), ex=ttl)
+        for index_key in [user_decisions_key, service_decisions_key]:
+            pipe.sadd(index_key, decision_key)
+            pipe.expire(index_key, ttl)
+
+    store_unless_invalidated(current_app.redis_client, _generation_keys([user.id], [service.id]), generations, store)
+
+
+def remove_authz_decisions(user_ids: Iterable[int] = (), service_ids: Iterable[int] = ()):
+    index_keys = [f"{USER_DECISIONS_KEY_PREFIX}{user_id}" for user_id in user_ids] + \
+                 [f"{SERVICE_DECISIONS_KEY_PREFIX}{service_id}" for service_id in service_ids]
+    if not index_keys:
+        return
+    redis_client = current_app.redis_client
+    with redis_client.pipeline() as pipe:
+        for index_key in index_keys:
+            pipe.smembers(index_key)
+        decision_keys = set().union(*pipe.execute())
+    with redis_client.pipeline() as pipe:
+        pipe.delete(*decision_keys, *index_keys)
+        # The decisions that are being computed are not stored
+        bump_generations(pipe, _generation_keys(user_ids, service_ids),
+                         current_app.app_config.proxy_authz.decision_ttl_seconds)
+        pipe.execute()
+
+
+def _changed(state) -> bool:
+    return any(attr.history.has_changes() for attr in state.attrs if attr.key not in ignore_attributes)
+
+
+@event.listens_for(Session, "before_flush")
+def collect_changed_authz_decisions(session, _flush_context, _instances):
+    # The changed memberships, groups and collaborations are collected by the entitlements
+    user_ids, service_ids, crm_organisation_ids = set(), set(), set()
+    for instance in session.deleted:
+        if isinstance(instance, User):
+            user_ids.add(instance.id)
+        elif isinstance(instance, Service):
+            service_ids.add(instance.id)
+    for instance in session.dirty:
+        if isinstance(instance, (User, Service)) and _changed(inspect(instance)):
+            (user_ids if isinstance(instance, User) else service_ids).add(instance.id)
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, _user_entities):
+            user_ids.add(instance.user_id if instance.user_id is not None
+                         else getattr(getattr(instance, "user", None), "id", None))
+        elif isinstance(instance, SchacHomeOrganisation):
+            crm_organisation_ids.add(instance.organisation_id)
+    crm_organisation_ids.discard(None)
+    if crm_organisation_ids:
+        statement = select(Service.id).where(Service.crm_organisation_id.in_(crm_organisation_ids))
+        service_ids.update(session.connection().execute(statement).scalars())
+    user_ids.discard(None)
+    service_ids.discard(None)
+    if user_ids or service_ids:
+        changed = session.info.setdefault(DECISIONS_CHANGED, (set(), set()))
+        changed[0].update(user_ids)
+        changed[1].update(service_ids)
+
+
+@event.listens_for(Session, "after_commit")
+def remove_changed_authz_decisions(session):
+    changed = session.info.pop(DECISIONS_CHANGED, None)
+    if changed:
+        try:
+            remove_authz_decisions(*changed)
+        except RedisError as e:
+            # The changes are committed, the stored decisions are served until they expire
+            logger = logging.getLogger("main")
+            logger.error(f"Could not remove the proxy_authz decisions: {e}")
+
+
+@event.listens_for(Session, "after_rollback")
+def clear_changed_authz_decisions(session):
+    session.info.pop(DECISIONS_CHANGED, None)
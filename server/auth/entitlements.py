@@ -0,0 +1,182 @@
+import itertools
+import json
+import logging
+from typing import Iterable, Optional, Set
+
+from flask import current_app
+from redis.exceptions import RedisError
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from server.auth.authz_decisions import remove_authz_decisions
+from server.auth.service_access import collaboration_memberships_for_service
+from server.auth.user_claims import user_memberships, co_tags
+from server.db.domain import User, Service, Collaboration, CollaborationMembership, Group, Organisation, Tag, \
+    collaboration_tags_association
+from server.db.redis import read_generations, bump_generations, store_unless_invalidated
+from server.tools import dt_now
+
+ENTITLEMENTS_KEY_PREFIX = "entitlements_"
+ENTITLEMENTS_CHANGED = "entitlements_changed"
+
+# The attributes of which a change alters the entitlements of the users, e.g. not the last_activity_date of a
+# login. Deleting any of these entities alters them as well.
+_entitlement_attributes = {
+    User: ["suspended"],
+    CollaborationMembership: ["status", "expiry_date", "groups", "user_id", "collaboration_id"],
+    Collaboration: ["status", "expiry_date", "short_name", "organisation_id", "services", "tags"],
+    Group: ["short_name", "collaboration_memberships", "collaboration_id"],
+    Organisation: ["short_name"],
+    Service: ["collaborations"],
+    Tag: ["tag_value", "collaborations"],
+}
+
+
+def _redis_key(user_id: int):
+    return f"{ENTITLEMENTS_KEY_PREFIX}{user_id}"
+
+
+def _generation_key(user_id: int):
+    return f"{ENTITLEMENTS_KEY_PREFIX}generation_{user_id}"
+
+
+def compute_service_entitlements(service: Service, user: User) -> dict:
+    """
+    The membership part of the access of the user to the service: the ids of the connected collaborations, the
+    eduPersonEntitlement memberships and labels, and the epoch after which the active memberships may have expired
+    """
+    memberships = collaboration_memberships_for_service(service, user)
+    collaborations = [m.collaboration for m in memberships]
+    expiry_dates = [expiry_date for m in memberships for expiry_date in [m.expiry_date, m.collaboration.expiry_date]
+                    if expiry_date]
+    return {"collaboration_ids": sorted(c.id for c in collaborations),
+            "memberships": sorted(user_memberships(user, collaborations)),
+            "labels": sorted(co_tags(collaborations)),
+            "valid_until": min(expiry_dates).timestamp() if expiry_dates else None}
+
+
+def service_entitlements(service: Service, user: User) -> dict:
+    """
+    The precomputed entitlements of the user for the service, stored in one redis hash per user with a field per
+    service. The hash is removed after each commit that changed the entitlements of the user, and expires after
+    entitlements.ttl_seconds, which bounds the staleness after changes made outside of the ORM. The entitlements are
+    not stored if they were removed while they were computed.
+    """
+    redis_client = current_app.redis_client
+    redis_key = _redis_key(user.id)
+    ttl = current_app.app_config.entitlements.ttl_seconds
+    cached = redis_client.hget(redis_key, str(service.id))
+    if cached is not None:
+        entitlements = json.loads(cached)
+        valid_until = entitlements["valid_until"]
+        if valid_until is None or valid_until > dt_now().timestamp():
+            return entitlements
+    generation_keys = [_generation_key(user.id)]
+    generations = read_generations(redis_client, generation_keys, ttl)
+    entitlements = compute_service_entitlements(service, user)
+
+    def store(pipe):
+        pipe.hset(redis_key, str(service.id), json.dumps(entitlements))
+        pipe.expire(redis_key, ttl)
+
+    store_unless_invalidated(redis_client, generation_keys, generations, store)
+    return entitlements
+
+
+def remove_entitlements(user_ids: Iterable[int]):
+    """Remove the entitlements of the users, including those that are being computed"""
+    ttl = current_app.app_config.entitlements.ttl_seconds
+    with current_app.redis_client.pipeline() as pipe:
+        pipe.delete(*[_redis_key(user_id) for user_id in user_ids])
+        bump_generations(pipe, [_generation_key(user_id) for user_id in user_ids], ttl)
+        pipe.execute()
+
+
+def has_service_access(service: Service, user: User, entitlements: Optional[dict]) -> bool:
+    """Equivalent of has_user_access_to_service, which uses the precomputed memberships of the entitlements"""
+    if user is None or user.suspended or service is None:
+        return False
+    if service.non_member_users_access_allowed or (entitlements and entitlements["collaboration_ids"]):
+        return True
+    return service.access_allowed_by_crm_organisation(user)
+
+
+def _relationship_ids(state, key: str) -> Set[int]:
+    history = state.attrs[key].history
+    return {obj.id for obj in itertools.chain(history.added, history.deleted) if obj.id is not None}
+
+
+def _changed_instances(session):
+    for instance in session.deleted:
+        if type(instance) in _entitlement_attributes:
+            yield instance, inspect(instance)
+    for instance in session.dirty:
+        keys = _entitlement_attributes.get(type(instance), [])
+        state = inspect(instance)
+        if any(state.attrs[key].history.has_changes() for key in keys):
+            yield instance, state
+
+
+@event.listens_for(Session, "before_flush")
+def collect_changed_entitlements(session, _flush_context, _instances):
+    # Before the flush, as the memberships of deleted collaborations, groups and tags are still in the database
+    user_ids, collaboration_ids, organisation_ids, tag_ids = set(), set(), set(), set()
+    for instance, state in _changed_instances(session):
+        if isinstance(instance, User):
+            user_ids.add(instance.id)
+        elif isinstance(instance, CollaborationMembership):
+            user_ids.update(state.attrs.user_id.history.deleted)
+            user_ids.add(instance.user_id)
+        elif isinstance(instance, Collaboration):
+            collaboration_ids.add(instance.id)
+        elif isinstance(instance, Group):
+            collaboration_ids.update(state.attrs.collaboration_id.history.deleted)
+            collaboration_ids.add(instance.collaboration_id)
+        elif isinstance(instance, Organisation):
+            organisation_ids.add(instance.id)
+        elif isinstance(instance, Service):
+            collaboration_ids.update(_relationship_ids(state, "collaborations"))
+        elif isinstance(instance, Tag):
+            tag_ids.add(instance.id)
+            collaboration_ids.update(_relationship_ids(state, "collaborations"))
+    for instance in session.new:
+        # New users and collaborations have no stored entitlements, new memberships and groups with members do
+        if isinstance(instance, CollaborationMembership):
+            user_ids.add(instance.user_id if instance.user_id is not None else getattr(instance.user, "id", None))
+        elif isinstance(instance, Group):
+            collaboration_ids.add(instance.collaboration_id if instance.collaboration_id is not None
+                                  else getattr(instance.collaboration, "id", None))
+    if tag_ids:
+        statement = select(collaboration_tags_association.c.collaboration_id) \
+            .where(collaboration_tags_association.c.tag_id.in_(tag_ids))
+        collaboration_ids.update(session.connection().execute(statement).scalars())
+    if organisation_ids:
+        statement = select(Collaboration.id).where(Collaboration.organisation_id.in_(organisation_ids))
+        collaboration_ids.update(session.connection().execute(statement).scalars())
+    collaboration_ids.discard(None)
+    if collaboration_ids:
+        statement = select(CollaborationMembership.user_id) \
+            .where(CollaborationMembership.collaboration_id.in_(collaboration_ids))
+        user_ids.update(session.connection().execute(statement).scalars())
+    user_ids.discard(None)
+    if user_ids:
+        session.info.setdefault(ENTITLEMENTS_CHANGED, set()).update(user_ids)
+
+
+@event.listens_for(Session, "after_commit")
+def remove_changed_entitlements(session):
+    # Removed after the commit, so the entitlements are never recomputed from the data before the commit
+    user_ids = session.info.pop(ENTITLEMENTS_CHANGED, None)
+    if user_ids:
+        try:
+            remove_entitlements(user_ids)
+            remove_authz_decisions(user_ids=user_ids)
+        except RedisError as e:
+            # The changes are committed, the stored entitlements are served until they expire
+            logger = logging.getLogger("main")
+            logger.error(f"Could not remove the entitlements of users {sorted(user_ids)}: {e}")
+
+
+@event.listens_for(Session, "after_rollback")
+def clear_changed_entitlements(session):
+    session.info.pop(ENTITLEMENTS_CHANGED, None)
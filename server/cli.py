@@ -18,6 +18,8 @@ def register_commands(app):
                   help="Number of services to create")
     @click.option("-g", "--groups", default=5,
                   help="Number of groups to create")
+    @click.option("-k", "--ssh-keys", default=3,
+                  help="Maximum number of SSH keys per user")
     @click.option(
         "-p", "--probability",
         default=0.5,
@@ -33,7 +35,7 @@ def register_commands(app):
         )
     )
     @with_appcontext
-    def run_stress_seed(users, orgs, collab, services, groups, probability):
+    def run_stress_seed(users, orgs, collab, services, groups, ssh_keys, probability):
         """Run stress seed with specified parameters"""
         from server.test.stress_seed import stress_seed
 
@@ -43,6 +45,7 @@ def register_commands(app):
             "num_collaborations": collab,
             "num_services": services,
             "num_groups": groups,
+            "num_ssh_keys": ssh_keys,
             "probability": probability,
         }
 
@@ -57,6 +60,20 @@ def register_commands(app):
         except Exception as e:
             click.echo(f"Error during stress seed: {str(e)}")
 
+    @app.cli.command("plsc-benchmark")
+    @click.option("-r", "--repeat", default=3,
+                  help="Number of runs, the fastest one is reported")
+    @with_appcontext
+    def plsc_benchmark_command(repeat):
+        """Compare the joined and the split PLSC users queries and time the full PLSC sync"""
+        from server.test.plsc_benchmark import benchmark_users_sync, benchmark_sync
+
+        for name, result in benchmark_users_sync(app.db, repeat).items():
+            click.echo(f"{name}: {result['rows']} rows, {result['seconds']:.3f} seconds")
+        result = benchmark_sync(app.db, repeat)
+        click.echo(f"sync: {result['memberships']} memberships, {result['statements']} statements, "
+                   f"{result['seconds']:.3f} seconds")
+
     @app.cli.command("seed")
     @click.option("--skip", is_flag=True, help="Skip seeding of test data")
     @with_appcontext
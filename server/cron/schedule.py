@@ -13,6 +13,7 @@ from server.cron.membership_expiration import expire_memberships
 from server.cron.open_requests import open_requests
 from server.cron.orphan_users import delete_orphan_users
 from server.cron.outstanding_requests import outstanding_requests
+from server.cron.scim_outbox import scim_outbox
 from server.cron.scim_sweep_services import scim_sweep_services
 from server.cron.user_suspending import suspend_users
 
@@ -30,6 +31,10 @@ def start_scheduling(app):
         sweep_services_options = {**options, **{"hour": "*", "minute": cfg.scim_sweep.cron_minutes_expression}}
         scheduler.add_job(func=scim_sweep_services, **sweep_services_options)
 
+    if cfg.scim_outbox.enabled:
+        scim_outbox_options = {**options, **{"hour": "*", "minute": cfg.scim_outbox.cron_minutes_expression}}
+        scheduler.add_job(func=scim_outbox, **scim_outbox_options)
+
     if cfg.platform_admin_notifications.enabled:
         scheduler.add_job(func=outstanding_requests, hour=cfg.platform_admin_notifications.cron_hour_of_day, **options)
     if cfg.collaboration_expiration.enabled:
@@ -0,0 +1,26 @@
+import logging
+
+from server.cron.shared import obtain_lock
+from server.scim.events import submit_outbox_delivery
+from server.scim.outbox import due_outbox_endpoints
+
+scim_outbox_lock_name = "scim_outbox_lock_name"
+
+
+def _result_container():
+    return {"endpoints": []}
+
+
+def _do_scim_outbox(app):
+    with app.app_context():
+        logger = logging.getLogger("scheduler")
+        # The messages to be retried and the ones left behind by a restart of the worker that queued them
+        endpoints = due_outbox_endpoints()
+        for endpoint in endpoints:
+            logger.info(f"Delivering the pending SCIM outbox messages of {endpoint}")
+            submit_outbox_delivery(app, endpoint)
+        return {"endpoints": endpoints}
+
+
+def scim_outbox(app):
+    return obtain_lock(app, scim_outbox_lock_name, _do_scim_outbox, _result_container)
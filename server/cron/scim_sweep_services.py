@@ -5,14 +5,18 @@ import time
 from server.cron.shared import obtain_lock
 from server.db.db import db
 from server.db.domain import Service
-from server.scim.sweep import perform_sweep
+from server.scim.sweep import perform_endpoint_sweep, perform_incremental_sweep, group_services_by_remote_state, \
+    sweep_enabled_services
 from server.tools import dt_now
 
 scim_sweep_services_lock_name = "scim_sweep_services_lock_name"
 
+# The changes of the last seconds of the previous sweep may be stored with a timestamp truncated to whole seconds
+INCREMENTAL_SWEEP_OVERLAP = datetime.timedelta(minutes=1)
+
 
 def _result_container():
-    return {"services": []}
+    return {"services": [], "incremental_services": []}
 
 
 def _do_scim_sweep_services(app):
@@ -21,10 +25,7 @@ def _do_scim_sweep_services(app):
         logger = logging.getLogger("scheduler")
         logger.info("Start running scim_sweep_services job")
 
-        services = Service.query \
-            .filter(Service.scim_enabled == True) \
-            .filter(Service.sweep_scim_enabled == True) \
-            .all()  # noqa: E712
+        services = sweep_enabled_services()
 
         now = dt_now()
 
@@ -34,24 +35,53 @@ def _do_scim_sweep_services(app):
             cutoff_time = service.sweep_scim_last_run + datetime.timedelta(hours=24 / service.sweep_scim_daily_rate)
             return cutoff_time < now
 
-        services_sweeping = [service for service in services if service_needs_sweeping(service)]
+        # Services sharing one SCIM endpoint and bearer token are reconciled with one fetch of the remote state. The
+        # remote objects are owned by all these services, so they are swept together once one of them is due
+        endpoints_sweeping = [endpoint_services for endpoint_services in group_services_by_remote_state(services)
+                              if any(service_needs_sweeping(service) for service in endpoint_services)]
+        services_sweeping = [service for endpoint_services in endpoints_sweeping for service in endpoint_services]
+        # Between the full sweeps, only the changes since the last (incremental) sweep are reconciled
+        incremental = app.app_config.scim_sweep.get("incremental", False)
+        services_incremental = [service for service in services if service not in services_sweeping] \
+            if incremental else []
         aggregated_results = _result_container()
-        for service in services_sweeping:
-            logger.info(f"Running scim_sweep for service {service.abbreviation} ({service.entity_id})")
+        for endpoint_services in endpoints_sweeping:
+            abbreviations = ", ".join(f"{service.abbreviation} ({service.entity_id})" for service in endpoint_services)
+            logger.info(f"Running scim_sweep for services {abbreviations}")
             try:
-                sync_results = perform_sweep(service)
-                aggregated_results["services"].append({"name": service.name, "sync_results": sync_results})
-                service.sweep_scim_last_run = now
+                sync_results_by_service = perform_endpoint_sweep(endpoint_services)
+                for service in endpoint_services:
+                    aggregated_results["services"].append({"name": service.name,
+                                                           "sync_results": sync_results_by_service[service.id]})
+                    service.sweep_scim_last_run = now
+                    db.session.merge(service)
+                db.session.commit()
+            except BaseException as e:
+                logger.error(f"scim_sweep for services {abbreviations}, exception: {str(e)}")
+                for service in endpoint_services:
+                    aggregated_results["services"].append({"name": service.name, "sync_results": str(e)})
+                # Ensure the sweep for the remaining services continues
+                pass
+
+        for service in services_incremental:
+            since = max(service.sweep_scim_last_run, service.sweep_scim_last_incremental_run or service.sweep_scim_last_run)
+            try:
+                sync_results = perform_incremental_sweep(service, since - INCREMENTAL_SWEEP_OVERLAP)
+                aggregated_results["incremental_services"].append({"name": service.name, "sync_results": sync_results})
+                if sync_results["failed"]:
+                    # The changes since the previous run are reconciled again by the next incremental sweep
+                    logger.warning(f"Incremental scim_sweep for service {service.abbreviation} ({service.entity_id})"
+                                   f", {sync_results['failed']} failed operations")
+                    continue
+                service.sweep_scim_last_incremental_run = now
                 db.session.merge(service)
                 db.session.commit()
             except BaseException as e:
                 logger.error(
-                    f"scim_sweep for service {service.abbreviation} ({service.entity_id})"
+                    f"Incremental scim_sweep for service {service.abbreviation} ({service.entity_id})"
                     f", exception: {str(e)}"
                 )
-                aggregated_results["services"].append({"name": service.name, "sync_results": str(e)})
-                # Ensure the sweep for the remaining services continues
-                pass
+                aggregated_results["incremental_services"].append({"name": service.name, "sync_results": str(e)})
 
         end = int(time.time() * 1000.0)
         logger.info(f"Finished running scim_sweep_services job in {end - start} ms")
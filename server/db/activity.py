@@ -1,3 +1,5 @@
+from sqlalchemy import update
+
 from server.db.db import db
 from server.db.domain import Collaboration
 from server.tools import dt_now
@@ -7,3 +9,10 @@ def update_last_activity_date(collaboration_id):
     collaboration = db.session.get(Collaboration, collaboration_id)
     collaboration.last_activity_date = dt_now()
     db.session.merge(collaboration)
+
+
+def update_last_activity_dates(collaboration_ids):
+    if collaboration_ids:
+        db.session.execute(update(Collaboration)
+                           .where(Collaboration.id.in_(collaboration_ids))
+                           .values(last_activity_date=dt_now()))
@@ -1,16 +1,22 @@
+import itertools
+import logging
 import os
 
 from flask import current_app, session, g as request_context
+from redis.exceptions import RedisError
 from sqlalchemy import MetaData
 from sqlalchemy import event, inspect
 from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import Session
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.attributes import get_history
 
+from server.db.data_version import bump_data_version
 from server.db.datetime import TZDateTime
 from server.db.db import db
 from server.db.json_serialize_base import JsonSerializableBase
+from server.tools import sram_inactive_days
 
 ACTION_CREATE = 1
 ACTION_UPDATE = 2
@@ -26,11 +32,15 @@ ignore_attributes = [
     "logo",
     "pam_last_login_date",
     "sweep_scim_last_run",
+    "sweep_scim_last_incremental_run",
     "updated_at",
     "updated_by",
     "uuid4"
 ]
 
+# The tables excluded from the audit log which are part of the data versioned by the data_version
+data_version_tables = ["tags", "units"]
+
 relationship_configuration = {
     "groups": ["collaboration_memberships", "invitations"],
     "collaborations": ["services", "tags"],
@@ -221,3 +231,50 @@ class AuditMixin(JsonSerializableBase):
 
 metadata = MetaData()
 Base = declarative_base(cls=AuditMixin, metadata=metadata)
+
+
+DATA_CHANGED = "data_changed"
+
+
+def _versioned(instance) -> bool:
+    # Bookkeeping - e.g. logins, sessions and outbox messages - is excluded from the audit log and the data version
+    return isinstance(instance, AuditMixin) and (not hasattr(instance, "audit_log_exclude")
+                                                 or instance.__tablename__ in data_version_tables)
+
+
+def _data_changed(instance) -> bool:
+    # Updates of only ignored attributes - e.g. the last_accessed_date - do not change the data
+    state = inspect(instance)
+    if any(attr.history.has_changes() for attr in state.attrs if attr.key not in ignore_attributes):
+        return True
+    # Except for the last_login_date of a user, as far as it changes the sram_inactive_days of the PLSC sync
+    if instance.__tablename__ == "users":
+        history = state.attrs.last_login_date.history
+        if history.has_changes():
+            before, after = (history.deleted or [None])[0], (history.added or [None])[0]
+            return sram_inactive_days(before) != sram_inactive_days(after)
+    return False
+
+
+@event.listens_for(Session, "after_flush")
+def mark_data_changed(session, _flush_context):
+    changed = itertools.chain(session.new, session.deleted, filter(_data_changed, session.dirty))
+    if any(_versioned(instance) for instance in changed):
+        session.info[DATA_CHANGED] = True
+
+
+@event.listens_for(Session, "after_commit")
+def bump_data_version_after_commit(session):
+    # Bumped after the commit, so readers of the new version always see the committed changes
+    if session.info.pop(DATA_CHANGED, False):
+        try:
+            bump_data_version()
+        except RedisError as e:
+            # The changes are committed, the cached data is served until it expires
+            logger = logging.getLogger("main")
+            logger.error(f"Could not bump the data version: {e}")
+
+
+@event.listens_for(Session, "after_rollback")
+def clear_data_changed(session):
+    session.info.pop(DATA_CHANGED, None)
@@ -0,0 +1,25 @@
+import time
+
+from flask import current_app
+
+DATA_VERSION_KEY = "data_version"
+
+
+def _init_data_version(pipe):
+    # A missing counter - e.g. flushed or evicted - must never restart at a version used before
+    pipe.set(DATA_VERSION_KEY, time.time_ns(), nx=True)
+
+
+def data_version():
+    """Return the global data version, which is bumped after each commit of changed (audited) entities"""
+    with current_app.redis_client.pipeline() as pipe:
+        _init_data_version(pipe)
+        pipe.get(DATA_VERSION_KEY)
+        return int(pipe.execute()[-1])
+
+
+def bump_data_version():
+    with current_app.redis_client.pipeline() as pipe:
+        _init_data_version(pipe)
+        pipe.incr(DATA_VERSION_KEY)
+        pipe.execute()
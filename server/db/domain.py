@@ -615,6 +615,8 @@ class Service(Base, db.Model, LogoMixin, SecretMixin):
     sweep_remove_orphans = db.Column("sweep_remove_orphans", db.Boolean(), nullable=True, default=False)
     sweep_scim_daily_rate = db.Column("sweep_scim_daily_rate", db.Integer(), nullable=True, default=0)
     sweep_scim_last_run = db.Column("sweep_scim_last_run", TZDateTime(), nullable=True)
+    sweep_scim_last_incremental_run = db.Column("sweep_scim_last_incremental_run", TZDateTime(), nullable=True)
+    sweep_scim_concurrency = db.Column("sweep_scim_concurrency", db.Integer(), nullable=True)
     redirect_urls = db.Column("redirect_urls", db.Text(), nullable=True)
     acs_locations = db.Column("acs_locations", db.Text(), nullable=True)
     oidc_client_secret = db.Column("oidc_client_secret", db.String(length=255), nullable=True)
@@ -1057,3 +1059,20 @@ class RateLimitInfo(Base, db.Model):
     user = db.relationship("User")
     last_accessed_date = db.Column("last_accessed_date", TZDateTime(), nullable=False)
     count = db.Column("count", db.Integer(), nullable=False)
+
+
+class ScimOutboxMessage(Base, db.Model):
+    __tablename__ = "scim_outbox_messages"
+    metadata = metadata
+    id = db.Column("id", db.Integer(), primary_key=True, nullable=False, autoincrement=True)
+    endpoint = db.Column("endpoint", db.String(length=255), nullable=False)
+    task = db.Column("task", db.String(length=255), nullable=False)
+    arguments = db.Column("arguments", db.Text(), nullable=False)
+    status = db.Column("status", db.String(length=255), nullable=False)
+    attempts = db.Column("attempts", db.Integer(), nullable=False, default=0)
+    next_attempt_at = db.Column("next_attempt_at", TZDateTime(), nullable=False)
+    last_attempt_at = db.Column("last_attempt_at", TZDateTime(), nullable=True)
+    created_at = db.Column("created_at", TZDateTime(), server_default=db.text("CURRENT_TIMESTAMP"),
+                           nullable=False)
+
+    audit_log_exclude = True
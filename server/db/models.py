@@ -22,7 +22,7 @@ deserialization_mapping = {"users": User, "collaboration_memberships": Collabora
 forbidden_fields = ["created_at", "updated_at"]
 date_fields = ["start_date", "end_date", "created_at", "updated_at", "last_accessed_date", "last_login_date",
                "last_activity_date", "membership_expiry_date", "expiry_date", "invitation_expiry_date",
-               "sweep_scim_last_run", "exported_at"]
+               "sweep_scim_last_run", "sweep_scim_last_incremental_run", "exported_at"]
 
 
 def flatten(coll):
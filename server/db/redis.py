@@ -1,5 +1,50 @@
+import time
+from typing import Callable, List, Sequence
+
 import redis
+from redis.exceptions import WatchError
 
 
 def init_redis(app_conf):
     return redis.from_url(app_conf.redis.uri)
+
+
+def _init_generations(pipe, keys: Sequence[str], ttl: int):
+    # A missing - e.g. expired - counter must never restart at a generation used before, see data_version
+    for key in keys:
+        pipe.set(key, time.time_ns(), nx=True)
+        pipe.expire(key, ttl)
+
+
+def read_generations(redis_client, keys: Sequence[str], ttl: int) -> List[bytes]:
+    """The generations of the cached data, read before the data is computed, see store_unless_invalidated"""
+    with redis_client.pipeline() as pipe:
+        _init_generations(pipe, keys, ttl)
+        pipe.mget(keys)
+        return pipe.execute()[-1]
+
+
+def bump_generations(pipe, keys: Sequence[str], ttl: int):
+    """Add the increments of the generations to the pipeline that removes the cached data"""
+    _init_generations(pipe, keys, ttl)
+    for key in keys:
+        pipe.incr(key)
+
+
+def store_unless_invalidated(redis_client, keys: Sequence[str], generations: List[bytes],
+                             store: Callable) -> bool:
+    """
+    Add the computed data with the store function to a transaction, which is discarded if any of the generations
+    changed since they were read, as the data may then be computed from the data before the invalidation
+    """
+    with redis_client.pipeline() as pipe:
+        try:
+            pipe.watch(*keys)
+            if pipe.mget(keys) != generations:
+                return False
+            pipe.multi()
+            store(pipe)
+            pipe.execute()
+            return True
+        except WatchError:
+            return False
@@ -0,0 +1,24 @@
+"""Maximum number of concurrent requests in the SCIM sweep per service
+
+Revision ID: 3c1e0a9d7b42
+Revises: fdeb5f8ff280
+Create Date: 2026-10-18 10:12:41.120384
+
+"""
+from alembic import op
+from sqlalchemy import text
+
+# revision identifiers, used by Alembic.
+revision = '3c1e0a9d7b42'
+down_revision = 'fdeb5f8ff280'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE services ADD COLUMN sweep_scim_concurrency INT NULL"))
+
+
+def downgrade():
+    pass
@@ -0,0 +1,38 @@
+"""Durable outbox of the SCIM changes per endpoint
+
+Revision ID: 8e4b1f6c2a90
+Revises: 3c1e0a9d7b42
+Create Date: 2026-10-18 14:03:27.512093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import text
+
+# revision identifiers, used by Alembic.
+revision = '8e4b1f6c2a90'
+down_revision = '3c1e0a9d7b42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table("scim_outbox_messages",
+                    sa.Column("id", sa.Integer(), primary_key=True, nullable=False, autoincrement=True),
+                    sa.Column("endpoint", sa.String(length=255), nullable=False),
+                    sa.Column("task", sa.String(length=255), nullable=False),
+                    sa.Column("arguments", sa.Text(), nullable=False),
+                    sa.Column("status", sa.String(length=255), nullable=False),
+                    sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+                    sa.Column("next_attempt_at", sa.DateTime(timezone=True), nullable=False),
+                    sa.Column("last_attempt_at", sa.DateTime(timezone=True), nullable=True),
+                    sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.text("CURRENT_TIMESTAMP"),
+                              nullable=False),
+                    )
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE scim_outbox_messages "
+                      "ADD INDEX scim_outbox_messages_endpoint_status(endpoint, status)"))
+
+
+def downgrade():
+    pass
@@ -0,0 +1,24 @@
+"""Last run of the incremental SCIM sweep per service
+
+Revision ID: b71d3e5a9c04
+Revises: 8e4b1f6c2a90
+Create Date: 2026-10-18 15:02:17.409121
+
+"""
+from alembic import op
+from sqlalchemy import text
+
+# revision identifiers, used by Alembic.
+revision = 'b71d3e5a9c04'
+down_revision = '8e4b1f6c2a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE services ADD COLUMN sweep_scim_last_incremental_run DATETIME"))
+
+
+def downgrade():
+    pass
@@ -0,0 +1,28 @@
+"""Indexes for the SCIM filter attributes
+
+Revision ID: c4f2a8d61e37
+Revises: b71d3e5a9c04
+Create Date: 2026-10-18 17:21:45.803214
+
+"""
+from alembic import op
+from sqlalchemy import text
+
+# revision identifiers, used by Alembic.
+revision = 'c4f2a8d61e37'
+down_revision = 'b71d3e5a9c04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE `users` ADD INDEX users_email(email)"))
+    conn.execute(text("ALTER TABLE `users` ADD INDEX users_name(name)"))
+    conn.execute(text("ALTER TABLE `users` ADD INDEX users_updated_at(updated_at)"))
+    conn.execute(text("ALTER TABLE `collaborations` ADD INDEX collaborations_updated_at(updated_at)"))
+    conn.execute(text("ALTER TABLE `groups` ADD INDEX groups_updated_at(updated_at)"))
+
+
+def downgrade():
+    pass
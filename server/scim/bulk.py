@@ -0,0 +1,176 @@
+import json
+import logging
+from typing import Callable, Dict, List, Optional
+
+from server.db.domain import Service
+from server.scim.schema_template import SCIM_API_MESSAGES
+from server.scim.scim import scim_headers, validate_response, scim_service_provider_config, SCIM_BULK_MAX_OPERATIONS
+from server.scim.session import scim_session
+
+SCIM_BULK_REQUEST = f"{SCIM_API_MESSAGES}:BulkRequest"
+BULK_ID_REFERENCE = "bulkId:"
+
+# A bulk request is processed in one go by the remote SCIM server, hence the longer read timeout
+BULK_TIMEOUT = (3.05, 120)
+
+
+def bulk_supported(service: Service) -> bool:
+    return scim_service_provider_config(service)["bulk"]["supported"]
+
+
+def bulk_id_reference(bulk_id: str) -> str:
+    return f"{BULK_ID_REFERENCE}{bulk_id}"
+
+
+class BulkOperationResponse:
+    """The result of one operation of a bulk request, which quacks like the requests.Response of a single request"""
+
+    def __init__(self, status_code: int, body: dict):
+        self.status_code = status_code
+        self._body = body
+        self.headers = {"Content-Type": "application/scim+json"} if body else {}
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self._body
+
+
+class BulkExecutor:
+    """
+    Send the submitted requests as operations of /Bulk requests - see https://www.rfc-editor.org/rfc/rfc7644#section-3.7
+    - respecting the maxOperations and maxPayloadSize of the remote SCIM server. An operation can reference a
+    resource created by an earlier operation with bulk_id_reference, also when the earlier operation ended up in a
+    previous bulk request. The operation responses are validated and handled in the calling thread - in the order
+    the requests were submitted - when the executor is joined, like the SweepExecutor.
+    """
+
+    supports_bulk_ids = True
+
+    def __init__(self, service: Service, outside_user_context: bool = True):
+        bulk_config = scim_service_provider_config(service)["bulk"]
+        self.service = service
+        self.max_operations = min(bulk_config["maxOperations"], SCIM_BULK_MAX_OPERATIONS)
+        self.max_payload_size = bulk_config["maxPayloadSize"]
+        self.outside_user_context = outside_user_context
+        self.session = scim_session(service.scim_url)
+        self.headers = scim_headers(service)
+        self._pending = []
+        self._resolved_bulk_ids: Dict[str, str] = {}
+        self._operation_count = 0
+        # Number of operations that failed, see SweepExecutor
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._pending = []
+
+    def submit(self, method: str, url: str, on_success: Callable, extra_logging: str, json: dict = None,
+               bulk_id: str = None):
+        path = url[len(self.service.scim_url):] if url.startswith(self.service.scim_url) else url
+        operation = {"method": method, "path": path}
+        if method == "POST":
+            # The bulkId is required for a POST operation
+            self._operation_count += 1
+            operation["bulkId"] = bulk_id or f"operation-{self._operation_count}"
+        if json is not None:
+            operation["data"] = json
+        self._pending.append((operation, on_success, extra_logging))
+
+    def join(self):
+        pending, self._pending = self._pending, []
+        while pending:
+            # References to earlier bulk requests are replaced by the id's of the created resources
+            batch = self._next_batch([(self._resolve(operation), on_success, extra_logging)
+                                      for operation, on_success, extra_logging in pending[:self.max_operations]])
+            pending = pending[len(batch):]
+            self._send(batch)
+
+    def _next_batch(self, operations: List[tuple]) -> List[tuple]:
+        payload_size = len(json.dumps({"schemas": [SCIM_BULK_REQUEST], "Operations": []}))
+        batch = []
+        for operation in operations:
+            payload_size += len(json.dumps(operation[0]).encode("utf-8")) + 1
+            # An operation exceeding the maxPayloadSize on its own is still sent, and rejected by the remote server
+            if batch and payload_size > self.max_payload_size:
+                break
+            batch.append(operation)
+        return batch
+
+    def _resolve(self, value):
+        if isinstance(value, dict):
+            return {k: self._resolve(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._resolve(v) for v in value]
+        if isinstance(value, str) and value.startswith(BULK_ID_REFERENCE):
+            return self._resolved_bulk_ids.get(value[len(BULK_ID_REFERENCE):], value)
+        return value
+
+    def _send(self, batch: List[tuple]):
+        body = {"schemas": [SCIM_BULK_REQUEST], "Operations": [operation for operation, _, _ in batch]}
+        response = self.session.post(f"{self.service.scim_url}/Bulk", json=body, headers=self.headers,
+                                     timeout=BULK_TIMEOUT)
+        if not validate_response(response, self.service, outside_user_context=self.outside_user_context,
+                                 extra_logging=f"bulk request with {len(batch)} operations"):
+            self.failed += len(batch)
+            return
+        results = response.json().get("Operations", [])
+        results_by_bulk_id = {result["bulkId"]: result for result in results if result.get("bulkId")}
+        other_results = [result for result in results if not result.get("bulkId")]
+        for operation, on_success, extra_logging in batch:
+            if "bulkId" in operation:
+                result = results_by_bulk_id.get(operation["bulkId"])
+            else:
+                result = self._take_result(other_results, operation)
+            if result is None:
+                logger = logging.getLogger("scim")
+                logger.error(f"Scim endpoint {self.service.scim_url} returned no result for bulk operation "
+                             f"{operation['method']} {operation['path']} ({extra_logging})")
+                self.failed += 1
+                continue
+            operation_response = self._operation_response(result)
+            if operation.get("bulkId") and operation_response and operation_response.json().get("id"):
+                self._resolved_bulk_ids[operation["bulkId"]] = operation_response.json()["id"]
+            if validate_response(operation_response, self.service, outside_user_context=self.outside_user_context,
+                                 extra_logging=extra_logging):
+                on_success(operation_response)
+            else:
+                self.failed += 1
+
+    @staticmethod
+    def _take_result(results: List[dict], operation: dict) -> Optional[dict]:
+        """
+        The result of an operation without a bulkId is the one with the same method and the location of the path, as
+        the remote server may return the results in any order. Lenient servers omit the location of e.g. a DELETE.
+        """
+        path = operation["path"].rstrip("/")
+        candidates = [result for result in results if str(result.get("method", "")).upper() == operation["method"]]
+        result = next((r for r in candidates if str(r.get("location", "")).rstrip("/").endswith(path)),
+                      next((r for r in candidates if not r.get("location")), None))
+        if result is not None:
+            results.remove(result)
+        return result
+
+    def _operation_response(self, result: dict) -> BulkOperationResponse:
+        status = result.get("status")
+        try:
+            # Early drafts of the specification used a complex status
+            status_code = int(status.get("code") if isinstance(status, dict) else status)
+        except (TypeError, ValueError):
+            # A missing or invalid status is an invalid response of the remote SCIM server
+            status_code = 502
+        body = result.get("response")
+        if not body and result.get("location"):
+            # Only the location of the resource is returned on success
+            location = self._relative_location(result["location"])
+            body = {"id": location.rstrip("/").rsplit("/", 1)[-1], "meta": {"location": location}}
+        return BulkOperationResponse(status_code, body or {})
+
+    def _relative_location(self, location: str) -> str:
+        if location.startswith(self.service.scim_url):
+            return location[len(self.service.scim_url):]
+        # The location is relative to the base URL of the remote SCIM server, e.g. /Users/{id}
+        return "/" + "/".join(location.rstrip("/").split("/")[-2:])
@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+import requests
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+DEFAULT_WINDOW_SIZE = 20
+DEFAULT_MINIMUM_CALLS = 5
+DEFAULT_FAILURE_RATE_THRESHOLD = 50
+DEFAULT_OPEN_SECONDS = 30
+
+_breakers: Dict[str, "CircuitBreaker"] = {}
+_breakers_lock = threading.Lock()
+_settings: dict = {"enabled": False}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    The request is not sent, because the circuit of the SCIM endpoint is open. Being a ConnectionError, it is
+    handled like an unreachable remote SCIM server: the change stays in the outbox and the sweep is aborted.
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one SCIM endpoint. The circuit opens when at least failure_rate_threshold percent of the last
+    window_size requests - and at least minimum_calls - failed. An open circuit fails fast for open_seconds, after
+    which one probe request at the time is let through (half open). A successful probe closes the circuit, a failed
+    probe opens it again.
+    """
+
+    def __init__(self, endpoint: str, window_size: int = DEFAULT_WINDOW_SIZE,
+                 minimum_calls: int = DEFAULT_MINIMUM_CALLS,
+                 failure_rate_threshold: int = DEFAULT_FAILURE_RATE_THRESHOLD,
+                 open_seconds: float = DEFAULT_OPEN_SECONDS, clock: Callable[[], float] = time.monotonic):
+        self.endpoint = endpoint
+        self.window_size = window_size
+        self.minimum_calls = minimum_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.open_seconds = open_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._outcomes: Deque[bool] = deque(maxlen=window_size)
+        self._state = CIRCUIT_CLOSED
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._opened_count = 0
+        self._rejected_count = 0
+
+    def _current_state(self) -> str:
+        if self._state == CIRCUIT_OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            return CIRCUIT_HALF_OPEN
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def allow_request(self) -> bool:
+        """May a request be sent, which must be followed by a record of its outcome"""
+        with self._lock:
+            state = self._current_state()
+            if state == CIRCUIT_CLOSED:
+                return True
+            if state == CIRCUIT_HALF_OPEN and not self._probing:
+                self._state = CIRCUIT_HALF_OPEN
+                self._probing = True
+                return True
+            self._rejected_count += 1
+            return False
+
+    def record(self, success: bool):
+        with self._lock:
+            if self._state == CIRCUIT_HALF_OPEN:
+                self._probing = False
+                if success:
+                    self._state = CIRCUIT_CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+            self._outcomes.append(success)
+            if self._state == CIRCUIT_CLOSED and self._failure_rate_exceeded():
+                self._open()
+                logger = logging.getLogger("scim")
+                logger.error(f"Circuit of SCIM endpoint {self.endpoint} opened for {self.open_seconds} seconds "
+                             f"after {self._failures()} failures of the last {len(self._outcomes)} requests")
+
+    def _failures(self) -> int:
+        return sum(1 for success in self._outcomes if not success)
+
+    def _failure_rate_exceeded(self) -> bool:
+        calls = len(self._outcomes)
+        return calls >= self.minimum_calls and self._failures() * 100 >= self.failure_rate_threshold * calls
+
+    def _open(self):
+        self._state = CIRCUIT_OPEN
+        self._opened_at = self._clock()
+        self._opened_count += 1
+
+    def is_open(self) -> bool:
+        """Does the circuit fail fast, without claiming the probe of a half open circuit"""
+        with self._lock:
+            return self._current_state() == CIRCUIT_OPEN or (self._state == CIRCUIT_HALF_OPEN and self._probing)
+
+    def statistics(self) -> dict:
+        with self._lock:
+            state = self._current_state()
+            calls = len(self._outcomes)
+            retry_in = self.open_seconds - (self._clock() - self._opened_at) if state == CIRCUIT_OPEN else None
+            return {"endpoint": self.endpoint,
+                    "state": state,
+                    "calls": calls,
+                    "failures": self._failures(),
+                    "failure_rate": round(self._failures() * 100 / calls) if calls else 0,
+                    "retry_in_seconds": max(0, round(retry_in)) if retry_in is not None else None,
+                    "opened_count": self._opened_count,
+                    "rejected_count": self._rejected_count}
+
+
+def configure_circuit_breakers(config: dict):
+    """Apply the scim_circuit_breaker configuration, which resets the state of all circuits"""
+    global _settings
+    with _breakers_lock:
+        _settings = dict(config or {"enabled": False})
+        _breakers.clear()
+
+
+def reset_circuit_breakers():
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def circuit_breaker(endpoint: str) -> Optional[CircuitBreaker]:
+    """The circuit breaker of the normalized SCIM endpoint - the key of the session and outbox - or None if disabled"""
+    with _breakers_lock:
+        if not _settings.get("enabled"):
+            return None
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(endpoint,
+                                     window_size=_settings.get("window_size", DEFAULT_WINDOW_SIZE),
+                                     minimum_calls=_settings.get("minimum_calls", DEFAULT_MINIMUM_CALLS),
+                                     failure_rate_threshold=_settings.get("failure_rate_threshold",
+                                                                          DEFAULT_FAILURE_RATE_THRESHOLD),
+                                     open_seconds=_settings.get("open_seconds", DEFAULT_OPEN_SECONDS))
+            _breakers[endpoint] = breaker
+        return breaker
+
+
+def circuit_open(endpoint: str) -> bool:
+    breaker = circuit_breaker(endpoint)
+    return breaker is not None and breaker.is_open()
+
+
+def circuit_breaker_statistics() -> List[dict]:
+    """The state of the circuits of the SCIM endpoints contacted by this process"""
+    with _breakers_lock:
+        breakers = sorted(_breakers.values(), key=lambda b: b.endpoint)
+    return [breaker.statistics() for breaker in breakers]
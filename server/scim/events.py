@@ -2,15 +2,16 @@ import os
 from concurrent.futures import Future
 from functools import wraps
 from typing import Callable, Dict, List, Sequence
-from urllib.parse import urlparse
 
 from flask import current_app
 
 from server.db.db import db
 from server.db.domain import User, Collaboration, Group, Organisation, Service
 from server.scim.futures import ScimBroadcastFuture
+from server.scim.outbox import enqueue_outbox_message, deliver_outbox
 from server.scim.scim import apply_user_change, apply_group_change, apply_organisation_change, \
     apply_collaboration_change, apply_service_changed, apply_user_deletion
+from server.scim.session import normalize_endpoint_url
 
 
 def broadcast_endpoint(f):
@@ -23,16 +24,6 @@ def broadcast_endpoint(f):
     return wrapper
 
 
-def _normalize_endpoint_url(scim_url: str) -> str:
-    if not scim_url:
-        return ""
-    parsed = urlparse(scim_url)
-    base = f"{parsed.scheme}://{parsed.netloc}{parsed.path.rstrip('/')}"
-    if parsed.query:
-        base += f"?{parsed.query}"
-    return base
-
-
 def _unique_services(services: Sequence[Service]) -> List[Service]:
     unique: Dict[int, Service] = {}
     for service in services:
@@ -44,24 +35,40 @@ def _unique_services(services: Sequence[Service]) -> List[Service]:
 def _group_services_by_endpoint(services: Sequence[Service]) -> Dict[str, List[int]]:
     grouped: Dict[str, List[int]] = {}
     for service in _unique_services(services):
-        endpoint = _normalize_endpoint_url(service.scim_url)
+        endpoint = normalize_endpoint_url(service.scim_url)
         grouped.setdefault(endpoint, []).append(service.id)
     return grouped
 
 
+# The tasks that can be stored in the outbox, resolved when delivered
+_OUTBOX_TASK_NAMES = ["apply_user_change", "apply_user_deletion", "apply_organisation_change",
+                      "apply_collaboration_change", "apply_group_change", "apply_service_changed"]
+
+
+def _outbox_tasks() -> Dict[str, Callable]:
+    return {name: globals()[name] for name in _OUTBOX_TASK_NAMES}
+
+
+def submit_outbox_delivery(app, endpoint_url: str) -> Future:
+    tasks = _outbox_tasks()
+    if os.environ.get("SCIM_FIFO_SYNC"):
+        future: Future = Future()
+        try:
+            future.set_result(deliver_outbox(app, endpoint_url, tasks))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+    return app.scim_fifo_pool.submit(endpoint_url, deliver_outbox, app, endpoint_url, tasks)
+
+
 def _submit_by_endpoint(services: Sequence[Service], fn: Callable, *args) -> ScimBroadcastFuture:
     app = current_app._get_current_object()
+    task = next(name for name, task in _outbox_tasks().items() if task is fn)
     futures = []
     for endpoint_url, service_ids in _group_services_by_endpoint(services).items():
-        if os.environ.get("SCIM_FIFO_SYNC"):
-            future: Future = Future()
-            try:
-                future.set_result(fn(app, *args, service_ids))
-            except Exception as exc:
-                future.set_exception(exc)
-            futures.append(future)
-        else:
-            futures.append(app.scim_fifo_pool.submit(endpoint_url, fn, app, *args, service_ids))
+        # The change is stored before it is delivered, so it survives restarts and failures of the remote SCIM
+        enqueue_outbox_message(endpoint_url, task, args, service_ids)
+        futures.append(submit_outbox_delivery(app, endpoint_url))
     return ScimBroadcastFuture(futures)
 
 
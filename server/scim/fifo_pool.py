@@ -5,9 +5,32 @@ import threading
 import time
 from collections import deque
 from concurrent.futures import Future, ThreadPoolExecutor
-from typing import Any, Callable, Deque, Dict, Hashable, Tuple
+from typing import Any, Callable, Deque, Dict, Hashable, List
 
-Task = Tuple[Callable[..., Any], tuple, dict]
+from server.scim.metrics import Histogram, prometheus_text
+
+
+class _Task:
+    __slots__ = ("fn", "args", "kwargs", "future", "submitted_at")
+
+    def __init__(self, fn: Callable[..., Any], args: tuple, kwargs: dict, future: Future):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.submitted_at = time.monotonic()
+
+
+class _KeyMetrics:
+    __slots__ = ("submitted", "completed", "failed", "wait", "run")
+
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        # From the submit until the start of the execution
+        self.wait = Histogram()
+        self.run = Histogram()
 
 
 class FifoPool:
@@ -17,14 +40,17 @@ class FifoPool:
         self._executor = ThreadPoolExecutor(max_workers=max_workers)
         self._logger = logger or logging.getLogger("scim_fifo_pool")
         self._lock = threading.Lock()
-        self._queues: Dict[Hashable, Deque[Task]] = {}
+        self._queues: Dict[Hashable, Deque[_Task]] = {}
         self._active_keys: set[Hashable] = set()
+        self._metrics: Dict[Hashable, _KeyMetrics] = {}
 
     def submit(self, key: Hashable, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
         future: Future = Future()
+        task = _Task(fn, args, kwargs, future)
         with self._lock:
             queue = self._queues.setdefault(key, deque())
-            queue.append((fn, args, kwargs, future))
+            self._key_metrics(key).submitted += 1
+            queue.append(task)
             if key in self._active_keys:
                 return future
             self._active_keys.add(key)
@@ -40,20 +66,62 @@ class FifoPool:
                         self._queues.pop(key, None)
                         self._active_keys.discard(key)
                         return
-                    fn, args, kwargs, future = queue.popleft()
+                    task = queue.popleft()
+                    metrics = self._key_metrics(key)
+                    started_at = time.monotonic()
+                    metrics.wait.observe(started_at - task.submitted_at)
 
                 try:
-                    result = fn(*args, **kwargs)
+                    result = task.fn(*task.args, **task.kwargs)
                 except Exception as exc:
+                    self._record_run(metrics, started_at, failed=True)
                     self._logger.exception("Error while processing FIFO task for %s", key)
-                    future.set_exception(exc)
+                    task.future.set_exception(exc)
                 else:
-                    future.set_result(result)
+                    self._record_run(metrics, started_at, failed=False)
+                    task.future.set_result(result)
         finally:
             with self._lock:
                 if key not in self._queues:
                     self._active_keys.discard(key)
 
+    def _key_metrics(self, key: Hashable) -> _KeyMetrics:
+        metrics = self._metrics.get(key)
+        if metrics is None:
+            metrics = self._metrics[key] = _KeyMetrics()
+        return metrics
+
+    def _record_run(self, metrics: _KeyMetrics, started_at: float, failed: bool) -> None:
+        with self._lock:
+            metrics.run.observe(time.monotonic() - started_at)
+            if failed:
+                metrics.failed += 1
+            else:
+                metrics.completed += 1
+
+    def metrics(self) -> List[dict]:
+        """
+        The counters and latency histograms per key of all keys ever submitted, with the number of queued tasks and
+        the age of the oldest queued one to alert on a backlog. For SCIM a task is a drain of the outbox of an
+        endpoint, which sends any number of requests: see scim_request_metrics for the requests themselves.
+        """
+        now = time.monotonic()
+        result = []
+        with self._lock:
+            for key, metrics in self._metrics.items():
+                queued = self._queues.get(key, ())
+                oldest = min((task.submitted_at for task in queued), default=None)
+                result.append({"key": str(key),
+                               "depth": len(queued),
+                               "active": key in self._active_keys,
+                               "oldest_pending_age_seconds": round(now - oldest, 3) if oldest is not None else None,
+                               "submitted": metrics.submitted,
+                               "completed": metrics.completed,
+                               "failed": metrics.failed,
+                               "wait_seconds": metrics.wait.snapshot(),
+                               "run_seconds": metrics.run.snapshot()})
+        return sorted(result, key=lambda m: m["key"])
+
     def join_idle(self, timeout: float = 30.0) -> None:
         """Block until all per-key queues are drained (for tests / teardown)."""
         deadline = time.monotonic() + timeout
@@ -66,3 +134,16 @@ class FifoPool:
 
     def shutdown(self, wait: bool = True) -> None:
         self._executor.shutdown(wait=wait)
+
+
+def prometheus_metrics(metrics: List[dict], prefix: str = "scim_fifo_pool") -> str:
+    """Render the FifoPool metrics in the Prometheus text exposition format"""
+    return prometheus_text(metrics, prefix, "key",
+                           gauges=[("depth", "Number of queued tasks"),
+                                   ("oldest_pending_age_seconds", "Age of the oldest queued task")],
+                           counters=[("submitted", "Number of submitted tasks"),
+                                     ("completed", "Number of successfully executed tasks"),
+                                     ("failed", "Number of tasks that raised an exception")],
+                           histograms=[("wait_seconds", "Time between the submit and the start of the execution of "
+                                                        "a task"),
+                                       ("run_seconds", "Execution time of a task")])
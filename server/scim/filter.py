@@ -0,0 +1,197 @@
+import datetime
+import json
+import re
+from typing import Dict, List, Set, Tuple
+
+from sqlalchemy import and_, or_, not_, DateTime
+
+from server.api.exceptions import APIBadRequest
+from server.scim import EXTERNAL_ID_POST_FIX
+
+# The comparison operators of https://www.rfc-editor.org/rfc/rfc7644#section-3.4.2.2
+SCIM_FILTER_OPERATORS = ["eq", "ne", "co", "sw", "ew", "gt", "ge", "lt", "le"]
+# The values of these attributes may contain the EXTERNAL_ID_POST_FIX, which is not stored
+SCIM_FILTER_EXTERNAL_ID_ATTRIBUTES = ["id", "externalid"]
+
+_TOKEN = re.compile(r"\s*(?:(?P<paren>[()])|(?P<string>\"(?:[^\"\\]|\\.)*\"|'[^']*')|(?P<word>[^\s()\"']+))")
+
+
+def _invalid_filter(message: str):
+    return APIBadRequest(f"invalidFilter: {message}")
+
+
+def _tokens(query_filter: str) -> List[Tuple[str, str]]:
+    tokens = []
+    position = 0
+    query_filter = query_filter.strip()
+    while position < len(query_filter):
+        match = _TOKEN.match(query_filter, position)
+        if not match or match.end() == position:
+            raise _invalid_filter(f"unexpected character at position {position} in {query_filter}")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+def _value(kind: str, token: str):
+    if kind == "string":
+        # Double quoted strings are JSON strings, single quoted strings are accepted for backward compatibility
+        return json.loads(token) if token.startswith("\"") else token[1:-1]
+    literals = {"true": True, "false": False, "null": None}
+    if token.lower() in literals:
+        return literals[token.lower()]
+    try:
+        return float(token) if "." in token else int(token)
+    except ValueError:
+        raise _invalid_filter(f"invalid value {token}")
+
+
+class _Parser:
+    """
+    Recursive descent parser of a SCIM filter into a tree of tuples: (and / or, left, right), (not, filter),
+    (pr, attribute) and (operator, attribute, value). The precedence is not, and, or.
+    """
+
+    def __init__(self, query_filter: str):
+        self.query_filter = query_filter
+        self.tokens = _tokens(query_filter)
+        self.position = 0
+
+    def parse(self):
+        tree = self._or()
+        if self.position < len(self.tokens):
+            raise _invalid_filter(f"unexpected {self.tokens[self.position][1]} in {self.query_filter}")
+        return tree
+
+    def _peek_word(self):
+        if self.position < len(self.tokens) and self.tokens[self.position][0] == "word":
+            return self.tokens[self.position][1].lower()
+        return None
+
+    def _next(self) -> Tuple[str, str]:
+        if self.position >= len(self.tokens):
+            raise _invalid_filter(f"unexpected end of {self.query_filter}")
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def _or(self):
+        tree = self._and()
+        while self._peek_word() == "or":
+            self.position += 1
+            tree = ("or", tree, self._and())
+        return tree
+
+    def _and(self):
+        tree = self._not()
+        while self._peek_word() == "and":
+            self.position += 1
+            tree = ("and", tree, self._not())
+        return tree
+
+    def _not(self):
+        if self._peek_word() == "not":
+            self.position += 1
+            return "not", self._not()
+        return self._atom()
+
+    def _atom(self):
+        kind, token = self._next()
+        if kind == "paren" and token == "(":
+            tree = self._or()
+            if self._next() != ("paren", ")"):
+                raise _invalid_filter(f"missing closing parenthesis in {self.query_filter}")
+            return tree
+        if kind != "word":
+            raise _invalid_filter(f"attribute expected instead of {token} in {self.query_filter}")
+        kind, operator = self._next()
+        operator = operator.lower()
+        if kind == "word" and operator == "pr":
+            return "pr", token
+        if kind != "word" or operator not in SCIM_FILTER_OPERATORS:
+            raise _invalid_filter(f"unknown operator {operator} in {self.query_filter}")
+        value_kind, value = self._next()
+        if value_kind == "paren":
+            raise _invalid_filter(f"value expected instead of {value} in {self.query_filter}")
+        return operator, token, _value(value_kind, value)
+
+
+def parse_scim_filter(query_filter: str):
+    return _Parser(query_filter).parse()
+
+
+def normalize_attribute(attribute: str, core_schema: str, extension_schemas: List[str]) -> str:
+    """
+    The lowercase name of the attribute without the URN of the core schema. The attributes of an extension schema
+    keep the lowercase URN of the schema, joined with a colon - or the dot used in earlier SBS versions.
+    """
+    attribute = attribute.lower()
+    for schema in extension_schemas:
+        schema = schema.lower()
+        if attribute.startswith(f"{schema}:") or attribute.startswith(f"{schema}."):
+            return f"{schema}:{attribute[len(schema) + 1:]}"
+    core_schema = core_schema.lower()
+    if attribute.startswith(f"{core_schema}:"):
+        return attribute[len(core_schema) + 1:]
+    return attribute
+
+
+def filter_attributes(tree, core_schema: str, extension_schemas: List[str]) -> Set[str]:
+    if tree[0] in ["and", "or"]:
+        return filter_attributes(tree[1], core_schema, extension_schemas) | \
+            filter_attributes(tree[2], core_schema, extension_schemas)
+    if tree[0] == "not":
+        return filter_attributes(tree[1], core_schema, extension_schemas)
+    return {normalize_attribute(tree[1], core_schema, extension_schemas)}
+
+
+def _is_datetime(column) -> bool:
+    # The TZDateTime columns decorate a DateTime
+    column_type = column.type
+    return isinstance(getattr(column_type, "impl", column_type), DateTime)
+
+
+def _column_value(attribute: str, column, value):
+    if isinstance(value, str) and attribute in SCIM_FILTER_EXTERNAL_ID_ATTRIBUTES and \
+            value.lower().endswith(EXTERNAL_ID_POST_FIX):
+        return value[:-len(EXTERNAL_ID_POST_FIX)]
+    if _is_datetime(column) and value is not None:
+        try:
+            date_time = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        except ValueError:
+            raise _invalid_filter(f"invalid dateTime {value}")
+        return date_time if date_time.tzinfo else date_time.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def _comparison(operator: str, column, value):
+    if operator in ["co", "sw", "ew"]:
+        if not isinstance(value, str):
+            raise _invalid_filter(f"operator {operator} requires a string")
+        return {"co": column.contains, "sw": column.startswith, "ew": column.endswith}[operator](value, autoescape=True)
+    if value is None:
+        if operator not in ["eq", "ne"]:
+            raise _invalid_filter(f"operator {operator} can not compare with null")
+        return column.is_(None) if operator == "eq" else column.isnot(None)
+    return {"eq": column.__eq__, "ne": column.__ne__, "gt": column.__gt__, "ge": column.__ge__,
+            "lt": column.__lt__, "le": column.__le__}[operator](value)
+
+
+def scim_filter_criteria(tree, columns: Dict[str, object], core_schema: str, extension_schemas: List[str]):
+    """
+    The SQLAlchemy criteria of the parsed SCIM filter, where columns are the supported attributes by normalized name
+    """
+    if tree[0] in ["and", "or"]:
+        left = scim_filter_criteria(tree[1], columns, core_schema, extension_schemas)
+        right = scim_filter_criteria(tree[2], columns, core_schema, extension_schemas)
+        return and_(left, right) if tree[0] == "and" else or_(left, right)
+    if tree[0] == "not":
+        return not_(scim_filter_criteria(tree[1], columns, core_schema, extension_schemas))
+    attribute = normalize_attribute(tree[1], core_schema, extension_schemas)
+    if attribute not in columns:
+        raise _invalid_filter(f"not supported attribute {tree[1]}")
+    column = columns[attribute]
+    if tree[0] == "pr":
+        return column.isnot(None) if _is_datetime(column) else and_(column.isnot(None), column != "")
+    return _comparison(tree[0], column, _column_value(attribute, column, tree[2]))
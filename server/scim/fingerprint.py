@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple, Union
+
+from flask import current_app
+
+from server.api.base import application_base_url
+from server.db.domain import Service, User, Group, Collaboration
+from server.scim.group_template import create_group_template, scim_member_object
+from server.scim.session import normalize_endpoint_url
+from server.scim.user_template import create_user_template, replace_none_values
+
+# The fingerprints by (scim_type, external_id), where None removes the fingerprint
+Fingerprints = Dict[Tuple[str, str], Optional[str]]
+
+
+def fingerprints_enabled() -> bool:
+    return os.environ.get("SCIM_FINGERPRINTS", "1") != "0"
+
+
+def _redis_key(service: Service):
+    return f"scim_fingerprints_{service.id}_{normalize_endpoint_url(service.scim_url)}"
+
+
+def _field(scim_type: str, external_id: str):
+    return f"{scim_type}:{external_id}"
+
+
+def _fingerprint(scim_dict: dict) -> str:
+    return hashlib.sha256(json.dumps(scim_dict, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def user_fingerprint(user: User) -> str:
+    return _fingerprint(replace_none_values(create_user_template(user)))
+
+
+def group_fingerprint(group: Union[Group, Collaboration]) -> str:
+    # The members are referenced by their external_id, so the fingerprint does not depend on the remote identifiers
+    base_url = application_base_url()
+    members = [scim_member_object(base_url, m) for m in group.collaboration_memberships if m.is_active()]
+    return _fingerprint(replace_none_values(create_group_template(group, members)))
+
+
+def stored_fingerprints(service: Service, scim_type: str, external_ids: List[str]) -> Dict[str, Optional[str]]:
+    """The fingerprints of the payloads last accepted by the remote SCIM server of the service by external_id"""
+    if not external_ids or not fingerprints_enabled():
+        return {external_id: None for external_id in external_ids}
+    values = current_app.redis_client.hmget(_redis_key(service), [_field(scim_type, e) for e in external_ids])
+    return {external_id: value.decode() if value else None for external_id, value in zip(external_ids, values)}
+
+
+def is_unchanged(service: Service, scim_type: str, external_id: str, fingerprint: str) -> bool:
+    return stored_fingerprints(service, scim_type, [external_id])[external_id] == fingerprint
+
+
+def store_fingerprints(service: Service, fingerprints: Fingerprints, replace_all=False):
+    """Store the fingerprints of the accepted payloads, with replace_all the others of the service are removed"""
+    if not fingerprints_enabled():
+        return
+    redis_key = _redis_key(service)
+    mapping = {_field(*key): value for key, value in fingerprints.items() if value is not None}
+    removed = [_field(*key) for key, value in fingerprints.items() if value is None]
+    with current_app.redis_client.pipeline() as pipe:
+        if replace_all:
+            pipe.delete(redis_key)
+        if mapping:
+            pipe.hset(redis_key, mapping=mapping)
+        if removed and not replace_all:
+            pipe.hdel(redis_key, *removed)
+        pipe.execute()
+
+
+def store_fingerprint(service: Service, scim_type: str, external_id: str, fingerprint: Optional[str]):
+    store_fingerprints(service, {(scim_type, external_id): fingerprint})
@@ -1,23 +1,22 @@
-from typing import Union, List
+from typing import Dict, List, Optional, Tuple, Union
 
 from server.api.base import application_base_url
 from server.db.domain import Group, Collaboration, CollaborationMembership
 from server.scim import SCIM_URL_PREFIX, EXTERNAL_ID_POST_FIX
-from server.scim.schema_template import SCIM_SCHEMA_CORE_GROUP, SCIM_API_MESSAGES
+from server.scim.schema_template import SCIM_SCHEMA_CORE_GROUP, SCIM_API_MESSAGES, SCIM_PATCH_OP, \
+    get_scim_schema_sram_group
 from server.scim.user_template import version_value, date_time_format, replace_none_values
 
 
-def _meta_info(group: Union[Group, Collaboration]):
+def _meta_info(group: Union[Group, Collaboration], version: Optional[str] = None):
     return {"resourceType": "Group",
             "created": date_time_format(group.created_at),
             "lastModified": date_time_format(group.updated_at),
-            "version": version_value(group),
+            "version": version or version_value(group),
             "location": f"/Groups/{group.identifier}{EXTERNAL_ID_POST_FIX}"}
 
 
 def create_group_template(group: Union[Group, Collaboration], membership_scim_objects):
-    from server.scim.schema_template import get_scim_schema_sram_group
-
     def link(name: str, value: str):
         return {
             'name': name,
@@ -69,6 +68,30 @@ def update_group_template(group: Union[Group, Collaboration], membership_scim_ob
     return result
 
 
+def patch_group_template(group: Union[Group, Collaboration], membership_scim_objects,
+                         scim_object: dict) -> Optional[dict]:
+    """
+    The RFC 7644 PatchOp with the changes of the group compared to the remote scim_object: a replace of the
+    non-member attributes if changed and an add / remove of the changed members. None if nothing has changed.
+    """
+    desired = create_group_template(group, membership_scim_objects)
+    operations = []
+    attributes = {attr: desired[attr] for attr in ["displayName", get_scim_schema_sram_group()]
+                  if scim_object.get(attr) != desired[attr]}
+    if attributes:
+        operations.append({"op": "replace", "value": attributes})
+    remote_values = {member.get("value") for member in scim_object.get("members", [])}
+    desired_values = {member["value"] for member in desired["members"]}
+    added = [member for member in desired["members"] if member["value"] not in remote_values]
+    if added:
+        operations.append({"op": "add", "path": "members", "value": added})
+    for value in sorted(remote_values - desired_values):
+        operations.append({"op": "remove", "path": f"members[value eq \"{value}\"]"})
+    if not operations:
+        return None
+    return {"schemas": [SCIM_PATCH_OP], "Operations": operations}
+
+
 # This is used for internal SRAM groups and external SCIM providers
 def scim_member_object(base_url, membership: CollaborationMembership, scim_object=None):
     member_value = f"{membership.user.external_id}{EXTERNAL_ID_POST_FIX}"
@@ -79,25 +102,29 @@ def scim_member_object(base_url, membership: CollaborationMembership, scim_objec
     }
 
 
-def find_group_by_id_template(group: Union[Group, Collaboration]):
+def find_group_by_id_template(group: Union[Group, Collaboration], version: Optional[str] = None):
     base_url = application_base_url()
     members = [scim_member_object(base_url, m) for m in group.collaboration_memberships if m.is_active()]
     group_template = update_group_template(group, members, f"{group.identifier}{EXTERNAL_ID_POST_FIX}")
-    group_template["meta"] = _meta_info(group)
+    group_template["meta"] = _meta_info(group, version)
     return group_template
 
 
-def find_groups_template(groups: List[Union[Group, Collaboration]]):
+# The total_results and the 1-based start_index are those of the requested page, the projection drops attributes and
+# the versions by collaboration or group are those of the page, see server.scim.repo.scim_group_versions
+def find_groups_template(groups: List[Union[Group, Collaboration]], total_results: int = None, start_index: int = 1,
+                         projection=None, versions: Optional[Dict[Tuple[type, int], str]] = None):
     base = {
         "schemas": [
             f"{SCIM_API_MESSAGES}:ListResponse"
         ],
-        "totalResults": len(groups),
-        "startIndex": 0,
+        "totalResults": len(groups) if total_results is None else total_results,
+        "startIndex": start_index,
         "itemsPerPage": len(groups),
     }
     resources = []
     for group in groups:
-        resources.append(find_group_by_id_template(group))
+        resource = find_group_by_id_template(group, versions.get((type(group), group.id)) if versions else None)
+        resources.append(projection.apply(resource) if projection else resource)
     base["Resources"] = resources
     return base
@@ -0,0 +1,120 @@
+from typing import Dict, List, Optional, Tuple
+
+from server.api.base import query_param
+from server.api.exceptions import APIBadRequest
+
+# Attributes that are returned regardless of the attributes and excludedAttributes parameters
+SCIM_ALWAYS_RETURNED = ["id", "schemas"]
+
+
+def _int_param(name: str, default: Optional[int]) -> Optional[int]:
+    value = query_param(name, required=False)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise APIBadRequest(f"Invalid {name} {value}, an integer is required")
+
+
+def list_paging() -> Tuple[int, Optional[int]]:
+    """
+    The 1-based startIndex and the count of the requested page, see https://www.rfc-editor.org/rfc/rfc7644#section-3.4.2.4.
+    Without a count all resources from the startIndex are returned.
+    """
+    start_index = max(1, _int_param("startIndex", 1))
+    count = _int_param("count", None)
+    return start_index, None if count is None else max(0, count)
+
+
+def list_sorting(sort_columns: Dict[str, object], core_schema: str) -> Tuple[Optional[object], bool]:
+    """
+    The column to sort on - or None if not requested - and whether the order is descending, see
+    https://www.rfc-editor.org/rfc/rfc7644#section-3.4.2.3
+    """
+    sort_by = query_param("sortBy", required=False)
+    sort_order = query_param("sortOrder", required=False, default="ascending").lower()
+    if sort_order not in ["ascending", "descending"]:
+        raise APIBadRequest(f"Invalid sortOrder {sort_order}")
+    if not sort_by:
+        return None, False
+    attribute = sort_by.lower()
+    if attribute.startswith(f"{core_schema.lower()}:"):
+        attribute = attribute[len(core_schema) + 1:]
+    if attribute not in sort_columns:
+        raise APIBadRequest(f"Not supported sortBy {sort_by}")
+    return sort_columns[attribute], sort_order == "descending"
+
+
+class AttributeProjection:
+    """
+    The attributes and excludedAttributes of a request, see https://www.rfc-editor.org/rfc/rfc7644#section-3.4.2.5.
+    Attribute names are case-insensitive, sub-attributes are separated by a dot and the attributes of the core schema
+    may be prefixed with the schema URN. The attributes of an extension schema are always prefixed with its URN.
+    """
+
+    def __init__(self, core_schema: str, extension_schemas: List[str]):
+        self.core_schema = core_schema.lower()
+        self.extension_schemas = [schema.lower() for schema in extension_schemas]
+        attributes = query_param("attributes", required=False)
+        excluded_attributes = query_param("excludedAttributes", required=False)
+        # The attributes take precedence over the excludedAttributes
+        self.attributes = self._paths(attributes) if attributes else None
+        self.excluded_attributes = self._paths(excluded_attributes) if excluded_attributes and not attributes else []
+
+    def _path(self, attribute: str) -> List[str]:
+        attribute = attribute.strip().lower()
+        for schema in self.extension_schemas:
+            if attribute == schema:
+                return [schema]
+            if attribute.startswith(f"{schema}:"):
+                return [schema] + attribute[len(schema) + 1:].split(".")
+        if attribute.startswith(f"{self.core_schema}:"):
+            attribute = attribute[len(self.core_schema) + 1:]
+        return attribute.split(".")
+
+    def _paths(self, attributes: str) -> List[List[str]]:
+        return [self._path(attribute) for attribute in attributes.split(",") if attribute.strip()]
+
+    def returned(self, attribute: str) -> bool:
+        """Is the - possibly expensive - attribute part of the response"""
+        path = self._path(attribute)
+        if self.attributes is not None:
+            return any(p[:len(path)] == path or path[:len(p)] == p for p in self.attributes)
+        return not any(path[:len(p)] == p for p in self.excluded_attributes)
+
+    def apply(self, resource: dict) -> dict:
+        if self.attributes is not None:
+            always = {key: value for key, value in resource.items() if key in SCIM_ALWAYS_RETURNED}
+            return {**_include(resource, self.attributes), **always}
+        if self.excluded_attributes:
+            return _exclude(resource, [p for p in self.excluded_attributes if p[0] not in SCIM_ALWAYS_RETURNED])
+        return resource
+
+
+def _include(value, paths: List[List[str]]):
+    if isinstance(value, list):
+        return [_include(v, paths) for v in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for key, sub_value in value.items():
+        matching = [p[1:] for p in paths if p[0] == key.lower()]
+        if not matching:
+            continue
+        result[key] = sub_value if any(not p for p in matching) else _include(sub_value, matching)
+    return result
+
+
+def _exclude(value, paths: List[List[str]]):
+    if isinstance(value, list):
+        return [_exclude(v, paths) for v in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for key, sub_value in value.items():
+        matching = [p[1:] for p in paths if p[0] == key.lower()]
+        if any(not p for p in matching):
+            continue
+        result[key] = _exclude(sub_value, matching) if matching else sub_value
+    return result
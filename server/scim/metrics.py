@@ -0,0 +1,61 @@
+from typing import List, Sequence, Tuple
+
+# Upper bounds in seconds of the buckets of the latency histograms, the implicit last bucket is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    __slots__ = ("bucket_counts", "sum", "count")
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        for i, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                self.bucket_counts[i] += 1
+                break
+        self.sum += seconds
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        """Cumulative bucket counts - like Prometheus - keyed by their upper bound"""
+        buckets, cumulative = {}, 0
+        for upper_bound, count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            cumulative += count
+            buckets[str(upper_bound)] = cumulative
+        buckets["+Inf"] = self.count
+        return {"buckets": buckets, "sum": round(self.sum, 6), "count": self.count}
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prometheus_text(metrics: List[dict], prefix: str, label: str, gauges: Sequence[Tuple[str, str]] = (),
+                    counters: Sequence[Tuple[str, str]] = (), histograms: Sequence[Tuple[str, str]] = ()) -> str:
+    """
+    Render the metrics - one dict per value of the label - in the Prometheus text exposition format. The gauges,
+    counters and histograms are tuples of the key in the dicts and its description.
+    """
+    lines = []
+    for name, description in gauges:
+        lines += [f"# HELP {prefix}_{name} {description}", f"# TYPE {prefix}_{name} gauge"]
+        for m in metrics:
+            lines.append(f'{prefix}_{name}{{{label}="{_escape_label(m[label])}"}} {m[name] or 0}')
+    for name, description in counters:
+        lines += [f"# HELP {prefix}_{name}_total {description}", f"# TYPE {prefix}_{name}_total counter"]
+        for m in metrics:
+            lines.append(f'{prefix}_{name}_total{{{label}="{_escape_label(m[label])}"}} {m[name]}')
+    for name, description in histograms:
+        lines += [f"# HELP {prefix}_{name} {description}", f"# TYPE {prefix}_{name} histogram"]
+        for m in metrics:
+            label_value = f'{label}="{_escape_label(m[label])}"'
+            histogram = m[name]
+            for upper_bound, count in histogram["buckets"].items():
+                lines.append(f'{prefix}_{name}_bucket{{{label_value},le="{upper_bound}"}} {count}')
+            lines.append(f"{prefix}_{name}_sum{{{label_value}}} {histogram['sum']}")
+            lines.append(f"{prefix}_{name}_count{{{label_value}}} {histogram['count']}")
+    return "\n".join(lines) + "\n"
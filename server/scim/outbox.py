@@ -0,0 +1,174 @@
+import json
+import logging
+from datetime import timedelta
+from typing import Callable, Dict, List, Sequence
+
+from flask import current_app
+from redis.exceptions import LockError
+from sqlalchemy import delete, func, insert, select, update
+
+from server.db.db import db
+from server.db.domain import ScimOutboxMessage
+from server.scim.circuit_breaker import circuit_open
+from server.scim.metrics import prometheus_text
+from server.tools import dt_now
+
+OUTBOX_PENDING = "pending"
+OUTBOX_DEAD_LETTER = "dead_letter"
+
+# Maximum number of messages of one endpoint loaded at the time
+OUTBOX_BATCH_SIZE = 100
+# Expiry of the lock ensuring that only one process at the time delivers the messages of an endpoint
+OUTBOX_LOCK_TIMEOUT = 15 * 60  # seconds
+# Redis hash with the number of coalesced - skipped - messages per endpoint, shared by all processes
+OUTBOX_COALESCED_KEY = "scim_outbox_coalesced"
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BACKOFF_SECONDS = 30
+DEFAULT_MAX_BACKOFF_SECONDS = 60 * 60
+
+# The outbox is changed with plain statements, so the messages don't count as changed (audited) data
+outbox = ScimOutboxMessage.__table__
+
+
+def _outbox_config(key: str, default: int) -> int:
+    return current_app.app_config.get("scim_outbox", {}).get(key, default)
+
+
+def enqueue_outbox_message(endpoint: str, task: str, args: Sequence, service_ids: List[int]):
+    arguments = json.dumps({"args": list(args), "service_ids": service_ids})
+    db.session.execute(insert(outbox).values(endpoint=endpoint, task=task, arguments=arguments,
+                                             status=OUTBOX_PENDING, attempts=0, next_attempt_at=dt_now()))
+    db.session.commit()
+
+
+def deliver_outbox(app, endpoint: str, tasks: Dict[str, Callable]) -> int:
+    """
+    Deliver the pending messages of the endpoint in FIFO order and return the number of delivered messages. A
+    failed delivery is retried with exponential backoff - blocking the later messages of the endpoint - until it
+    is moved to the dead letters after max_attempts. Nothing is delivered while the circuit of the endpoint is open.
+    With scim_outbox.coalesce, a message is skipped if the next pending message is identical, e.g. for the same user
+    changed many times in a row during an import.
+    """
+    if circuit_open(endpoint):
+        # The messages stay pending - without counting an attempt - until the circuit lets a probe request through
+        return 0
+    with app.app_context():
+        lock = app.redis_client.lock(f"scim_outbox_{endpoint}", timeout=OUTBOX_LOCK_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            # Another process is delivering the messages of this endpoint
+            return 0
+        try:
+            return _deliver_messages(app, endpoint, tasks)
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                pass
+
+
+def _deliver_messages(app, endpoint: str, tasks: Dict[str, Callable]) -> int:
+    coalesce = _outbox_config("coalesce", True)
+    delivered = 0
+    while True:
+        messages = db.session.execute(select(outbox)
+                                      .where(outbox.c.endpoint == endpoint)
+                                      .where(outbox.c.status == OUTBOX_PENDING)
+                                      .order_by(outbox.c.id)
+                                      .limit(OUTBOX_BATCH_SIZE)).all()
+        if not messages:
+            return delivered
+        for message, next_message in zip(messages, messages[1:] + [None]):
+            # Only runs of identical messages are coalesced. Skipping a message past different ones would reorder
+            # it, e.g. a group would be provisioned before a changed user it contains.
+            if coalesce and next_message is not None and \
+                    (message.task, message.arguments) == (next_message.task, next_message.arguments):
+                _delete_message(message.id)
+                app.redis_client.hincrby(OUTBOX_COALESCED_KEY, endpoint)
+                continue
+            if message.next_attempt_at > dt_now():
+                return delivered
+            if _deliver_message(app, message, tasks):
+                _delete_message(message.id)
+                delivered += 1
+            elif not _retry_message(message):
+                # The later messages wait for the retry of this one
+                return delivered
+
+
+def _deliver_message(app, message, tasks: Dict[str, Callable]) -> bool:
+    task = tasks.get(message.task)
+    if task is None:
+        logger = logging.getLogger("scim")
+        logger.error(f"Unknown SCIM outbox task {message.task} for message {message.id}")
+        return True
+    arguments = json.loads(message.arguments)
+    return task(app, *arguments["args"], arguments["service_ids"]) is not False
+
+
+def _delete_message(message_id: int):
+    db.session.execute(delete(outbox).where(outbox.c.id == message_id))
+    db.session.commit()
+
+
+# Returns False if the message will be retried, True if it is moved to the dead letters
+def _retry_message(message) -> bool:
+    now = dt_now()
+    attempts = message.attempts + 1
+    values = {"attempts": attempts, "last_attempt_at": now}
+    if attempts >= _outbox_config("max_attempts", DEFAULT_MAX_ATTEMPTS):
+        logger = logging.getLogger("scim")
+        logger.error(f"SCIM outbox message {message.id} ({message.task} for {message.endpoint}) moved to the dead "
+                     f"letters after {attempts} attempts")
+        values["status"] = OUTBOX_DEAD_LETTER
+    else:
+        backoff = _outbox_config("backoff_seconds", DEFAULT_BACKOFF_SECONDS) * 2 ** (attempts - 1)
+        max_backoff = _outbox_config("max_backoff_seconds", DEFAULT_MAX_BACKOFF_SECONDS)
+        values["next_attempt_at"] = now + timedelta(seconds=min(backoff, max_backoff))
+    db.session.execute(update(outbox).where(outbox.c.id == message.id).values(**values))
+    db.session.commit()
+    return values.get("status") == OUTBOX_DEAD_LETTER
+
+
+def due_outbox_endpoints() -> List[str]:
+    statement = select(outbox.c.endpoint) \
+        .where(outbox.c.status == OUTBOX_PENDING) \
+        .where(outbox.c.next_attempt_at <= dt_now()) \
+        .distinct()
+    return list(db.session.execute(statement).scalars())
+
+
+def outbox_statistics() -> List[dict]:
+    """
+    The number of pending messages, the age of the oldest one, the number of dead letters and the number of
+    coalesced messages per endpoint
+    """
+    statement = select(outbox.c.endpoint, outbox.c.status, func.count(), func.min(outbox.c.created_at)) \
+        .group_by(outbox.c.endpoint, outbox.c.status) \
+        .order_by(outbox.c.endpoint)
+    now = dt_now()
+    coalesced = {endpoint.decode(): int(count)
+                 for endpoint, count in current_app.redis_client.hgetall(OUTBOX_COALESCED_KEY).items()}
+    statistics = {endpoint: _endpoint_statistics(endpoint, coalesced[endpoint]) for endpoint in coalesced}
+    for endpoint, status, count, oldest in db.session.execute(statement):
+        endpoint_statistics = statistics.setdefault(endpoint, _endpoint_statistics(endpoint, 0))
+        if status == OUTBOX_PENDING:
+            endpoint_statistics["depth"] = count
+            endpoint_statistics["oldest_age_seconds"] = int((now - oldest).total_seconds())
+        elif status == OUTBOX_DEAD_LETTER:
+            endpoint_statistics["dead_letters"] = count
+    return [statistics[endpoint] for endpoint in sorted(statistics)]
+
+
+def _endpoint_statistics(endpoint: str, coalesced: int) -> dict:
+    return {"endpoint": endpoint, "depth": 0, "oldest_age_seconds": None, "dead_letters": 0, "coalesced": coalesced}
+
+
+def prometheus_outbox_statistics(statistics: List[dict], prefix: str = "scim_outbox") -> str:
+    """Render the outbox statistics in the Prometheus text exposition format"""
+    return prometheus_text(statistics, prefix, "endpoint",
+                           gauges=[("depth", "Number of pending messages"),
+                                   ("oldest_age_seconds", "Age of the oldest pending message"),
+                                   ("dead_letters", "Number of messages moved to the dead letters")],
+                           counters=[("coalesced", "Number of messages skipped, because the next message was "
+                                                   "identical")])
@@ -1,5 +1,39 @@
-from server.db.domain import User, CollaborationMembership, Collaboration, Service
-from server.db.models import flatten
+import json
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from sqlalchemy import or_, select, func, literal, union_all
+from sqlalchemy.orm import Query, selectinload, noload
+
+from server.db.audit_mixin import AuditLog, ACTION_DELETE
+from server.db.db import db
+from server.db.defaults import STATUS_SUSPENDED
+from server.db.domain import User, CollaborationMembership, Collaboration, Service, Group, SshKey, Tag, \
+    services_collaborations_association, collaboration_memberships_groups_association, collaboration_tags_association
+from server.db.models import flatten, unique_model_objects
+from server.scim import SCIM_GROUPS, SCIM_USERS
+from server.scim.fingerprint import stored_fingerprints
+from server.scim.schema_template import get_scim_schema_sram_user
+from server.scim.user_template import updated_at_version, aggregate_version, inactive_days, timestamp
+from server.tools import dt_now, dt_today
+
+
+def scim_user_options(with_ssh_keys=True) -> list:
+    """The loader options of the users rendered with the SCIM user template"""
+    return [selectinload(User.ssh_keys) if with_ssh_keys else noload(User.ssh_keys)]
+
+
+def scim_group_options(model, with_members=True) -> list:
+    """
+    The loader options of the collaborations or groups rendered with the SCIM group template. The members require
+    the user and the collaboration of the memberships, see CollaborationMembership.is_active.
+    """
+    options = [selectinload(Collaboration.tags)] if model is Collaboration else []
+    if not with_members:
+        return options + [noload(model.collaboration_memberships)]
+    memberships = selectinload(model.collaboration_memberships)
+    return options + [memberships.selectinload(CollaborationMembership.user),
+                      memberships.selectinload(CollaborationMembership.collaboration)]
 
 
 def all_scim_users_by_service(service):
@@ -8,6 +42,7 @@ def all_scim_users_by_service(service):
         .join(CollaborationMembership.collaboration) \
         .join(Collaboration.services) \
         .filter(Service.id == service.id) \
+        .options(*scim_user_options()) \
         .all()
 
 
@@ -15,6 +50,407 @@ def all_scim_groups_by_service(service):
     collaborations = Collaboration.query \
         .join(Collaboration.services) \
         .filter(Service.id == service.id) \
+        .options(*scim_group_options(Collaboration),
+                 selectinload(Collaboration.groups).options(*scim_group_options(Group))) \
         .all()
     groups = flatten(co.groups for co in collaborations)
     return collaborations + groups
+
+
+def load_scim_users(users: List[User]) -> List[User]:
+    """The users in the same order, with the relationships of the SCIM user template loaded in one go"""
+    if not users:
+        return []
+    loaded = {user.id: user for user in User.query
+              .filter(User.id.in_([user.id for user in users]))
+              .options(*scim_user_options())
+              .all()}
+    return [loaded[user.id] for user in users]
+
+
+# The sortBy attributes of the SCIM server by lowercase name
+USER_SORT_COLUMNS = {
+    "id": User.external_id,
+    "externalid": User.external_id,
+    "username": User.username,
+    "displayname": User.name,
+    "name.givenname": User.given_name,
+    "name.familyname": User.family_name,
+    "emails": User.email,
+    "emails.value": User.email,
+    "meta.created": User.created_at,
+    "meta.lastmodified": User.updated_at
+}
+
+
+# The filter attributes of the SCIM server by normalized name, see server.scim.filter.normalize_attribute
+def user_filter_columns():
+    return {**USER_SORT_COLUMNS, f"{get_scim_schema_sram_user().lower()}:edupersonuniqueid": User.uid}
+
+
+# The columns are present in both the collaborations and the groups table
+GROUP_SORT_COLUMNS = {
+    "id": "identifier",
+    "externalid": "identifier",
+    "displayname": "name",
+    "meta.created": "created_at",
+    "meta.lastmodified": "updated_at"
+}
+
+
+def scim_users_query(service) -> Query:
+    return User.query \
+        .join(User.collaboration_memberships) \
+        .join(CollaborationMembership.collaboration) \
+        .join(Collaboration.services) \
+        .filter(Service.id == service.id) \
+        .distinct()
+
+
+def _aggregate(subquery, *state) -> Tuple[int, str]:
+    total_results, last_updated_at, checksum = db.session.execute(
+        select(func.count(), func.max(subquery.c.updated_at), func.sum(subquery.c.key)).select_from(subquery)).one()
+    return total_results, aggregate_version(total_results, last_updated_at, int(checksum or 0), *state)
+
+
+def _aggregate_state(key, statement) -> tuple:
+    """
+    The state of the related rows of all resources in a single row, instead of a row per resource. The statement
+    selects the key of the resource followed by the aggregates of its related rows, the sum of the keys detects a
+    related row moved to another resource.
+    """
+    row = db.session.execute(statement.with_only_columns(func.sum(key), *list(statement.selected_columns)[1:])).one()
+    return tuple(timestamp(value) if isinstance(value, datetime) else int(value or 0) for value in row)
+
+
+def _ssh_key_statement(user_ids):
+    # The SQL equivalent of the ssh_keys part of server.scim.user_template.user_state
+    key = SshKey.user_id
+    statement = select(key, func.count(), func.sum(SshKey.id), func.sum(func.crc32(SshKey.ssh_value))) \
+        .where(key.in_(user_ids))
+    return key, statement
+
+
+def _ssh_key_states(user_ids) -> Dict[int, tuple]:
+    key, statement = _ssh_key_statement(user_ids)
+    return {row[0]: tuple(int(value) for value in row[1:]) for row in db.session.execute(statement.group_by(key))}
+
+
+def scim_users_aggregate(query: Query) -> Tuple[int, str]:
+    """
+    The total number of users of the query and their aggregate version, without loading the users or their related
+    rows
+    """
+    subquery = query.order_by(None).with_entities(User.id.label("key"), User.updated_at).subquery()
+    ssh_key_state = _aggregate_state(*_ssh_key_statement(select(subquery.c.key)))
+    # The sramInactiveDays of the users depend on the current day
+    return _aggregate(subquery, dt_today().strftime("%Y%m%d"), *ssh_key_state)
+
+
+def scim_user_versions(user_ids: List[int]) -> Dict[int, str]:
+    """The versions of the users by id, without loading the users, see server.scim.user_template.version_value"""
+    if not user_ids:
+        return {}
+    ssh_key_states = _ssh_key_states(user_ids)
+    rows = db.session.execute(select(User.id, User.updated_at, User.last_login_date).where(User.id.in_(user_ids)))
+    return {user_id: updated_at_version(updated_at, inactive_days(last_login_date),
+                                        *ssh_key_states.get(user_id, (0, 0, 0)))
+            for user_id, updated_at, last_login_date in rows}
+
+
+def scim_user_version(external_id: str) -> str:
+    """The version of the user, without loading the user"""
+    user_id = db.session.execute(select(User.id).where(User.external_id == external_id)).scalar_one()
+    return scim_user_versions([user_id])[user_id]
+
+
+def paged_scim_users(query: Query, start_index: int, count: Optional[int], sort_column=None, descending=False,
+                     with_ssh_keys=True, total_results: Optional[int] = None) -> Tuple[List[User], int]:
+    """
+    The page of users of the query starting at the 1-based start_index and the total number of users, which is
+    counted unless already known. The ssh_keys are only loaded if they are returned.
+    """
+    if total_results is None:
+        total_results = query.order_by(None).count()
+    order_by = [sort_column.desc() if descending else sort_column.asc()] if sort_column is not None else []
+    query = query \
+        .order_by(*order_by, User.id) \
+        .options(*scim_user_options(with_ssh_keys)) \
+        .offset(start_index - 1)
+    if count is not None:
+        query = query.limit(count)
+    return query.all(), total_results
+
+
+def group_filter_columns(model):
+    return {attribute: getattr(model, column_name) for attribute, column_name in GROUP_SORT_COLUMNS.items()}
+
+
+def _scim_groups_union(service, sort_column_name: Optional[str] = None, criteria: Optional[Callable] = None):
+    def scim_groups(kind: int, model):
+        sort_key = [getattr(model, sort_column_name).label("sort_key")] if sort_column_name else []
+        # The key distinguishes the collaborations from the groups with the same id
+        statement = select(literal(kind).label("kind"), model.id.label("id"), (model.id * 2 + kind).label("key"),
+                           model.updated_at.label("updated_at"), *sort_key)
+        return statement.where(criteria(model)) if criteria else statement
+
+    collaborations = scim_groups(0, Collaboration) \
+        .join(Collaboration.services) \
+        .where(Service.id == service.id)
+    groups = scim_groups(1, Group) \
+        .join(Group.collaboration) \
+        .join(Collaboration.services) \
+        .where(Service.id == service.id)
+    return union_all(collaborations, groups).subquery()
+
+
+def _member_statement(model, ids):
+    # The SQL equivalent of the members part of server.scim.user_template.group_state
+    now = dt_now()
+    if model is Collaboration:
+        key = CollaborationMembership.collaboration_id
+        statement = select(key).select_from(CollaborationMembership)
+    else:
+        association = collaboration_memberships_groups_association
+        key = association.c.group_id
+        statement = select(key) \
+            .select_from(association) \
+            .join(CollaborationMembership, CollaborationMembership.id == association.c.collaboration_membership_id)
+    # The criteria of CollaborationMembership.is_active
+    statement = statement \
+        .add_columns(func.count(), func.sum(CollaborationMembership.id), func.max(User.updated_at)) \
+        .join(CollaborationMembership.user) \
+        .join(CollaborationMembership.collaboration) \
+        .where(key.in_(ids)) \
+        .where(or_(CollaborationMembership.expiry_date.is_(None), CollaborationMembership.expiry_date > now)) \
+        .where(or_(Collaboration.expiry_date.is_(None), Collaboration.expiry_date > now)) \
+        .where(Collaboration.status != STATUS_SUSPENDED) \
+        .where(User.suspended.isnot(True))
+    return key, statement
+
+
+def _member_states(model, ids) -> Dict[int, tuple]:
+    key, statement = _member_statement(model, ids)
+    return {row[0]: (int(row[1]), int(row[2]), timestamp(row[3]))
+            for row in db.session.execute(statement.group_by(key))}
+
+
+def _label_statement(collaboration_ids):
+    # The SQL equivalent of the labels part of server.scim.user_template.group_state
+    key = collaboration_tags_association.c.collaboration_id
+    statement = select(key, func.count(), func.sum(func.crc32(Tag.tag_value))) \
+        .join(Tag, Tag.id == collaboration_tags_association.c.tag_id) \
+        .where(key.in_(collaboration_ids))
+    return key, statement
+
+
+def _label_states(collaboration_ids) -> Dict[int, tuple]:
+    key, statement = _label_statement(collaboration_ids)
+    return {row[0]: (int(row[1]), int(row[2])) for row in db.session.execute(statement.group_by(key))}
+
+
+def _group_states(model, ids) -> Dict[int, tuple]:
+    member_states = _member_states(model, ids)
+    if model is Group:
+        return member_states
+    label_states = _label_states(ids)
+    return {key: member_states.get(key, (0, 0, 0)) + label_states.get(key, (0, 0))
+            for key in member_states.keys() | label_states.keys()}
+
+
+def _empty_group_state(model) -> tuple:
+    return (0, 0, 0) if model is Group else (0, 0, 0, 0, 0)
+
+
+def scim_groups_aggregate(service, criteria: Optional[Callable] = None) -> Tuple[int, str]:
+    """
+    The total number of collaborations and groups of the service and their aggregate version, without loading them or
+    their related rows
+    """
+    scim_groups_union = _scim_groups_union(service, criteria=criteria)
+
+    def ids(kind: int):
+        return select(scim_groups_union.c.id).where(scim_groups_union.c.kind == kind)
+
+    state = _aggregate_state(*_member_statement(Collaboration, ids(0))) + \
+        _aggregate_state(*_member_statement(Group, ids(1))) + \
+        _aggregate_state(*_label_statement(ids(0)))
+    return _aggregate(scim_groups_union, *state)
+
+
+def scim_group_versions(model, ids: List[int]) -> Dict[int, str]:
+    """
+    The versions of the collaborations or groups by id, without loading them, see
+    server.scim.user_template.version_value
+    """
+    if not ids:
+        return {}
+    states = _group_states(model, ids)
+    rows = db.session.execute(select(model.id, model.updated_at).where(model.id.in_(ids)))
+    return {key: updated_at_version(updated_at, *states.get(key, _empty_group_state(model)))
+            for key, updated_at in rows}
+
+
+def scim_group_version(identifier: str) -> str:
+    """The version of the collaboration or group, without loading it"""
+    model = Collaboration
+    key = db.session.execute(select(Collaboration.id).where(Collaboration.identifier == identifier)).scalar_one_or_none()
+    if key is None:
+        model = Group
+        key = db.session.execute(select(Group.id).where(Group.identifier == identifier)).scalar_one()
+    return scim_group_versions(model, [key])[key]
+
+
+def paged_scim_groups(service, start_index: int, count: Optional[int], sort_column_name: Optional[str] = None,
+                      descending=False, with_members=True, criteria: Optional[Callable] = None,
+                      total_results: Optional[int] = None) -> Tuple[List[Union[Collaboration, Group]], int]:
+    """
+    The page of the collaborations and groups of the service starting at the 1-based start_index and the total number
+    of collaborations and groups, which is counted unless already known. Without sorting, the collaborations precede
+    the groups. The memberships are only loaded if the members are returned. The optional criteria returns the filter
+    for the collaborations or groups.
+    """
+    scim_groups_union = _scim_groups_union(service, sort_column_name, criteria)
+    if total_results is None:
+        total_results = db.session.execute(select(func.count()).select_from(scim_groups_union)).scalar()
+
+    order_by = []
+    if sort_column_name:
+        sort_key = scim_groups_union.c.sort_key
+        order_by.append(sort_key.desc() if descending else sort_key.asc())
+    statement = select(scim_groups_union.c.kind, scim_groups_union.c.id) \
+        .order_by(*order_by, scim_groups_union.c.kind, scim_groups_union.c.id) \
+        .offset(start_index - 1)
+    if count is not None:
+        statement = statement.limit(count)
+    page = db.session.execute(statement).all()
+
+    def load(model, kind: int):
+        ids = [row.id for row in page if row.kind == kind]
+        if not ids:
+            return {}
+        options = scim_group_options(model, with_members)
+        return {obj.id: obj for obj in model.query.filter(model.id.in_(ids)).options(*options).all()}
+
+    loaded = {0: load(Collaboration, 0), 1: load(Group, 1)}
+    return [loaded[row.kind][row.id] for row in page], total_results
+
+
+def _audit_logs_since(since: datetime, *criteria):
+    return AuditLog.query.filter(AuditLog.created_at >= since).filter(*criteria).all()
+
+
+def _state_before(audit_log: AuditLog, attr: str):
+    return json.loads(audit_log.state_before or "{}").get(attr)
+
+
+def _collaboration_ids(services) -> set:
+    return set(db.session.execute(
+        select(services_collaborations_association.c.collaboration_id)
+        .where(services_collaborations_association.c.service_id.in_([service.id for service in services]))).scalars())
+
+
+def changed_scim_objects_by_service(service, since: datetime, owners: Optional[List[Service]] = None):
+    """
+    The users, collaborations and groups of the service changed since the given moment - according to their
+    updated_at and the audit logs - and the identifiers of the deleted groups and the external_id's of the users
+    that lost access to the service. The deletions are restricted to the collaborations of the service, and skip
+    the users and groups still owned by one of the owners: the services sharing the remote SCIM state of the
+    service, see server.scim.sweep.services_sharing_remote_state.
+    """
+    collaboration_ids = _collaboration_ids([service])
+    owner_collaboration_ids = _collaboration_ids(owners) | collaboration_ids if owners else collaboration_ids
+
+    # Changes of the memberships, groups, tags and services are logged with the collaboration as parent
+    parent_audit_logs = _audit_logs_since(since, AuditLog.parent_name.in_(["collaborations", "groups"]))
+    changed_collaboration_ids = {a.parent_id for a in parent_audit_logs if a.parent_name == "collaborations"}
+    changed_collaboration_ids.update(db.session.execute(
+        select(Collaboration.id).where(Collaboration.updated_at >= since)).scalars())
+    changed_collaboration_ids &= collaboration_ids
+    changed_group_ids = {a.parent_id for a in parent_audit_logs if a.parent_name == "groups"}
+    changed_group_ids.update(db.session.execute(select(Group.id).where(Group.updated_at >= since)).scalars())
+
+    collaborations = Collaboration.query \
+        .filter(Collaboration.id.in_(changed_collaboration_ids)) \
+        .options(*scim_group_options(Collaboration)) \
+        .all()
+    # The memberships of the groups change with the memberships of their collaboration
+    groups = Group.query \
+        .filter(Group.collaboration_id.in_(collaboration_ids)) \
+        .filter(or_(Group.id.in_(changed_group_ids), Group.collaboration_id.in_(changed_collaboration_ids))) \
+        .options(*scim_group_options(Group)) \
+        .all()
+
+    # The collaborations still connected to another owner are not deleted
+    disconnected_collaboration_ids = {a.parent_id for a in parent_audit_logs
+                                      if a.target_type == "services" and a.target_id == service.id
+                                      and a.action == ACTION_DELETE and a.parent_id not in owner_collaboration_ids}
+    # The deleted collaborations that were connected to the service - according to the audit logs of the connection
+    # or the fingerprint of the provisioned group - and the deleted groups of the collaborations of the service
+    deletion_audit_logs = _audit_logs_since(since, AuditLog.target_type.in_(["collaborations", "groups"]),
+                                            AuditLog.action == ACTION_DELETE)
+    deleted_collaborations = {a.target_id: _state_before(a, "identifier") for a in deletion_audit_logs
+                              if a.target_type == "collaborations"}
+    connected_collaboration_ids = set(db.session.execute(
+        select(AuditLog.parent_id)
+        .where(AuditLog.target_type == "services", AuditLog.target_id == service.id,
+               AuditLog.parent_name == "collaborations", AuditLog.parent_id.in_(deleted_collaborations.keys())))
+        .scalars())
+    provisioned_groups = stored_fingerprints(service, SCIM_GROUPS,
+                                             [identifier for identifier in deleted_collaborations.values() if identifier])
+    deleted_collaboration_ids = {collaboration_id for collaboration_id, identifier in deleted_collaborations.items()
+                                 if collaboration_id in connected_collaboration_ids or provisioned_groups.get(identifier)}
+    scope_collaboration_ids = collaboration_ids | deleted_collaboration_ids | disconnected_collaboration_ids
+    deleted_group_identifiers = [_state_before(a, "identifier") for a in deletion_audit_logs
+                                 if (a.target_id in deleted_collaboration_ids if a.target_type == "collaborations"
+                                     else a.parent_id in scope_collaboration_ids)]
+    disconnected_collaborations = Collaboration.query \
+        .filter(Collaboration.id.in_(disconnected_collaboration_ids)) \
+        .all()
+    for collaboration in disconnected_collaborations:
+        deleted_group_identifiers += [collaboration.identifier] + [g.identifier for g in collaboration.groups]
+
+    # The ssh_keys of a user are part of the SCIM user
+    changed_user_ids = {a.subject_id for a in _audit_logs_since(since, AuditLog.target_type == "ssh_keys")}
+    changed_user_ids.update(db.session.execute(select(User.id).where(User.updated_at >= since)).scalars())
+    member_users = [m.user for group in collaborations + groups for m in group.collaboration_memberships
+                    if m.is_active()]
+    users = load_scim_users(unique_model_objects(_users_with_access(collaboration_ids, changed_user_ids) + member_users))
+
+    # Users that left a collaboration of the service or were deleted may have lost access to the service
+    membership_audit_logs = _audit_logs_since(since, AuditLog.target_type.in_(["collaboration_memberships", "users"]),
+                                              AuditLog.action == ACTION_DELETE)
+    left_user_ids = {a.subject_id for a in membership_audit_logs if a.target_type == "collaboration_memberships"
+                     and a.parent_id in scope_collaboration_ids}
+    deleted_users = {a.target_id: _state_before(a, "external_id") for a in membership_audit_logs
+                     if a.target_type == "users"}
+    provisioned_users = stored_fingerprints(service, SCIM_USERS,
+                                            [external_id for external_id in deleted_users.values() if external_id])
+    deleted_user_external_ids = [external_id for user_id, external_id in deleted_users.items()
+                                 if user_id in left_user_ids or provisioned_users.get(external_id)]
+    candidate_user_ids = left_user_ids - deleted_users.keys()
+    candidate_user_ids.update(m.user_id for co in disconnected_collaborations for m in co.collaboration_memberships)
+    # The users with access through another owner are not deleted
+    users_with_access = {user.id for user in _users_with_access(owner_collaboration_ids, candidate_user_ids)}
+    deleted_user_external_ids += [user.external_id for user in User.query.filter(User.id.in_(candidate_user_ids))
+                                  if user.id not in users_with_access]
+
+    return {
+        "users": users,
+        "groups": collaborations + groups,
+        "deleted_group_identifiers": [identifier for identifier in dict.fromkeys(deleted_group_identifiers)
+                                      if identifier],
+        "deleted_user_external_ids": [external_id for external_id in dict.fromkeys(deleted_user_external_ids)
+                                      if external_id]
+    }
+
+
+def _users_with_access(collaboration_ids, user_ids):
+    if not user_ids or not collaboration_ids:
+        return []
+    return User.query \
+        .join(User.collaboration_memberships) \
+        .filter(CollaborationMembership.collaboration_id.in_(collaboration_ids)) \
+        .filter(User.id.in_(user_ids)) \
+        .distinct() \
+        .all()
@@ -1,4 +1,5 @@
 SCIM_API_MESSAGES = "urn:ietf:params:scim:api:messages:2.0"
+SCIM_PATCH_OP = f"{SCIM_API_MESSAGES}:PatchOp"
 
 SCIM_SCHEMA_CORE = "urn:ietf:params:scim:schemas:core:2.0"
 SCIM_SCHEMA_CORE_USER = f"{SCIM_SCHEMA_CORE}:User"
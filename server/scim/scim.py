@@ -1,9 +1,12 @@
+import json
 import logging
 import urllib.parse
 import requests
 
 from functools import wraps
-from typing import Union, List, Optional, Sequence
+from typing import Union, List, Optional, Sequence, Dict
+
+from flask import g as request_context, current_app
 
 from server.api.base import application_base_url
 from server.auth.tokens import decrypt_scim_bearer_token
@@ -12,22 +15,48 @@ from server.db.domain import Service, User, Group, Collaboration, Organisation
 from server.db.models import flatten, unique_model_objects
 from server.logger.context_logger import ctx_logger
 from server.scim import EXTERNAL_ID_POST_FIX, SCIM_USERS, SCIM_GROUPS
-from server.scim.group_template import update_group_template, create_group_template, scim_member_object
+from server.scim.fingerprint import user_fingerprint, group_fingerprint, is_unchanged, store_fingerprint, \
+    store_fingerprints
+from server.scim.group_template import update_group_template, create_group_template, scim_member_object, \
+    patch_group_template
+from server.scim.session import normalize_endpoint_url, scim_session
 from server.scim.user_template import create_user_template, update_user_template, replace_none_values
 
 # (connect_timeout, read_timeout) — split tuple avoids blocking the single SCIM worker indefinitely
 SCIM_TIMEOUT = (3.05, 15)
 
+# Maximum number of externalId's combined with "or" in one filter, when resolving the members of a group
+SCIM_FILTER_CHUNK_SIZE = 50
+
+# Seconds the ServiceProviderConfig of a remote SCIM server is cached, and the shorter period after a failed retrieval
+SCIM_SERVICE_PROVIDER_CONFIG_TTL = 24 * 60 * 60
+SCIM_SERVICE_PROVIDER_CONFIG_FAILURE_TTL = 5 * 60
+# Limits of a bulk request for remote SCIM servers that don't advertise them
+SCIM_BULK_MAX_OPERATIONS = 1000
+SCIM_BULK_MAX_PAYLOAD_SIZE = 1024 * 1024
+# Status codes and scimTypes of a 400 of a PATCH not understood by the remote SCIM server, which then falls back to the
+# full PUT. Other errors - e.g. an invalidValue - are errors of the group itself, see
+# https://www.rfc-editor.org/rfc/rfc7644#section-3.5.2
+SCIM_PATCH_UNSUPPORTED = [405, 501]
+SCIM_PATCH_UNSUPPORTED_SCIM_TYPES = ["invalidSyntax", "noTarget"]
+
 
+# Returns whether the change was delivered, False if it is worth a retry
 def apply_change(f):
     @wraps(f)
     def wrapper(app, *args, **kwargs):
         try:
             with app.app_context():
                 f(app, *args, **kwargs)
+                return not request_context.get("scim_retryable_errors")
+        except requests.RequestException as e:
+            logger = logging.getLogger("scim")
+            logger.error(f"Error during SCIM exchange, will be retried ({str(e)})")
+            return False
         except Exception as e:
             logger = logging.getLogger("scim")
             logger.error(f"Error (absorbed) during SCIM exchange ({str(e)})")
+            return True
         finally:
             with app.app_context():
                 db.session.rollback()
@@ -50,6 +79,9 @@ def _log_scim_error(response, service, outside_user_context, extra_logging):
 def validate_response(response, service, outside_user_context=False, extra_logging=None):
     if not response or response.status_code > 204:
         _log_scim_error(response, service, outside_user_context, extra_logging)
+        if response is not None and (response.status_code >= 500 or response.status_code == 429):
+            # Server errors and throttling of the remote SCIM server are temporary, see apply_change
+            request_context.setdefault("scim_retryable_errors", []).append(response.status_code)
         return False
     return True
 
@@ -89,7 +121,8 @@ def _has_user_service_access(user: User, service: Service, collaboration_to_excl
 # If the user is known in the remote SCIM then update the user else provision the user in the remote SCIM
 def _provision_user(scim_object, service: Service, user: User):
     scim_dict = update_user_template(user, scim_object["id"]) if scim_object else create_user_template(user)
-    request_method = requests.put if scim_object else requests.post
+    session = scim_session(service.scim_url)
+    request_method = session.put if scim_object else session.post
     postfix = scim_object['meta']['location'] if scim_object else "/Users"
     url = f"{service.scim_url}{postfix}"
     return request_method(url, json=replace_none_values(scim_dict), headers=scim_headers(service), timeout=SCIM_TIMEOUT)
@@ -98,42 +131,188 @@ def _provision_user(scim_object, service: Service, user: User):
 # If the group / collaboration is known in the remote SCIM then update the group else provision the group
 def _provision_group(scim_object, service: Service, group: Union[Group, Collaboration]):
     membership_scim_objects = membership_user_scim_objects(service, group)
+    # The member delta can only be computed if the remote SCIM returns the members of the group
+    if scim_object and "members" in scim_object and scim_service_provider_config(service)["patch"]["supported"]:
+        patch_dict = patch_group_template(group, membership_scim_objects, scim_object)
+        if patch_dict is None:
+            return None
+        url = f"{service.scim_url}{scim_object['meta']['location']}"
+        response = scim_session(service.scim_url).patch(url, json=patch_dict, headers=scim_headers(service),
+                                                        timeout=SCIM_TIMEOUT)
+        if not _patch_unsupported(response):
+            return response
+        logger = logging.getLogger("scim")
+        logger.warning(f"Scim endpoint {service.scim_url} rejected the PATCH of group {group.global_urn} with "
+                       f"{response.status_code}, using PUT")
+        # PATCH is not used until the advertised ServiceProviderConfig is retrieved again
+        current_app.redis_client.set(_service_provider_config_key(service),
+                                     json.dumps({**scim_service_provider_config(service), "patch": {"supported": False}}),
+                                     keepttl=True)
     if scim_object:
         scim_dict = update_group_template(group, membership_scim_objects, scim_object["id"])
     else:
         scim_dict = create_group_template(group, membership_scim_objects)
-    request_method = requests.put if scim_object else requests.post
+    session = scim_session(service.scim_url)
+    request_method = session.put if scim_object else session.post
     postfix = scim_object['meta']['location'] if scim_object else "/Groups"
     url = f"{service.scim_url}{postfix}"
     return request_method(url, json=replace_none_values(scim_dict), headers=scim_headers(service), timeout=SCIM_TIMEOUT)
 
 
+def _patch_unsupported(response) -> bool:
+    if response.status_code in SCIM_PATCH_UNSUPPORTED:
+        return True
+    if response.status_code != 400:
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and body.get("scimType") in SCIM_PATCH_UNSUPPORTED_SCIM_TYPES
+
+
+def _service_provider_config_key(service: Service):
+    return f"scim_service_provider_config_{service.id}_{normalize_endpoint_url(service.scim_url)}"
+
+
+def _store_service_provider_config(service: Service, config: dict, expiry: int):
+    current_app.redis_client.set(_service_provider_config_key(service), json.dumps(config), ex=expiry)
+
+
+def _positive_int(value, default: int) -> int:
+    try:
+        return int(value) if int(value) > 0 else default
+    except (TypeError, ValueError):
+        return default
+
+
+def scim_service_provider_config(service: Service) -> dict:
+    """
+    The PATCH and bulk support of the remote SCIM server according to its ServiceProviderConfig, cached per service
+    in redis. A remote SCIM server without a (valid) ServiceProviderConfig supports neither.
+    """
+    cached = current_app.redis_client.get(_service_provider_config_key(service))
+    if cached is not None:
+        return json.loads(cached)
+    remote_config = {}
+    expiry = SCIM_SERVICE_PROVIDER_CONFIG_FAILURE_TTL
+    try:
+        url = f"{service.scim_url}/ServiceProviderConfig"
+        response = scim_session(service.scim_url).get(url, headers=scim_headers(service), timeout=SCIM_TIMEOUT)
+        if response.status_code == 200:
+            remote_config = response.json()
+        if response.status_code < 500:
+            expiry = SCIM_SERVICE_PROVIDER_CONFIG_TTL
+    except (requests.RequestException, ValueError) as e:
+        logger = logging.getLogger("scim")
+        logger.warning(f"Error retrieving the ServiceProviderConfig of {service.scim_url} ({str(e)})")
+    bulk = remote_config.get("bulk") or {}
+    config = {
+        "patch": {"supported": bool((remote_config.get("patch") or {}).get("supported"))},
+        "bulk": {"supported": bool(bulk.get("supported")),
+                 "maxOperations": _positive_int(bulk.get("maxOperations"), SCIM_BULK_MAX_OPERATIONS),
+                 "maxPayloadSize": _positive_int(bulk.get("maxPayloadSize"), SCIM_BULK_MAX_PAYLOAD_SIZE)}
+    }
+    _store_service_provider_config(service, config, expiry)
+    return config
+
+
 # Get all SCIM members of the group / collaboration and provision new ones
 def membership_user_scim_objects(service: Service, group: Union[Group, Collaboration]):
     base_url = application_base_url()
 
     members = [member for member in group.collaboration_memberships if member.is_active()]
-    result = []
-    for member in members:
-        user = member.user
-        scim_object = _lookup_scim_object(service, SCIM_USERS, user.external_id)
-        if not scim_object:
-            # We need to provision this user first as it is unknown in the remote SCIM DB
-            response = _provision_user(scim_object, service, user)
-            if validate_response(response, service, extra_logging=f"membership {user.username} of"
-                                                                  f" {group.global_urn}"):
-                scim_object = response.json()
-        if scim_object:
-            result.append(scim_member_object(base_url, member, scim_object))
-    return result
+    scim_objects = _lookup_scim_users(service, [member.user.external_id for member in members])
+    # We need to provision the users first that are unknown in the remote SCIM DB
+    unknown_users = [member.user for member in members if not scim_objects.get(member.user.external_id)]
+    provisioned = _provision_users(service, group, unknown_users)
+    _scim_users_cache(service).update(provisioned)
+    store_fingerprints(service, {(SCIM_USERS, user.external_id): user_fingerprint(user) for user in unknown_users
+                                 if user.external_id in provisioned})
+    scim_objects.update(provisioned)
+    return [scim_member_object(base_url, member, scim_objects[member.user.external_id]) for member in members
+            if scim_objects.get(member.user.external_id)]
+
+
+# Provision the users in the remote SCIM DB - with bulk requests if supported - and return them by external_id
+def _provision_users(service: Service, group: Union[Group, Collaboration], users: List[User]) -> Dict[str, dict]:
+    provisioned = {}
+    if len(users) > 1 and scim_service_provider_config(service)["bulk"]["supported"]:
+        from server.scim.bulk import BulkExecutor
+
+        def created(user):
+            return lambda response: provisioned.update({user.external_id: response.json()})
+
+        executor = BulkExecutor(service, outside_user_context=False)
+        for user in users:
+            scim_dict = replace_none_values(create_user_template(user))
+            executor.submit("POST", f"{service.scim_url}/{SCIM_USERS}", created(user),
+                            f"membership {user.username} of {group.global_urn}", json=scim_dict,
+                            bulk_id=user.external_id)
+        executor.join()
+        return provisioned
+    for user in users:
+        response = _provision_user(None, service, user)
+        if validate_response(response, service, extra_logging=f"membership {user.username} of"
+                                                              f" {group.global_urn}"):
+            provisioned[user.external_id] = response.json()
+    return provisioned
+
+
+# The remote SCIM users by external_id of the service, cached for the application context of one broadcast
+def _scim_users_cache(service: Service) -> dict:
+    return request_context.setdefault("scim_users_cache", {}).setdefault(service.id, {})
+
+
+def _evict_scim_user(service: Service, external_id: str):
+    _scim_users_cache(service).pop(external_id, None)
+
+
+# Do a lookup of the users in the external SCIM DB with one "or" filter for each chunk of external_ids
+def _lookup_scim_users(service: Service, external_ids: List[str], outside_user_context=False) -> Dict[str, dict]:
+    cache = _scim_users_cache(service)
+    or_filter_rejected = request_context.setdefault("scim_or_filter_rejected", set())
+    unresolved = [external_id for external_id in dict.fromkeys(external_ids) if external_id not in cache]
+    for i in range(0, len(unresolved), SCIM_FILTER_CHUNK_SIZE):
+        chunk = unresolved[i:i + SCIM_FILTER_CHUNK_SIZE]
+        scim_objects = None
+        if len(chunk) > 1 and service.id not in or_filter_rejected:
+            scim_objects = _lookup_scim_users_chunk(service, chunk, outside_user_context)
+            if scim_objects is None:
+                or_filter_rejected.add(service.id)
+        if scim_objects is None:
+            scim_objects = {external_id: _lookup_scim_object(service, SCIM_USERS, external_id, outside_user_context)
+                            for external_id in chunk}
+        cache.update({external_id: scim_object for external_id, scim_object in scim_objects.items() if scim_object})
+    return {external_id: cache.get(external_id) for external_id in external_ids}
+
+
+# Returns None if the remote SCIM server rejects the "or" filter
+def _lookup_scim_users_chunk(service: Service, external_ids: List[str],
+                             outside_user_context=False) -> Optional[Dict[str, dict]]:
+    query_filter = " or ".join(f"externalId eq \"{external_id}{EXTERNAL_ID_POST_FIX}\"" for external_id in external_ids)
+    url = f"{service.scim_url}/{SCIM_USERS}?filter={urllib.parse.quote(query_filter)}&count={len(external_ids)}"
+    response = scim_session(service.scim_url).get(url, headers=scim_headers(service), timeout=SCIM_TIMEOUT)
+    if response.status_code == 400:
+        # invalidFilter or tooMany, see https://www.rfc-editor.org/rfc/rfc7644#section-3.12
+        logger = logging.getLogger("scim")
+        logger.warning(f"Scim endpoint {service.scim_url} rejected the externalId 'or' filter, using single lookups")
+        return None
+    if not validate_response(response, service, outside_user_context=outside_user_context,
+                             extra_logging=f"lookup {SCIM_USERS} {len(external_ids)} users"):
+        return {}
+    resources = response.json().get("Resources", [])
+    scim_objects = {r.get("externalId", "").replace(EXTERNAL_ID_POST_FIX, ""): r for r in resources}
+    return {external_id: scim_objects.get(external_id) for external_id in external_ids}
 
 
 # Do a lookup of the user or group in the external SCIM DB belonging to this service
-def _lookup_scim_object(service: Service, scim_type: str, external_id: str):
+def _lookup_scim_object(service: Service, scim_type: str, external_id: str, outside_user_context=False):
     query_filter = f"externalId eq \"{external_id}{EXTERNAL_ID_POST_FIX}\""
     url = f"{service.scim_url}/{scim_type}?filter={urllib.parse.quote(query_filter)}"
-    response = requests.get(url, headers=scim_headers(service), timeout=SCIM_TIMEOUT)
-    if not validate_response(response, service, extra_logging=f"lookup {scim_type} {external_id}"):
+    response = scim_session(service.scim_url).get(url, headers=scim_headers(service), timeout=SCIM_TIMEOUT)
+    if not validate_response(response, service, outside_user_context=outside_user_context,
+                             extra_logging=f"lookup {scim_type} {external_id}"):
         return None
     scim_json = response.json()
     return None if scim_json["totalResults"] == 0 else scim_json["Resources"][0]
@@ -147,18 +326,26 @@ def _do_apply_user_change(user: User, service: Union[None, Service], deletion: b
         collaborations = [member.collaboration for member in user.collaboration_memberships if member.is_active()]
         scim_services = _all_unique_scim_services_of_collaborations(collaborations)
 
+    fingerprint = None if deletion else user_fingerprint(user)
     for service in scim_services:
+        # No use to push the user if the remote system already accepted the same payload
+        if fingerprint and is_unchanged(service, SCIM_USERS, user.external_id, fingerprint):
+            continue
         response = None
         scim_object = _lookup_scim_object(service, SCIM_USERS, user.external_id)
         # No use to delete the user if the user is unknown in the remote system
         if deletion:
             if scim_object:
                 url = f"{service.scim_url}{scim_object['meta']['location']}"
-                response = requests.delete(url, headers=scim_headers(service, is_delete=True), timeout=SCIM_TIMEOUT)
+                response = scim_session(service.scim_url).delete(url, headers=scim_headers(service, is_delete=True),
+                                                                 timeout=SCIM_TIMEOUT)
+                _evict_scim_user(service, user.external_id)
+            store_fingerprint(service, SCIM_USERS, user.external_id, None)
         else:
             response = _provision_user(scim_object, service, user)
-        if response:
-            validate_response(response, service, extra_logging=f"user={user.username}, delete={deletion}")
+        if response and validate_response(response, service,
+                                          extra_logging=f"user={user.username}, delete={deletion}"):
+            store_fingerprint(service, SCIM_USERS, user.external_id, fingerprint)
 
 
 def _all_unique_scim_services_of_collaborations(collaborations):
@@ -169,14 +356,20 @@ def _all_unique_scim_services_of_collaborations(collaborations):
 
 def _do_apply_group_collaboration_change(group: Union[Group, Collaboration], services: List[Service], deletion: bool):
     scim_services = _unique_scim_services(services)
-    response = None
+    fingerprint = None if deletion else group_fingerprint(group)
     for service in scim_services:
+        # No use to push the group if the remote system already accepted the same payload
+        if fingerprint and is_unchanged(service, SCIM_GROUPS, group.identifier, fingerprint):
+            continue
+        response = None
         scim_object = _lookup_scim_object(service, SCIM_GROUPS, group.identifier)
         if deletion:
+            store_fingerprint(service, SCIM_GROUPS, group.identifier, None)
             # No use to delete the group if the group is unknown in the remote system
             if scim_object:
                 url = f"{service.scim_url}{scim_object['meta']['location']}"
-                response = requests.delete(url, headers=scim_headers(service, is_delete=True), timeout=SCIM_TIMEOUT)
+                response = scim_session(service.scim_url).delete(url, headers=scim_headers(service, is_delete=True),
+                                                                 timeout=SCIM_TIMEOUT)
                 if isinstance(group, Collaboration):
                     for co_group in group.groups:
                         _do_apply_group_collaboration_change(co_group, services=scim_services, deletion=True)
@@ -185,8 +378,20 @@ def _do_apply_group_collaboration_change(group: Union[Group, Collaboration], ser
                             _do_apply_user_change(user, service=service, deletion=True)
         else:
             response = _provision_group(scim_object, service, group)
-        if response:
-            validate_response(response, service, extra_logging=f"group={group.global_urn} delete={deletion}")
+            # A PATCH without changes is not sent, so the remote group is up-to-date
+            if response is None and scim_object:
+                _store_group_fingerprint(service, group, fingerprint)
+        if response and validate_response(response, service,
+                                          extra_logging=f"group={group.global_urn} delete={deletion}"):
+            _store_group_fingerprint(service, group, fingerprint)
+
+
+# The group is only up-to-date in the remote system if all its members are provisioned
+def _store_group_fingerprint(service: Service, group: Union[Group, Collaboration], fingerprint: Optional[str]):
+    scim_users = _scim_users_cache(service)
+    if fingerprint and all(member.user.external_id in scim_users for member in group.collaboration_memberships
+                           if member.is_active()):
+        store_fingerprint(service, SCIM_GROUPS, group.identifier, fingerprint)
 
 
 # User has been updated. Propagate the changes to the remote SCIM DB to all connected SCIM services
@@ -210,12 +415,15 @@ def apply_user_deletion(app, external_id, collaboration_identifiers: List[int],
     scim_services = _filter_services_by_ids(
         _all_unique_scim_services_of_collaborations(collaborations), service_ids)
     for service in scim_services:
+        store_fingerprint(service, SCIM_USERS, external_id, None)
         scim_object = _lookup_scim_object(service, SCIM_USERS, external_id)
         # No use to delete the user if the user is unknown in the remote system
         if scim_object:
             url = f"{service.scim_url}{scim_object['meta']['location']}"
-            response = requests.delete(url, headers=scim_headers(service, is_delete=True), timeout=SCIM_TIMEOUT)
+            response = scim_session(service.scim_url).delete(url, headers=scim_headers(service, is_delete=True),
+                                                             timeout=SCIM_TIMEOUT)
             validate_response(response, service, extra_logging=f"user={external_id}, delete=True")
+            _evict_scim_user(service, external_id)
     for co in collaborations:
         services = _filter_services_by_ids(_all_unique_scim_services_of_collaborations([co]), service_ids)
         if not services:
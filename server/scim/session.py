@@ -0,0 +1,126 @@
+import threading
+import time
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from server.scim.circuit_breaker import circuit_breaker, CircuitOpenError
+from server.scim.metrics import Histogram, prometheus_text
+
+# Upper bound of the pooled connections per SCIM endpoint, shared by all services with the same endpoint
+SCIM_POOL_MAXSIZE = 32
+
+# The outcomes of a SCIM request: a response, a server error or throttling response, no response at all - e.g. a
+# timeout - and not sent, because the circuit of the endpoint is open
+REQUEST_SUCCESS = "success"
+REQUEST_FAILURE = "failure"
+REQUEST_ERROR = "error"
+REQUEST_REJECTED = "rejected"
+_request_outcomes = [REQUEST_SUCCESS, REQUEST_FAILURE, REQUEST_ERROR, REQUEST_REJECTED]
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+class _RequestMetrics:
+    __slots__ = ("outcomes", "seconds")
+
+    def __init__(self):
+        self.outcomes = dict.fromkeys(_request_outcomes, 0)
+        # The requests which were sent, from the send until the response or the exception
+        self.seconds = Histogram()
+
+
+_request_metrics: Dict[str, _RequestMetrics] = {}
+_request_metrics_lock = threading.Lock()
+
+
+def _record_request(endpoint: str, outcome: str, seconds: Optional[float] = None):
+    with _request_metrics_lock:
+        metrics = _request_metrics.get(endpoint)
+        if metrics is None:
+            metrics = _request_metrics[endpoint] = _RequestMetrics()
+        metrics.outcomes[outcome] += 1
+        if seconds is not None:
+            metrics.seconds.observe(seconds)
+
+
+def normalize_endpoint_url(scim_url: str) -> str:
+    if not scim_url:
+        return ""
+    parsed = urlparse(scim_url)
+    base = f"{parsed.scheme}://{parsed.netloc}{parsed.path.rstrip('/')}"
+    if parsed.query:
+        base += f"?{parsed.query}"
+    return base
+
+
+class CircuitBreakerAdapter(HTTPAdapter):
+    """
+    Sends the requests to a SCIM endpoint through the circuit breaker of the endpoint, and records the outcome and
+    latency of each request
+    """
+
+    def __init__(self, endpoint: str, **kwargs):
+        self.endpoint = endpoint
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        breaker = circuit_breaker(self.endpoint)
+        if breaker is not None and not breaker.allow_request():
+            _record_request(self.endpoint, REQUEST_REJECTED)
+            raise CircuitOpenError(f"Circuit of SCIM endpoint {self.endpoint} is open", request=request)
+        outcome = REQUEST_ERROR
+        started_at = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+            # Server errors and throttling count as failures, like the retryable errors of validate_response
+            success = response.status_code < 500 and response.status_code != 429
+            outcome = REQUEST_SUCCESS if success else REQUEST_FAILURE
+            return response
+        finally:
+            _record_request(self.endpoint, outcome, time.monotonic() - started_at)
+            if breaker is not None:
+                breaker.record(outcome == REQUEST_SUCCESS)
+
+
+def scim_session(scim_url: str) -> requests.Session:
+    """Return the keep-alive session with pooled connections for the SCIM endpoint of the scim_url"""
+    endpoint = normalize_endpoint_url(scim_url)
+    with _sessions_lock:
+        session = _sessions.get(endpoint)
+        if session is None:
+            session = requests.Session()
+            adapter = CircuitBreakerAdapter(endpoint, pool_connections=1, pool_maxsize=SCIM_POOL_MAXSIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[endpoint] = session
+        return session
+
+
+def scim_request_metrics() -> List[dict]:
+    """The number of requests per outcome and the latency histogram of the SCIM endpoints contacted by this process"""
+    with _request_metrics_lock:
+        return [{"endpoint": endpoint,
+                 "requests": sum(metrics.outcomes.values()),
+                 **metrics.outcomes,
+                 "seconds": metrics.seconds.snapshot()}
+                for endpoint, metrics in sorted(_request_metrics.items())]
+
+
+def reset_scim_request_metrics():
+    with _request_metrics_lock:
+        _request_metrics.clear()
+
+
+def prometheus_request_metrics(metrics: List[dict], prefix: str = "scim_requests") -> str:
+    """Render the SCIM request metrics in the Prometheus text exposition format"""
+    return prometheus_text(metrics, prefix, "endpoint",
+                           counters=[(REQUEST_SUCCESS, "Number of requests with a successful or client error response"),
+                                     (REQUEST_FAILURE, "Number of requests with a server error or throttling "
+                                                       "response"),
+                                     (REQUEST_ERROR, "Number of requests without a response"),
+                                     (REQUEST_REJECTED, "Number of requests not sent, because the circuit is open")],
+                           histograms=[("seconds", "Time between sending a request and its response or error")])
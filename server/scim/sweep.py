@@ -1,15 +1,24 @@
 import base64
-from typing import List, Union
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
-import requests
+from flask import current_app
 from werkzeug.exceptions import BadRequest
 
 from server.api.base import application_base_url
+from server.auth.tokens import decrypt_scim_bearer_token
 from server.db.domain import Service, Group, User, Collaboration
+from server.db.models import unique_model_objects
 from server.scim import EXTERNAL_ID_POST_FIX, SCIM_GROUPS, SCIM_USERS
+from server.scim.bulk import BulkExecutor, bulk_supported, bulk_id_reference, BULK_ID_REFERENCE
+from server.scim.events import _group_services_by_endpoint
+from server.scim.fingerprint import Fingerprints, user_fingerprint, group_fingerprint, stored_fingerprints, \
+    store_fingerprints
 from server.scim.group_template import create_group_template, update_group_template, scim_member_object
-from server.scim.repo import all_scim_groups_by_service, all_scim_users_by_service
-from server.scim.scim import scim_headers, validate_response
+from server.scim.repo import all_scim_groups_by_service, all_scim_users_by_service, changed_scim_objects_by_service
+from server.scim.scim import scim_headers, validate_response, _lookup_scim_users, _lookup_scim_object
+from server.scim.session import scim_session
 from server.scim.user_template import create_user_template, replace_none_values, update_user_template, \
     inactive_days
 
@@ -17,6 +26,9 @@ CONNECTION_TIMEOUT = 3.05  # seconds
 READ_TIMEOUT = 10  # seconds
 TIMEOUT = (CONNECTION_TIMEOUT, READ_TIMEOUT)
 
+DEFAULT_SWEEP_CONCURRENCY = 4
+DEFAULT_SCIM_PAGE_SIZE = 100
+
 
 def _replace_empty_string_values(d: dict):
     for k, v in d.items():
@@ -71,7 +83,9 @@ def _user_changed(user: User, remote_user: dict):
     return False
 
 
-def _group_changed(group: Union[Group, Collaboration], remote_group: dict, remote_scim_users: List[dict]):
+# With partial_remote_users, a remote member that is not one of the remote_scim_users is no longer a member in SBS
+def _group_changed(group: Union[Group, Collaboration], remote_group: dict, remote_scim_users: List[dict],
+                   partial_remote_users=False):
     from server.scim.schema_template import get_scim_schema_sram_group
 
     def link_is_different(name: str, value: str):
@@ -93,6 +107,8 @@ def _group_changed(group: Union[Group, Collaboration], remote_group: dict, remot
         remote_user = remote_users_by_id.get(remote_member["value"])
         if remote_user:
             remote_members.append(remote_user["externalId"].replace(EXTERNAL_ID_POST_FIX, ""))
+        elif partial_remote_users:
+            return True
     if sram_members != sorted(remote_members):
         return True
     if get_scim_schema_sram_group() in remote_group:
@@ -115,23 +131,58 @@ def _group_changed(group: Union[Group, Collaboration], remote_group: dict, remot
     return False
 
 
-def _all_remote_scim_objects(service: Service, scim_type):
-    scim_resources = []
-    while True:
-        url = f"{service.scim_url}/{scim_type}?startIndex={len(scim_resources) + 1}"
-        response = requests.get(url, headers=scim_headers(service), timeout=TIMEOUT)
-        if not validate_response(response, service, outside_user_context=True, extra_logging=f"SCIM {scim_type} list"):
-            raise BadRequest(f"Invalid response from remote SCIM server (got HTTP status {response.status_code})")
+def scim_page_size() -> int:
+    return max(1, current_app.app_config.scim_sweep.get("page_size", DEFAULT_SCIM_PAGE_SIZE))
 
-        scim_json = response.json()
-        scim_resources += scim_json["Resources"]
 
-        if scim_json["totalResults"] == len(scim_resources):
-            break
+def _all_remote_scim_objects_by_type(service: Service, scim_types: List[str]) -> Dict[str, List[dict]]:
+    """
+    List all remote SCIM objects of the scim_types. The first page of each type is fetched in parallel and once
+    the totalResults is known, the remaining pages are fetched concurrently. The responses are validated in the
+    calling thread.
+    """
+    session = scim_session(service.scim_url)
+    headers = scim_headers(service)
+    count = scim_page_size()
 
+    def fetch_page(scim_type, start_index):
+        url = f"{service.scim_url}/{scim_type}?startIndex={start_index}&count={count}"
+        return session.get(url, headers=headers, timeout=TIMEOUT)
+
+    def page_json(scim_type, future):
+        response = future.result()
+        if not validate_response(response, service, outside_user_context=True, extra_logging=f"SCIM {scim_type} list"):
+            raise BadRequest(f"Invalid response from remote SCIM server (got HTTP status {response.status_code})")
+        return response.json()
+
+    scim_resources = {}
+    with ThreadPoolExecutor(max_workers=sweep_concurrency(service), thread_name_prefix="scim-list") as executor:
+        first_pages = {scim_type: executor.submit(fetch_page, scim_type, 1) for scim_type in scim_types}
+        for scim_type, first_page in first_pages.items():
+            scim_json = page_json(scim_type, first_page)
+            resources = scim_resources[scim_type] = list(scim_json["Resources"])
+            total_results = scim_json["totalResults"]
+            # Remote SCIM servers may return less than the requested count per page
+            per_page = len(resources)
+            if per_page and total_results > per_page:
+                pages = [executor.submit(fetch_page, scim_type, start_index)
+                         for start_index in range(per_page + 1, total_results + 1, per_page)]
+                for page in pages:
+                    scim_json = page_json(scim_type, page)
+                    resources += scim_json["Resources"]
+            # Short pages - e.g. remote deletions during the listing - are completed one page at the time
+            page_resources = resources
+            while page_resources and len(resources) < scim_json["totalResults"]:
+                scim_json = page_json(scim_type, executor.submit(fetch_page, scim_type, len(resources) + 1))
+                page_resources = scim_json["Resources"]
+                resources += page_resources
     return scim_resources
 
 
+def _all_remote_scim_objects(service: Service, scim_type: str) -> List[dict]:
+    return _all_remote_scim_objects_by_type(service, [scim_type])[scim_type]
+
+
 # Construct the members part of a group create / update
 def _memberships(group: Union[Group, Collaboration], remote_users_by_external_id: dict):
     base_url = application_base_url()
@@ -143,8 +194,73 @@ def _memberships(group: Union[Group, Collaboration], remote_users_by_external_id
     return result
 
 
-def perform_sweep(service: Service):
-    sync_results = {
+# The group is only up-to-date in the remote system if all its members are provisioned, like
+# server.scim.scim._store_group_fingerprint. A member still referenced by its bulkId was not created.
+def _group_fingerprint(group: Union[Group, Collaboration], remote_users_by_external_id: dict) -> Optional[str]:
+    for member in group.collaboration_memberships:
+        remote_user = remote_users_by_external_id.get(member.user.external_id)
+        if member.is_active() and (not remote_user or str(remote_user.get("id")).startswith(BULK_ID_REFERENCE)):
+            return None
+    return group_fingerprint(group)
+
+
+class SweepExecutor:
+    """
+    Send the requests of a sweep with bounded concurrency over the keep-alive session of the SCIM endpoint. The
+    responses are validated and handled in the calling thread - in the order the requests were submitted - when
+    the executor is joined, so the callbacks can safely use the database session.
+    """
+
+    supports_bulk_ids = False
+
+    def __init__(self, service: Service, max_workers: int):
+        self.service = service
+        self.session = scim_session(service.scim_url)
+        self.headers = scim_headers(service)
+        self.delete_headers = scim_headers(service, is_delete=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scim-sweep")
+        self._pending = []
+        # Number of requests that failed, the objects are reconciled again by a later sweep
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    # The bulk_id is only used by the BulkExecutor
+    def submit(self, method: str, url: str, on_success: Callable, extra_logging: str, json: dict = None,
+               bulk_id: str = None):
+        headers = self.delete_headers if method == "DELETE" else self.headers
+        future = self._executor.submit(self.session.request, method, url, json=json, headers=headers,
+                                       timeout=TIMEOUT)
+        self._pending.append((future, on_success, extra_logging))
+
+    def join(self):
+        pending, self._pending = self._pending, []
+        for future, on_success, extra_logging in pending:
+            response = future.result()
+            if validate_response(response, self.service, outside_user_context=True, extra_logging=extra_logging):
+                on_success(response)
+            else:
+                self.failed += 1
+
+
+def sweep_concurrency(service: Service) -> int:
+    default_concurrency = current_app.app_config.scim_sweep.get("concurrency", DEFAULT_SWEEP_CONCURRENCY)
+    return max(1, service.sweep_scim_concurrency or default_concurrency)
+
+
+# Use /Bulk requests if the remote SCIM server supports them
+def _sweep_executor(service: Service) -> Union[SweepExecutor, BulkExecutor]:
+    if bulk_supported(service):
+        return BulkExecutor(service)
+    return SweepExecutor(service, sweep_concurrency(service))
+
+
+def _sync_results_container(service: Service):
+    return {
         "users": {
             "deleted": [],
             "created": [],
@@ -155,41 +271,247 @@ def perform_sweep(service: Service):
             "created": [],
             "updated": []
         },
-        "scim_url": service.scim_url
+        "scim_url": service.scim_url,
+        "failed": 0
     }
-    all_groups = all_scim_groups_by_service(service)
-    all_users = all_scim_users_by_service(service)
 
-    groups_by_identifier = {group.identifier: group for group in all_groups}
-    users_by_external_id = {user.external_id: user for user in all_users}
+
+def perform_sweep(service: Service):
+    """
+    Sweep only the service. The users and groups of the services sharing its remote SCIM state - see
+    services_sharing_remote_state - are not deleted, but neither reconciled nor reported, and their fingerprints are
+    kept.
+    """
+    return _sweep(services_sharing_remote_state(service), [service])[service.id]
+
+
+def sweep_enabled_services() -> List[Service]:
+    return Service.query \
+        .filter(Service.scim_enabled == True) \
+        .filter(Service.sweep_scim_enabled == True) \
+        .all()  # noqa: E712
+
+
+def services_sharing_remote_state(service: Service) -> List[Service]:
+    """
+    The service and the sweep enabled services sharing its remote SCIM state. The remote users and groups of all
+    these services are never deleted by the sweep of the service.
+    """
+    others = [s for s in sweep_enabled_services() if s.id != service.id]
+    return next(services for services in group_services_by_remote_state([service] + others) if service in services)
+
+
+def group_services_by_remote_state(services: List[Service]) -> List[List[Service]]:
+    """
+    Group the services by the remote SCIM state they share: the same normalized endpoint and bearer token
+    """
+    services_by_id = {service.id: service for service in services}
+    grouped = []
+    for service_ids in _group_services_by_endpoint(services).values():
+        services_by_token = {}
+        for service_id in service_ids:
+            service = services_by_id[service_id]
+            try:
+                token = decrypt_scim_bearer_token(service)
+            except Exception:
+                # The error is reported by the sweep of the service itself
+                token = f"service-{service.id}"
+            services_by_token.setdefault(token, []).append(service)
+        grouped += services_by_token.values()
+    # Services without a SCIM url are swept - and fail - on their own
+    grouped_ids = {service.id for services in grouped for service in services}
+    return grouped + [[service] for service in services if service.id not in grouped_ids]
+
+
+def perform_endpoint_sweep(services: List[Service]) -> Dict[int, dict]:
+    """
+    Sweep the services that share one remote SCIM state - see group_services_by_remote_state - in one pass. The
+    remote users and groups are fetched once and reconciled with the users and groups of all the services. The
+    sync results are returned by service id, where the deletions of remote objects unknown to all the services are
+    reported for each service.
+    """
+    return _sweep(services, services)
+
+
+def _sweep(services: List[Service], swept_services: List[Service]) -> Dict[int, dict]:
+    # The remote objects of all services are kept, only those of the swept services are reconciled
+    service = swept_services[0]
+    swept_ids = {s.id for s in swept_services}
+    results_by_service = {s.id: _sync_results_container(s) for s in swept_services}
+    owners = {}
+    groups_by_identifier, users_by_external_id = {}, {}
+    all_groups, all_users = [], []
+    for s in services:
+        groups = all_scim_groups_by_service(s)
+        users = all_scim_users_by_service(s)
+        for group in groups:
+            owners.setdefault((SCIM_GROUPS, group.identifier), []).append(s.id)
+        for user in users:
+            owners.setdefault((SCIM_USERS, user.external_id), []).append(s.id)
+        # Collaborations and groups share the id's, but not the identifiers
+        groups_by_identifier.update({group.identifier: group for group in groups})
+        users_by_external_id.update({user.external_id: user for user in users})
+        if s.id in swept_ids:
+            all_groups += groups
+            all_users += users
+    all_groups = list({group.identifier: group for group in all_groups}.values())
+    all_users = unique_model_objects(all_users)
+    record = _results_recorder(results_by_service, owners)
     try:
-        remote_scim_groups = _all_remote_scim_objects(service, SCIM_GROUPS)
-        remote_scim_users = _all_remote_scim_objects(service, SCIM_USERS)
+        remote_scim_objects = _all_remote_scim_objects_by_type(service, [SCIM_GROUPS, SCIM_USERS])
+        remote_scim_groups = remote_scim_objects[SCIM_GROUPS]
+        remote_scim_users = remote_scim_objects[SCIM_USERS]
     except BadRequest as e:
         # We abort, see https://github.com/SURFscz/SBS/issues/601 and reraise the exception
         raise e
 
+    # Orphaned groups are only removed if all services agree
+    remove_orphans = all(s.sweep_remove_orphans for s in services)
+    fingerprints: Fingerprints = {}
+    with _sweep_executor(service) as executor:
+        _sweep_deletions(service, executor, record, remote_scim_groups, remote_scim_users,
+                         groups_by_identifier, users_by_external_id)
+        # The deletions must be done before users with the same userName are created
+        executor.join()
+
+        remote_groups_by_external_id = {g.get("externalId", "").replace(EXTERNAL_ID_POST_FIX, ""): g for g in
+                                        remote_scim_groups}
+        remote_users_by_external_id = {u.get("externalId", "").replace(EXTERNAL_ID_POST_FIX, ""): u for u in
+                                       remote_scim_users}
+
+        _sweep_users(service, executor, record, all_users, remote_users_by_external_id, fingerprints)
+        if not executor.supports_bulk_ids:
+            # The users must be created before the groups that reference them
+            executor.join()
+
+        _sweep_groups(service, executor, record, all_groups, remote_groups_by_external_id,
+                      remote_users_by_external_id, remote_scim_users, fingerprints, remove_orphans)
+        executor.join()
+
+    # The failures on the shared remote state are reported for each swept service
+    for sync_results in results_by_service.values():
+        sync_results["failed"] = executor.failed
+    # The full sweep knows the complete remote state, so all other fingerprints are outdated
+    for s in swept_services:
+        store_fingerprints(s, {key: fingerprint for key, fingerprint in fingerprints.items()
+                               if s.id in owners.get(key, [])}, replace_all=True)
+    return results_by_service
+
+
+# Returns the function recording a sync result for the services owning the SCIM object, or all without a key
+def _results_recorder(results_by_service: Dict[int, dict], owners: Dict[Tuple[str, str], List[int]] = None):
+    def record(scim_type: str, action: str, value, key: str = None):
+        service_ids = owners.get((scim_type, key), []) if owners is not None and key else results_by_service.keys()
+        for service_id in service_ids:
+            if service_id in results_by_service:
+                results_by_service[service_id][scim_type.lower()][action].append(value)
+
+    return record
+
+
+def perform_incremental_sweep(service: Service, since: datetime):
+    """
+    Reconcile only the users and groups that changed in SBS since the given moment. Instead of listing all remote
+    users and groups, the changed ones are looked up by their externalId. Changes that are not tracked by SBS - e.g.
+    the sramInactiveDays of a user or changes made directly in the remote SCIM database - are left to the full sweep.
+    Users and groups of which the remote SCIM server already accepted the same payload are skipped.
+    """
+    sync_results = _sync_results_container(service)
+    changes = changed_scim_objects_by_service(service, since, services_sharing_remote_state(service))
+    users = _changed_since_fingerprint(service, SCIM_USERS, changes["users"], lambda u: u.external_id,
+                                       user_fingerprint)
+    groups = _changed_since_fingerprint(service, SCIM_GROUPS, changes["groups"], lambda g: g.identifier,
+                                        group_fingerprint)
+    if not users and not groups and not changes["deleted_user_external_ids"] \
+            and not changes["deleted_group_identifiers"]:
+        return sync_results
+    # The remote members of the changed groups are needed, also if the member itself did not change
+    member_external_ids = [member.user.external_id for group in groups for member in group.collaboration_memberships
+                           if member.is_active()]
+    external_ids = [user.external_id for user in users] + member_external_ids + changes["deleted_user_external_ids"]
+    remote_users_by_external_id = {external_id: remote_user for external_id, remote_user in
+                                   _lookup_scim_users(service, external_ids, outside_user_context=True).items()
+                                   if remote_user}
+    identifiers = [group.identifier for group in groups] + changes["deleted_group_identifiers"]
+    remote_groups_by_external_id = {identifier: _lookup_scim_object(service, SCIM_GROUPS, identifier, True)
+                                    for identifier in identifiers}
+    remote_groups_by_external_id = {k: v for k, v in remote_groups_by_external_id.items() if v}
+    remote_scim_users = list(remote_users_by_external_id.values())
+    # Members that are not known in the remote SCIM database are provisioned along with the changed users
+    users = unique_model_objects(users + [member.user for group in groups for member in group.collaboration_memberships
+                                          if member.is_active()
+                                          and member.user.external_id not in remote_users_by_external_id])
+
+    record = _results_recorder({service.id: sync_results})
+    fingerprints: Fingerprints = {(SCIM_USERS, external_id): None for external_id in
+                                  changes["deleted_user_external_ids"]}
+    fingerprints.update({(SCIM_GROUPS, identifier): None for identifier in changes["deleted_group_identifiers"]})
+    with _sweep_executor(service) as executor:
+        _sweep_deletions(service, executor, record,
+                         [remote_groups_by_external_id[i] for i in changes["deleted_group_identifiers"]
+                          if i in remote_groups_by_external_id],
+                         [remote_users_by_external_id[e] for e in changes["deleted_user_external_ids"]
+                          if e in remote_users_by_external_id],
+                         {group.identifier: group for group in groups}, {user.external_id: user for user in users})
+        executor.join()
+
+        _sweep_users(service, executor, record, users, remote_users_by_external_id, fingerprints)
+        if not executor.supports_bulk_ids:
+            executor.join()
+
+        _sweep_groups(service, executor, record, groups, remote_groups_by_external_id,
+                      remote_users_by_external_id, remote_scim_users, fingerprints, service.sweep_remove_orphans,
+                      partial_remote_users=True)
+        executor.join()
+
+    sync_results["failed"] = executor.failed
+    store_fingerprints(service, fingerprints)
+    return sync_results
+
+
+def _changed_since_fingerprint(service: Service, scim_type: str, scim_objects: list, external_id: Callable,
+                               fingerprint: Callable) -> list:
+    stored = stored_fingerprints(service, scim_type, [external_id(o) for o in scim_objects])
+    return [o for o in scim_objects if stored[external_id(o)] != fingerprint(o)]
+
+
+def _sweep_deletions(service: Service, executor: SweepExecutor, record: Callable, remote_scim_groups: List[dict],
+                     remote_scim_users: List[dict], groups_by_identifier: dict, users_by_external_id: dict):
+    def deleted(scim_type, url):
+        return lambda _: record(scim_type, "deleted", url)
+
     # First delete all remote users and groups that are incorrectly in the remote SCIM database
     for remote_group in remote_scim_groups:
         if f"{remote_group.get('externalId', '').replace(EXTERNAL_ID_POST_FIX, '')}" not in groups_by_identifier:
             if "meta" in remote_group and "location" in remote_group['meta']:
                 url = f"{service.scim_url}{remote_group['meta']['location']}"
-                response = requests.delete(url, headers=scim_headers(service, is_delete=True), timeout=TIMEOUT)
-                if validate_response(response, service, outside_user_context=True, extra_logging="SCIM group delete"):
-                    sync_results["groups"]["deleted"].append(url)
+                executor.submit("DELETE", url, deleted(SCIM_GROUPS, url), "SCIM group delete")
 
     for remote_user in remote_scim_users:
         if f"{remote_user.get('externalId', '').replace(EXTERNAL_ID_POST_FIX, '')}" not in users_by_external_id:
             if "meta" in remote_user and "location" in remote_user['meta']:
                 url = f"{service.scim_url}{remote_user['meta']['location']}"
-                response = requests.delete(url, headers=scim_headers(service, is_delete=True), timeout=TIMEOUT)
-                if validate_response(response, service, outside_user_context=True, extra_logging="SCIM user delete"):
-                    sync_results["users"]["deleted"].append(url)
+                executor.submit("DELETE", url, deleted(SCIM_USERS, url), "SCIM user delete")
+
+
+def _sweep_users(service: Service, executor: SweepExecutor, record: Callable, all_users: List[User],
+                 remote_users_by_external_id: dict, fingerprints: Fingerprints):
+    def created(user):
+        def on_success(response):
+            # Add the new remote user to the remote_users_by_external_id for membership lookup
+            response_json = response.json()
+            remote_users_by_external_id[user.external_id] = response_json
+            record(SCIM_USERS, "created", response_json, user.external_id)
+            fingerprints[(SCIM_USERS, user.external_id)] = user_fingerprint(user)
+
+        return on_success
 
-    remote_groups_by_external_id = {g.get("externalId", "").replace(EXTERNAL_ID_POST_FIX, ""): g for g in
-                                    remote_scim_groups}
-    remote_users_by_external_id = {u.get("externalId", "").replace(EXTERNAL_ID_POST_FIX, ""): u for u in
-                                   remote_scim_users}
+    def updated(user):
+        def on_success(response):
+            record(SCIM_USERS, "updated", response.json(), user.external_id)
+            fingerprints[(SCIM_USERS, user.external_id)] = user_fingerprint(user)
+
+        return on_success
 
     for user in all_users:
         # Add all SRAM users that are not present in the remote SCIM database
@@ -197,12 +519,11 @@ def perform_sweep(service: Service):
             scim_dict = create_user_template(user)
             url = f"{service.scim_url}/{SCIM_USERS}"
             scim_dict_cleansed = replace_none_values(scim_dict)
-            response = requests.post(url, json=scim_dict_cleansed, headers=scim_headers(service), timeout=TIMEOUT)
-            if validate_response(response, service, outside_user_context=True, extra_logging="SCIM user create"):
-                # Add the new remote user to the remote_users_by_external_id for membership lookup
-                response_json = response.json()
-                remote_users_by_external_id[user.external_id] = response_json
-                sync_results["users"]["created"].append(response_json)
+            executor.submit("POST", url, created(user), "SCIM user create", json=scim_dict_cleansed,
+                            bulk_id=user.external_id)
+            if executor.supports_bulk_ids:
+                # The groups reference the new user by its bulkId until it is created
+                remote_users_by_external_id[user.external_id] = {"id": bulk_id_reference(user.external_id)}
         else:
             remote_user = remote_users_by_external_id.get(user.external_id)
             # Update SRAM users that are not equal to their counterpart in the remote SCIM database
@@ -211,40 +532,43 @@ def perform_sweep(service: Service):
                 if "meta" in remote_user and "location" in remote_user['meta']:
                     url = f"{service.scim_url}{remote_user['meta']['location']}"
                     scim_dict_cleansed = replace_none_values(scim_dict)
-                    response = requests.put(url, json=scim_dict_cleansed, headers=scim_headers(service), timeout=TIMEOUT)
-                    if validate_response(response, service, outside_user_context=True,
-                                         extra_logging="SCIM user update"):
-                        response_json = response.json()
-                        sync_results["users"]["updated"].append(response_json)
+                    executor.submit("PUT", url, updated(user), "SCIM user update", json=scim_dict_cleansed)
+            else:
+                fingerprints[(SCIM_USERS, user.external_id)] = user_fingerprint(user)
+
+
+def _sweep_groups(service: Service, executor: SweepExecutor, record: Callable,
+                  all_groups: List[Union[Group, Collaboration]], remote_groups_by_external_id: dict,
+                  remote_users_by_external_id: dict, remote_scim_users: List[dict], fingerprints: Fingerprints,
+                  remove_orphans: bool, partial_remote_users=False):
+    def handled(group, action, url=None):
+        def on_success(response):
+            record(SCIM_GROUPS, action, url if url else response.json(), group.identifier)
+            fingerprints[(SCIM_GROUPS, group.identifier)] = None if action == "deleted" else \
+                _group_fingerprint(group, remote_users_by_external_id)
+
+        return on_success
 
     for group in all_groups:
         membership_scim_objects = _memberships(group, remote_users_by_external_id)
-        if not membership_scim_objects and service.sweep_remove_orphans:
+        if not membership_scim_objects and remove_orphans:
             remote_group = remote_groups_by_external_id.get(group.identifier)
             if remote_group and "meta" in remote_group and "location" in remote_group["meta"]:
                 url = f"{service.scim_url}{remote_group['meta']['location']}"
-                response = requests.delete(url, headers=scim_headers(service, is_delete=True), timeout=TIMEOUT)
-                if validate_response(response, service, outside_user_context=True, extra_logging="SCIM group delete"):
-                    sync_results["groups"]["deleted"].append(url)
+                executor.submit("DELETE", url, handled(group, "deleted", url), "SCIM group delete")
         elif group.identifier not in remote_groups_by_external_id:
             scim_dict = create_group_template(group, membership_scim_objects)
             url = f"{service.scim_url}/{SCIM_GROUPS}"
             scim_dict_cleansed = replace_none_values(scim_dict)
-            response = requests.post(url, json=scim_dict_cleansed, headers=scim_headers(service), timeout=TIMEOUT)
-            if validate_response(response, service, outside_user_context=True, extra_logging="SCIM group create"):
-                response_json = response.json()
-                sync_results["groups"]["created"].append(response_json)
+            executor.submit("POST", url, handled(group, "created"), "SCIM group create", json=scim_dict_cleansed)
         else:
             remote_group = remote_groups_by_external_id[group.identifier]
-            if _group_changed(group, remote_group, remote_scim_users):
+            if _group_changed(group, remote_group, remote_scim_users, partial_remote_users):
                 scim_dict = update_group_template(group, membership_scim_objects, remote_group["id"])
                 if remote_group and "meta" in remote_group and "location" in remote_group["meta"]:
                     url = f"{service.scim_url}{remote_group['meta']['location']}"
                     scim_dict_cleansed = replace_none_values(scim_dict)
-                    response = requests.put(url, json=scim_dict_cleansed, headers=scim_headers(service), timeout=TIMEOUT)
-                    if validate_response(response, service, outside_user_context=True,
-                                         extra_logging="SCIM group update"):
-                        response_json = response.json()
-                        sync_results["groups"]["updated"].append(response_json)
-
-    return sync_results
+                    executor.submit("PUT", url, handled(group, "updated"), "SCIM group update",
+                                    json=scim_dict_cleansed)
+            else:
+                fingerprints[(SCIM_GROUPS, group.identifier)] = _group_fingerprint(group, remote_users_by_external_id)
@@ -1,6 +1,8 @@
 import base64
+import datetime
 import hashlib
-from typing import List, Union
+import zlib
+from typing import Dict, List, Optional, Union
 
 from server.db.domain import User, Group, Collaboration
 from server.scim import EXTERNAL_ID_POST_FIX
@@ -17,19 +19,67 @@ def replace_none_values(d: dict):
     return d
 
 
+def timestamp(date_at: Optional[datetime.datetime]) -> int:
+    return int(date_at.timestamp()) if date_at else 0
+
+
+def value_checksum(value: str) -> int:
+    # Equal to the CRC32 of the database, so the state of the related rows can be computed there as well
+    return zlib.crc32(value.encode("utf-8"))
+
+
+def updated_at_version(updated_at: datetime.datetime, *state):
+    """
+    The version of a resource, which changes when the resource is updated or when the state of the related rows
+    rendered in the resource changes, see user_state and group_state
+    """
+    values = [str(int(updated_at.timestamp()))] + [str(value) for value in state]
+    return hashlib.sha256(bytes("-".join(values), "utf-8")).hexdigest()
+
+
+def user_state(user: User) -> tuple:
+    """The sramInactiveDays and the count, key sum and checksum of the ssh_keys of the user"""
+    return (inactive_days(user.last_login_date), len(user.ssh_keys), sum(ssh_key.id for ssh_key in user.ssh_keys),
+            sum(value_checksum(ssh_key.ssh_value) for ssh_key in user.ssh_keys))
+
+
+def group_state(group: Union[Group, Collaboration]) -> tuple:
+    """
+    The count, key sum and last update of the members of the active memberships, and the count and checksum of the
+    labels of a collaboration
+    """
+    memberships = [m for m in group.collaboration_memberships if m.is_active()]
+    last_updated_at = max((m.user.updated_at for m in memberships), default=None)
+    state = (len(memberships), sum(m.id for m in memberships), timestamp(last_updated_at))
+    if isinstance(group, Collaboration):
+        state += (len(group.tags), sum(value_checksum(tag.tag_value) for tag in group.tags))
+    return state
+
+
 def version_value(scim_object: Union[User, Group, Collaboration]):
-    return hashlib.sha256(bytes(str(int(scim_object.updated_at.timestamp())), "utf-8")).hexdigest()
+    state = user_state(scim_object) if isinstance(scim_object, User) else group_state(scim_object)
+    return updated_at_version(scim_object.updated_at, *state)
+
+
+def aggregate_version(total_results: int, last_updated_at: Optional[datetime.datetime], checksum: int, *state):
+    """
+    The version of a list of resources, which changes when a resource is added, removed or updated. The checksum of
+    the resource keys detects that a resource is replaced by another one with an older updated_at, the state covers
+    the related rows rendered in the resources.
+    """
+    values = [str(total_results), str(timestamp(last_updated_at)), str(checksum)] + [str(value) for value in state]
+    return hashlib.sha256(bytes("-".join(values), "utf-8")).hexdigest()
 
 
 def date_time_format(date_at):
     return date_at.strftime("%Y-%m-%dT%H:%M:%S")
 
 
-def _meta_info(user: User):
+def _meta_info(user: User, version: Optional[str] = None):
     return {"resourceType": "User",
             "created": date_time_format(user.created_at),
             "lastModified": date_time_format(user.updated_at),
-            "version": version_value(user),
+            "version": version or version_value(user),
             "location": f"/Users/{user.external_id}{EXTERNAL_ID_POST_FIX}"}
 
 
@@ -73,23 +123,27 @@ def update_user_template(user: User, scim_identifier: str):
     return result
 
 
-def find_user_by_id_template(user: User):
+def find_user_by_id_template(user: User, version: Optional[str] = None):
     user_template = update_user_template(user, f"{user.external_id}{EXTERNAL_ID_POST_FIX}")
-    user_template["meta"] = _meta_info(user)
+    user_template["meta"] = _meta_info(user, version)
     return user_template
 
 
-def find_users_template(users: List[User]):
+# The total_results and the 1-based start_index are those of the requested page, the projection drops attributes and
+# the versions by user id are those of the page, see server.scim.repo.scim_user_versions
+def find_users_template(users: List[User], total_results: int = None, start_index: int = 1, projection=None,
+                        versions: Optional[Dict[int, str]] = None):
     base = {
         "schemas": [
             f"{SCIM_API_MESSAGES}:ListResponse"
         ],
-        "totalResults": len(users),
-        "startIndex": 0,
+        "totalResults": len(users) if total_results is None else total_results,
+        "startIndex": start_index,
         "itemsPerPage": len(users),
     }
     resources = []
     for user in users:
-        resources.append(find_user_by_id_template(user))
+        resource = find_user_by_id_template(user, versions.get(user.id) if versions else None)
+        resources.append(projection.apply(resource) if projection else resource)
     base["Resources"] = resources
     return base
@@ -17,12 +17,17 @@ from flask_testing import TestCase
 from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker, load_only
 
+from server.auth.authz_decisions import DECISION_KEY_PREFIX, USER_DECISIONS_KEY_PREFIX, \
+    SERVICE_DECISIONS_KEY_PREFIX
+from server.auth.entitlements import ENTITLEMENTS_KEY_PREFIX
 from server.auth.mfa import ACR_VALUES
 from server.auth.secrets import secure_hash
 from server.db.db import db
 from server.db.defaults import STATUS_EXPIRED, STATUS_SUSPENDED
+from server.scim.outbox import OUTBOX_COALESCED_KEY
 from server.db.domain import Collaboration, User, Service, ServiceAup, UserToken, Invitation, \
     PamSSOSession, Group, CollaborationMembership, Aup
+from server.test.scim import clear_fingerprints
 from server.test.seed import seed
 from server.tools import dt_now
 from server.tools import read_file
@@ -45,6 +50,14 @@ class AbstractTest(TestCase):
             os.environ["SEEDING"] = "1"
             seed(db, self.app.app_config)
             del os.environ["SEEDING"]
+            # The remote SCIM servers start without any of the seeded users and groups
+            clear_fingerprints(self.app.redis_client)
+            # The precomputed entitlements and authorization decisions of the previous test are stale
+            for prefix in [ENTITLEMENTS_KEY_PREFIX, DECISION_KEY_PREFIX, USER_DECISIONS_KEY_PREFIX,
+                           SERVICE_DECISIONS_KEY_PREFIX]:
+                for key in self.app.redis_client.scan_iter(f"{prefix}*"):
+                    self.app.redis_client.delete(key)
+            self.app.redis_client.delete(OUTBOX_COALESCED_KEY)
 
     def create_app(self):
         return AbstractTest.app
@@ -1,11 +1,22 @@
+import json
+import os
 from base64 import b64encode
 
-from server.db.domain import User
+from munch import munchify
+from sqlalchemy import text
+
+from server.api import plsc
+from server.api.plsc import internal_sync, CURSOR_HEADER, _sync_users
+from server.db.db import db
+from server.db.domain import User, Group, Organisation, Collaboration, Service, SshKey, ServiceAup
 from server.db.models import flatten
 from server.test.abstract_test import AbstractTest
+from server.test import plsc_reference
+from server.test.plsc_benchmark import joined_users, benchmark_users_sync, counted_lines
+from server.test.plsc_reference import reference_sync
 from server.test.seed import user_sarah_name, service_wiki_entity_id, unihard_name, co_ai_computing_name, \
     group_ai_researchers, \
-    user_boss_name, service_storage_entity_id
+    user_boss_name, service_storage_entity_id, service_wiki_name, service_storage_name
 
 AUTH_HEADER_READ = {"Authorization": f"Basic {b64encode(b'sysread:secret').decode('ascii')}"}
 AUTH_HEADER_IPADDRESS = {"Authorization": f"Basic {b64encode(b'ipaddress:secret').decode('ascii')}"}
@@ -42,6 +53,183 @@ class TestPlsc(AbstractTest):
         sarah = next(u for u in users_ if u["name"] == user_sarah_name)
         self.assertTrue(sarah["sram_inactive_days"] > (24 * 365))
 
+    @staticmethod
+    def _comparable(result):
+        # The reference returns the ssh_keys and accepted_aups in the unspecified order of its joined rows
+        users = [{**user, "ssh_keys": sorted(user["ssh_keys"]),
+                  "accepted_aups": sorted(user["accepted_aups"],
+                                          key=lambda aup: (aup["service_id"], aup["url"], aup["agreed_at"]))}
+                 for user in result["users"]]
+        return json.dumps({**result, "users": users}, sort_keys=True, default=str)
+
+    def test_sync_equals_reference(self):
+        self.assertEqual(self._comparable(reference_sync()), self._comparable(internal_sync()))
+
+    def test_sync_scales_linearly(self):
+        from server.test.stress_seed import stress_seed
+
+        def counted_syncs(num_users, num_orgs, num_collaborations):
+            self.app.app_config.stress_test = munchify({"num_users": num_users, "num_orgs": num_orgs,
+                                                        "num_collaborations": num_collaborations,
+                                                        "num_services": 5, "num_groups": 3, "probability": 0.5})
+            os.environ["SEEDING"] = "1"
+            try:
+                stress_seed(db, self.app.app_config)
+            finally:
+                del os.environ["SEEDING"]
+            with counted_lines(plsc) as lines:
+                result = self._comparable(internal_sync())
+            with counted_lines(plsc_reference) as reference_lines:
+                reference = self._comparable(reference_sync())
+            self.assertEqual(reference, result)
+            return len(result), lines[0], reference_lines[0]
+
+        stress_test_config = self.app.app_config.stress_test
+        try:
+            small_size, small_lines, small_reference_lines = counted_syncs(25, 5, 10)
+            large_size, large_lines, large_reference_lines = counted_syncs(100, 20, 40)
+        finally:
+            self.app.app_config.stress_test = stress_test_config
+
+        # The executed lines - unlike the wall time - are deterministic. They grow with the size of the tree, unless
+        # each collaboration or organisation scans all rows, like the reference does.
+        size_ratio = large_size / small_size
+        self.assertGreater(size_ratio, 4)
+        self.assertLess(large_lines / small_lines, 1.5 * size_ratio)
+        self.assertGreater(large_reference_lines / small_reference_lines, 3 * size_ratio)
+
+    def test_delta_sync(self):
+        with db.engine.begin() as conn:
+            for table in ["users", "organisations", "collaborations", "`groups`", "services"]:
+                conn.execute(text(f"UPDATE {table} SET updated_at = '2020-01-01 00:00:00'"))
+        response = self.client.get("/api/plsc/syncing", headers=AUTH_HEADER_READ)
+        cursor = response.headers.get(CURSOR_HEADER)
+        self.assertIsNotNone(cursor)
+
+        res = self.get("/api/plsc/syncing", query_data={"since": cursor})
+        self.assertEqual(0, len(res["organisations"]))
+        self.assertEqual(0, len(res["services"]))
+        self.assertEqual(0, len(res["users"]))
+        self.assertIsNotNone(res["cursor"])
+
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        sarah.name = "Sarah Changed"
+        self.save_entity(sarah)
+        group = self.find_entity_by_name(Group, group_ai_researchers)
+        group_id = group.id
+        self.delete("/api/groups", primary_key=group_id)
+
+        res = self.get("/api/plsc/syncing", query_data={"since": cursor})
+        self.assertListEqual(["Sarah Changed"], [u["name"] for u in res["users"]])
+        self.assertListEqual([unihard_name], [org["name"] for org in res["organisations"]])
+        self.assertListEqual([co_ai_computing_name],
+                             [coll["name"] for coll in res["organisations"][0]["collaborations"]])
+        self.assertListEqual([group_id], res["deleted"]["groups"])
+        self.assertListEqual([], res["deleted"]["users"])
+
+        res = self.get("/api/plsc/syncing", query_data={"since": res["cursor"]})
+        self.assertListEqual([], res["deleted"]["groups"])
+
+    def test_delta_sync_streaming(self):
+        response = self.client.get("/api/plsc/sync", headers=AUTH_HEADER_READ)
+        cursor = response.headers.get(CURSOR_HEADER)
+        self.assertIsNotNone(cursor)
+        res = self.get("/api/plsc/sync", query_data={"since": cursor})
+        self.assertIsNotNone(res["cursor"])
+        self.assertTrue("deleted" in res)
+
+    def test_sync_streamed_equals_syncing(self):
+        streamed = self.get("/api/plsc/sync")
+        self.assertDictEqual(self.get("/api/plsc/syncing"), streamed)
+        self.assertListEqual(sorted(u["id"] for u in streamed["users"]), [u["id"] for u in streamed["users"]])
+
+    def test_sync_etag(self):
+        response = self.client.get("/api/plsc/syncing", headers=AUTH_HEADER_READ)
+        etag = response.headers.get("ETag")
+        self.assertIsNotNone(etag)
+
+        response = self.client.get("/api/plsc/sync", headers={**AUTH_HEADER_READ, "If-None-Match": etag})
+        self.assertEqual(304, response.status_code)
+        self.assertIsNotNone(response.headers.get(CURSOR_HEADER))
+        response = self.client.get("/api/plsc/syncing", headers={**AUTH_HEADER_READ, "If-None-Match": etag})
+        self.assertEqual(304, response.status_code)
+        response = self.client.get("/api/plsc/sync", headers=AUTH_HEADER_READ)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(etag, response.headers.get("ETag"))
+
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        sarah.name = "Sarah Changed"
+        self.save_entity(sarah)
+
+        response = self.client.get("/api/plsc/syncing", headers={**AUTH_HEADER_READ, "If-None-Match": etag})
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response.headers.get("ETag"))
+        self.assertTrue("Sarah Changed" in [u["name"] for u in response.json["users"]])
+
+    def test_sync_users_split_queries(self):
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        sarah_id = sarah.id
+        services = [self.find_entity_by_name(Service, name) for name in [service_wiki_name, service_storage_name]]
+        aups = [(f"https://aup/{service.id}", service.id) for service in services]
+        db.session.add(SshKey(user_id=sarah_id, ssh_value="ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIN9m sarah"))
+        db.session.add_all([ServiceAup(user_id=sarah_id, service_id=service_id, aup_url=url) for url, service_id in aups])
+        db.session.commit()
+
+        with db.engine.connect() as conn:
+            joined = {user["id"]: user for user in joined_users(conn)}
+            split = list(_sync_users(conn))
+        self.assertEqual(len(joined), len(split))
+        for user in split:
+            self.assertListEqual(joined[user["id"]]["ssh_keys"], user["ssh_keys"])
+            self.assertCountEqual(joined[user["id"]]["accepted_aups"], user["accepted_aups"])
+        sarah = next(user for user in split if user["id"] == sarah_id)
+        self.assertListEqual(["some-lame-key", "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIN9m sarah"], sarah["ssh_keys"])
+        self.assertListEqual(aups, [(aup["url"], aup["service_id"]) for aup in sarah["accepted_aups"]])
+
+        result = benchmark_users_sync(db, repeat=1)
+        self.assertTrue(result["before"]["rows"] >= len(split))
+        self.assertTrue(result["after"]["rows"] >= len(split))
+
+    def test_sync_organisation_ids(self):
+        organisation = self.find_entity_by_name(Organisation, unihard_name)
+        for url in ["/api/plsc/sync", "/api/plsc/syncing"]:
+            res = self.get(url, query_data={"organisation_ids": str(organisation.id)})
+            self.assertListEqual([unihard_name], [org["name"] for org in res["organisations"]])
+            org = res["organisations"][0]
+            user_ids = {m["user_id"] for m in org["organisation_memberships"]}
+            user_ids.update(m["user_id"] for coll in org["collaborations"] for m in coll["collaboration_memberships"])
+            self.assertSetEqual(user_ids, {user["id"] for user in res["users"]})
+            service_ids = {service_id for coll in org["collaborations"] for service_id in coll["services"]}
+            self.assertSetEqual(service_ids, {service["id"] for service in res["services"]})
+
+    def test_sync_shards(self):
+        full = self.get("/api/plsc/syncing")
+        shards = [self.get("/api/plsc/sync", query_data={"shard": f"{i}/3"}) for i in range(3)]
+        self.assertListEqual(sorted(org["id"] for org in full["organisations"]),
+                             sorted(org["id"] for shard in shards for org in shard["organisations"]))
+
+    def test_sync_invalid_shard(self):
+        self.get("/api/plsc/sync", query_data={"shard": "3/3"}, response_status_code=400)
+        self.get("/api/plsc/syncing", query_data={"organisation_ids": "nope"}, response_status_code=400)
+        self.get("/api/plsc/syncing", query_data={"organisation_ids": "1", "shard": "0/2"},
+                 response_status_code=400)
+
+    def test_ldif(self):
+        response = self.client.get("/api/plsc/ldif", headers=AUTH_HEADER_READ)
+        self.assertEqual(200, response.status_code)
+        records = response.data.decode().split("\n\n")
+        self.assertEqual("dn: ou=People,dc=example,dc=com\nobjectClass: organizationalUnit\nou: People", records[0])
+        sarah = next(record for record in records if record.startswith("dn: uid=sarah,ou=People,dc=example,dc=com"))
+        self.assertTrue("sshPublicKey: some-lame-key" in sarah)
+        ai_computing = self.find_entity_by_name(Collaboration, co_ai_computing_name)
+        collaboration = next(record for record in records
+                             if record.startswith(f"dn: cn={ai_computing.global_urn},ou=Groups"))
+        self.assertTrue("member: uid=sarah,ou=People,dc=example,dc=com" in collaboration)
+
+    def test_delta_sync_invalid_cursor(self):
+        self.get("/api/plsc/syncing", query_data={"since": "nope"}, response_status_code=400)
+        self.get("/api/plsc/sync", query_data={"since": "nope"}, response_status_code=400)
+
     def assert_sync_result(self, res):
         self.assertEqual(4, len(res["organisations"]))
         logo = res["organisations"][0]["logo"]
@@ -7,13 +7,16 @@ import responses
 from sqlalchemy import text
 
 from server.db.db import db
-from server.db.domain import User, Collaboration, Group, Service
+from server.db.domain import User, Collaboration, Group, Service, SshKey
 from server.scim import EXTERNAL_ID_POST_FIX
+from server.scim.outbox import enqueue_outbox_message
 from server.scim.resource_type_template import resource_type_template
+from server.scim.session import scim_session, reset_scim_request_metrics
 from server.scim.user_template import version_value
 from server.test.abstract_test import AbstractTest
+from server.test.scim import TEST_SCIM_SERVER, TEST_SCIM_USERS_ENDPOINT
 from server.test.seed import service_network_token, user_jane_name, co_ai_computing_name, group_ai_researchers, \
-    service_network_name, service_wiki_token, service_wiki_name
+    service_network_name, service_wiki_token, service_wiki_name, user_john_name, user_sarah_name
 from server.tools import read_file
 from server.scim.schema_template import schemas_template, get_scim_schema_sram_user
 
@@ -33,6 +36,42 @@ class TestScim(AbstractTest):
                        with_basic_auth=False)
         self.assertEqual(4, len(res["Resources"]))
 
+    def test_users_paging_sorting(self):
+        headers = {"Authorization": f"bearer {service_network_token}"}
+        res = self.get("/api/scim/v2/Users", query_data={"sortBy": "userName", "sortOrder": "descending"},
+                       headers=headers, with_basic_auth=False)
+        user_names = [user["userName"] for user in res["Resources"]]
+        self.assertListEqual(sorted(user_names, key=str.lower, reverse=True), user_names)
+
+        res = self.get("/api/scim/v2/Users",
+                       query_data={"sortBy": "userName", "sortOrder": "descending", "startIndex": 2, "count": 2},
+                       headers=headers, with_basic_auth=False)
+        self.assertEqual(6, res["totalResults"])
+        self.assertEqual(2, res["startIndex"])
+        self.assertEqual(2, res["itemsPerPage"])
+        self.assertListEqual(user_names[1:3], [user["userName"] for user in res["Resources"]])
+
+    def test_users_attributes(self):
+        headers = {"Authorization": f"bearer {service_network_token}"}
+        res = self.get("/api/scim/v2/Users", query_data={"attributes": "userName,name.givenName"},
+                       headers=headers, with_basic_auth=False)
+        for user in res["Resources"]:
+            self.assertListEqual(["id", "name", "schemas", "userName"], sorted(user.keys()))
+            self.assertListEqual(["givenName"], list(user["name"].keys()))
+
+        res = self.get("/api/scim/v2/Users", query_data={"excludedAttributes": "x509Certificates,meta"},
+                       headers=headers, with_basic_auth=False)
+        for user in res["Resources"]:
+            self.assertNotIn("x509Certificates", user)
+            self.assertNotIn("meta", user)
+            self.assertIn("userName", user)
+
+    def test_users_invalid_sort_by(self):
+        self.get("/api/scim/v2/Users", query_data={"sortBy": "nope"},
+                 headers={"Authorization": f"bearer {service_network_token}"},
+                 with_basic_auth=False,
+                 response_status_code=400)
+
     def test_user_by_external_id(self):
         jane = self.find_entity_by_name(User, user_jane_name)
         jane_external_id = jane.external_id
@@ -43,6 +82,55 @@ class TestScim(AbstractTest):
         self.assertEqual(f"{jane_external_id}{EXTERNAL_ID_POST_FIX}", res["externalId"])
         self.assertEqual("User", res["meta"]["resourceType"])
 
+    def test_user_by_external_id_not_modified(self):
+        jane = self.find_entity_by_name(User, user_jane_name)
+        jane_id, url = jane.id, f"/api/scim/v2/Users/{jane.external_id}{EXTERNAL_ID_POST_FIX}"
+        headers = {"Authorization": f"bearer {service_network_token}"}
+        etag = self.client.get(url, headers=headers).headers.get("Etag")
+
+        response = self.client.get(url, headers={**headers, "If-None-Match": f"\"{etag}\""})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response.headers.get("Etag"))
+        self.assertEqual(b"", response.data)
+
+        db.session.execute(text(f"UPDATE users SET updated_at = '2030-01-01 00:00:00' WHERE id = {jane_id}"))
+        db.session.commit()
+        response = self.client.get(url, headers={**headers, "If-None-Match": etag})
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response.headers.get("Etag"))
+
+    def test_user_etag_ssh_key_changes(self):
+        john = self.find_entity_by_name(User, user_john_name)
+        url = f"/api/scim/v2/Users/{john.external_id}{EXTERNAL_ID_POST_FIX}"
+        headers = {"Authorization": f"bearer {service_network_token}"}
+        etag = self.client.get(url, headers=headers).headers.get("Etag")
+        list_etag = self.client.get("/api/scim/v2/Users", headers=headers).headers.get("Etag")
+
+        ssh_key = john.ssh_keys[0]
+        ssh_key.ssh_value = ssh_key.ssh_value[::-1]
+        self.save_entity(ssh_key)
+        response = self.client.get(url, headers={**headers, "If-None-Match": etag})
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response.headers.get("Etag"))
+        self.assertEqual(response.headers.get("Etag"), response.json["meta"]["version"])
+        response = self.client.get("/api/scim/v2/Users", headers={**headers, "If-None-Match": list_etag})
+        self.assertEqual(200, response.status_code)
+
+        etag = response.headers.get("Etag")
+        john = self.find_entity_by_name(User, user_john_name)
+        db.session.add(SshKey(user_id=john.id, ssh_value="ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIN9m"))
+        db.session.commit()
+        response = self.client.get("/api/scim/v2/Users", headers={**headers, "If-None-Match": etag})
+        self.assertEqual(200, response.status_code)
+
+        # The ssh keys moved to another user of the service
+        etag = response.headers.get("Etag")
+        jane = self.find_entity_by_name(User, user_jane_name)
+        db.session.execute(text(f"UPDATE ssh_keys SET user_id = {jane.id} WHERE user_id = {john.id}"))
+        db.session.commit()
+        response = self.client.get("/api/scim/v2/Users", headers={**headers, "If-None-Match": etag})
+        self.assertEqual(200, response.status_code)
+
     def test_user_by_external_id_404(self):
         self.get("/api/scim/v2/Users/nope",
                  headers={"Authorization": f"bearer {service_network_token}"},
@@ -54,6 +142,40 @@ class TestScim(AbstractTest):
                        with_basic_auth=False)
         self.assertEqual(3, len(res["Resources"]))
 
+    def test_users_groups_not_modified(self):
+        headers = {"Authorization": f"bearer {service_network_token}"}
+        for url in ["/api/scim/v2/Users", "/api/scim/v2/Groups"]:
+            etag = self.client.get(url, headers=headers).headers.get("Etag")
+            response = self.client.get(url, headers={**headers, "If-None-Match": etag})
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(etag, response.headers.get("Etag"))
+
+        etag = self.client.get("/api/scim/v2/Groups", headers=headers).headers.get("Etag")
+        collaboration_id = self.find_entity_by_name(Collaboration, co_ai_computing_name).id
+        db.session.execute(text(f"UPDATE collaborations SET updated_at = '2030-01-01 00:00:00' "
+                                f"WHERE id = {collaboration_id}"))
+        db.session.commit()
+        response = self.client.get("/api/scim/v2/Groups", headers={**headers, "If-None-Match": etag})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, len(response.json["Resources"]))
+
+    def test_groups_paging_sorting_attributes(self):
+        headers = {"Authorization": f"bearer {service_network_token}"}
+        res = self.get("/api/scim/v2/Groups",
+                       query_data={"sortBy": "displayName", "attributes": "displayName"},
+                       headers=headers, with_basic_auth=False)
+        display_names = [group["displayName"] for group in res["Resources"]]
+        self.assertListEqual(sorted(display_names, key=str.lower), display_names)
+        self.assertNotIn("members", res["Resources"][0])
+
+        res = self.get("/api/scim/v2/Groups",
+                       query_data={"sortBy": "displayName", "startIndex": 3, "count": 10},
+                       headers=headers, with_basic_auth=False)
+        self.assertEqual(3, res["totalResults"])
+        self.assertEqual(1, res["itemsPerPage"])
+        self.assertEqual(display_names[2], res["Resources"][0]["displayName"])
+        self.assertIn("members", res["Resources"][0])
+
     def test_collaboration_by_identifier(self):
         collaboration = self.find_entity_by_name(Collaboration, co_ai_computing_name)
         collaboration_identifier = collaboration.identifier
@@ -64,6 +186,40 @@ class TestScim(AbstractTest):
         self.assertEqual(f"{collaboration_identifier}{EXTERNAL_ID_POST_FIX}", res["externalId"])
         self.assertEqual(f"{collaboration_identifier}{EXTERNAL_ID_POST_FIX}", res["id"])
 
+    def test_collaboration_by_identifier_not_modified(self):
+        collaboration = self.find_entity_by_name(Collaboration, co_ai_computing_name)
+        url = f"/api/scim/v2/Groups/{collaboration.identifier}{EXTERNAL_ID_POST_FIX}"
+        response = self.client.get(url, headers={"Authorization": f"bearer {service_network_token}",
+                                                 "If-None-Match": version_value(collaboration)})
+        self.assertEqual(304, response.status_code)
+
+    def test_group_etag_membership_changes(self):
+        group = self.find_entity_by_name(Group, group_ai_researchers)
+        url = f"/api/scim/v2/Groups/{group.identifier}{EXTERNAL_ID_POST_FIX}"
+        headers = {"Authorization": f"bearer {service_network_token}"}
+        etag = self.client.get(url, headers=headers).headers.get("Etag")
+        list_etag = self.client.get("/api/scim/v2/Groups", headers=headers).headers.get("Etag")
+
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        membership = next(m for m in group.collaboration.collaboration_memberships if m.user_id == sarah.id)
+        group.collaboration_memberships.append(membership)
+        self.save_entity(group)
+        response = self.client.get(url, headers={**headers, "If-None-Match": etag})
+        self.assertEqual(200, response.status_code)
+        added_etag = response.headers.get("Etag")
+        self.assertNotEqual(etag, added_etag)
+        self.assertEqual(added_etag, response.json["meta"]["version"])
+        response = self.client.get("/api/scim/v2/Groups", headers={**headers, "If-None-Match": list_etag})
+        self.assertEqual(200, response.status_code)
+        self.assertIn(added_etag, [group["meta"]["version"] for group in response.json["Resources"]])
+
+        group = self.find_entity_by_name(Group, group_ai_researchers)
+        group.collaboration_memberships.remove(membership)
+        self.save_entity(group)
+        response = self.client.get(url, headers={**headers, "If-None-Match": added_etag})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(etag, response.headers.get("Etag"))
+
     def test_group_by_identifier(self):
         group = self.find_entity_by_name(Group, group_ai_researchers)
         group_identifier = group.identifier
@@ -111,13 +267,55 @@ class TestScim(AbstractTest):
                        with_basic_auth=False)
         self.assertEqual(1, len(res["Resources"]))
 
-    def test_users_filter_not_implemented(self):
+    def test_users_filter_not_supported(self):
         query = urllib.parse.quote(f"{get_scim_schema_sram_user()}.voPersonExternalId eq 'urn:john'")
         self.get("/api/scim/v2/Users",
                  query_data={"filter": query},
                  headers={"Authorization": f"bearer {service_network_token}"},
                  with_basic_auth=False,
-                 response_status_code=500)
+                 response_status_code=400)
+
+    def test_users_filter_operators(self):
+        headers = {"Authorization": f"bearer {service_network_token}"}
+        users = self.get("/api/scim/v2/Users", headers=headers, with_basic_auth=False)["Resources"]
+
+        def user_names(query_filter):
+            res = self.get("/api/scim/v2/Users", query_data={"filter": query_filter}, headers=headers,
+                           with_basic_auth=False)
+            self.assertEqual(len(res["Resources"]), res["totalResults"])
+            return sorted(user["userName"] for user in res["Resources"])
+
+        expected = sorted(user["userName"] for user in users if user["userName"].startswith("j")
+                          and not user["emails"][0]["value"].endswith("@ucc.org"))
+        self.assertListEqual(expected, user_names("userName sw \"j\" and not (emails ew \"@ucc.org\")"))
+        self.assertEqual(len(users), len(user_names("meta.lastModified gt \"2000-01-01T00:00:00Z\" or userName pr")))
+        self.assertListEqual([], user_names("userName co \"%\""))
+
+        external_ids = [users[0]["externalId"], users[1]["externalId"]]
+        query_filter = f"externalId eq \"{external_ids[0]}\" OR id eq \"{external_ids[1]}\""
+        self.assertListEqual(sorted([users[0]["userName"], users[1]["userName"]]), user_names(query_filter))
+
+    def test_users_filter_invalid(self):
+        for query_filter in ["userName eq", "(userName eq \"john\"", "userName regex \"j\"",
+                             "meta.created gt \"yesterday\"", "emails[type eq \"work\"]"]:
+            res = self.get("/api/scim/v2/Users", query_data={"filter": query_filter},
+                           headers={"Authorization": f"bearer {service_network_token}"},
+                           with_basic_auth=False,
+                           response_status_code=400)
+            self.assertTrue(res["message"].startswith("invalidFilter"))
+
+    def test_groups_filter(self):
+        headers = {"Authorization": f"bearer {service_network_token}"}
+        groups = self.get("/api/scim/v2/Groups", headers=headers, with_basic_auth=False)["Resources"]
+        display_name = groups[-1]["displayName"]
+        res = self.get("/api/scim/v2/Groups", query_data={"filter": f"displayName eq \"{display_name}\""},
+                       headers=headers, with_basic_auth=False)
+        self.assertEqual(1, res["totalResults"])
+        self.assertEqual(groups[-1]["id"], res["Resources"][0]["id"])
+
+        res = self.get("/api/scim/v2/Groups", query_data={"filter": "not (displayName pr)"},
+                       headers=headers, with_basic_auth=False)
+        self.assertEqual(0, res["totalResults"])
 
     @responses.activate
     def test_sweep(self):
@@ -156,14 +354,14 @@ class TestScim(AbstractTest):
             self.assertTrue("Invalid response from remote SCIM server (got HTTP status 400)" in res["error"])
 
         # test HTTP error from remote SCIM server
-        with mock.patch("requests.get", side_effect=requests.Timeout('Connection timed out')):
+        with mock.patch("requests.Session.request", side_effect=requests.Timeout('Connection timed out')):
             res = self.put("/api/scim/v2/sweep", headers={"Authorization": f"bearer {service_network_token}"},
                            with_basic_auth=False, response_status_code=400)
             self.assertTrue("error" in res)
             self.assertEqual(res["error"], "Could not connect to remote SCIM server (Timeout)")
 
         # test other errors during SCIM sweep
-        with mock.patch("requests.get", side_effect=Exception("Weird error")):
+        with mock.patch("requests.Session.request", side_effect=Exception("Weird error")):
             res = self.put("/api/scim/v2/sweep", headers={"Authorization": f"bearer {service_network_token}"},
                            with_basic_auth=False, response_status_code=500)
             self.assertTrue("error" in res)
@@ -181,3 +379,49 @@ class TestScim(AbstractTest):
         self.login("urn:john")
         scim_services = self.get("/api/scim/v2/scim-services", with_basic_auth=False)
         self.assertEqual(4, len(scim_services))
+
+    def test_scim_outbox(self):
+        self.login("urn:john")
+        enqueue_outbox_message(TEST_SCIM_SERVER, "apply_user_change", [1], [2])
+        statistics = self.get("/api/scim/v2/outbox", with_basic_auth=False)
+        self.assertEqual(1, len(statistics))
+        self.assertEqual(TEST_SCIM_SERVER, statistics[0]["endpoint"])
+        self.assertEqual(1, statistics[0]["depth"])
+        self.assertEqual(0, statistics[0]["dead_letters"])
+        self.assertEqual(0, statistics[0]["coalesced"])
+
+        res = self.client.get("/api/scim/v2/outbox/metrics")
+        self.assertEqual(200, res.status_code)
+        self.assertIn(f'scim_outbox_depth{{endpoint="{TEST_SCIM_SERVER}"}} 1', res.text)
+        self.assertIn(f'scim_outbox_coalesced_total{{endpoint="{TEST_SCIM_SERVER}"}} 0', res.text)
+
+    def test_scim_circuit_breakers(self):
+        self.login("urn:john")
+        statistics = self.get("/api/scim/v2/circuit-breakers", with_basic_auth=False)
+        self.assertListEqual([], statistics)
+
+    def test_scim_fifo_pool(self):
+        self.app.scim_fifo_pool.submit("test_scim_fifo_pool", len, "abc").result(timeout=2)
+        self.login("urn:john")
+        metrics = self.get("/api/scim/v2/fifo-pool", with_basic_auth=False)
+        endpoint_metrics = next(m for m in metrics if m["key"] == "test_scim_fifo_pool")
+        self.assertEqual(1, endpoint_metrics["completed"])
+
+        res = self.client.get("/api/scim/v2/fifo-pool/metrics")
+        self.assertEqual(200, res.status_code)
+        self.assertIn('scim_fifo_pool_completed_total{key="test_scim_fifo_pool"} 1', res.text)
+
+    @responses.activate
+    def test_scim_requests(self):
+        reset_scim_request_metrics()
+        responses.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, status=200)
+        scim_session(TEST_SCIM_SERVER).get(TEST_SCIM_USERS_ENDPOINT)
+        self.login("urn:john")
+        metrics = self.get("/api/scim/v2/requests", with_basic_auth=False)
+        self.assertEqual(1, len(metrics))
+        self.assertEqual(1, metrics[0]["success"])
+        self.assertEqual(1, metrics[0]["seconds"]["count"])
+
+        res = self.client.get("/api/scim/v2/requests/metrics")
+        self.assertEqual(200, res.status_code)
+        self.assertIn(f'scim_requests_success_total{{endpoint="{TEST_SCIM_SERVER}"}} 1', res.text)
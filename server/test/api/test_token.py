@@ -1,12 +1,13 @@
 from sqlalchemy import text
 
+from server.auth.entitlements import ENTITLEMENTS_KEY_PREFIX
 from server.auth.secrets import secure_hash
 from server.db.db import db
-from server.db.domain import UserToken, User
+from server.db.domain import UserToken, User, Collaboration
 from server.test.abstract_test import AbstractTest
 from server.test.seed import (user_sarah_user_token_network, service_network_token, user_sarah_name, service_wiki_token,
                               user_betty_user_token_wiki,
-                              co_teachers_name, unihard_short_name)
+                              co_teachers_name, unihard_short_name, co_ai_computing_name)
 
 
 class TestToken(AbstractTest):
@@ -97,3 +98,28 @@ class TestToken(AbstractTest):
         self.assertEqual(200, res.status_code)
         self.assertEqual(res.json["active"], False)
         self.assertEqual(res.json["status"], "token-not-connected")
+
+    def test_introspect_precomputed_entitlements(self):
+        redis_key = f"{ENTITLEMENTS_KEY_PREFIX}{self.find_entity_by_name(User, user_sarah_name).id}"
+        entitlement = f"urn:example:sbs:group:{unihard_short_name}:ai_computing"
+
+        def introspect():
+            res = self.client.post("/api/tokens/introspect",
+                                   headers={"Authorization": f"bearer {service_network_token}"},
+                                   data={"token": user_sarah_user_token_network},
+                                   content_type="application/x-www-form-urlencoded")
+            self.assertEqual(200, res.status_code)
+            return res.json["user"]["eduperson_entitlement"]
+
+        self.assertIn(entitlement, introspect())
+        self.assertTrue(self.app.redis_client.exists(redis_key))
+
+        collaboration = self.find_entity_by_name(Collaboration, co_ai_computing_name)
+        collaboration.short_name = "ai_renamed"
+        db.session.merge(collaboration)
+        db.session.commit()
+        self.assertFalse(self.app.redis_client.exists(redis_key))
+
+        entitlements = introspect()
+        self.assertNotIn(entitlement, entitlements)
+        self.assertIn(f"urn:example:sbs:group:{unihard_short_name}:ai_renamed", entitlements)
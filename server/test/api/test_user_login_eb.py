@@ -1,19 +1,48 @@
 import urllib.parse
 import uuid
 
+import mock
 import requests
 
+from server.auth.entitlements import ENTITLEMENTS_KEY_PREFIX, compute_service_entitlements, remove_entitlements
 from server.auth.user_codes import UserCode
 from server.db.db import db
-from server.db.domain import UserNonce, ServiceAup, Service, User
+from server.db.domain import UserNonce, ServiceAup, Service, User, Collaboration
 from server.test.abstract_test import AbstractTest
 from server.test.seed import (service_mail_entity_id,
                               service_wireless_entity_id, service_cloud_entity_id, sarah_nonce, user_sarah_name,
-                              service_mail_name)
+                              service_mail_name, co_ai_computing_name, unihard_short_name)
 
 
 class TestUserLoginEB(AbstractTest):
 
+    def _authz_eb_sarah(self):
+        return self.post("/api/users/authz_eb", response_status_code=200,
+                         headers={"Authorization": self.app.app_config.engine_block.api_token,
+                                  "Content-Type": "application/json"},
+                         body={"user_id": "urn:sarah",
+                               "continue_url": "https://engine.surf.nl",
+                               "service_id": service_mail_entity_id,
+                               "issuer_id": "https://idp.test"})
+
+    def _attributes_eb_sarah(self):
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        mail = self.find_entity_by_name(Service, service_mail_name)
+        nonce = str(uuid.uuid4())
+        db.session.merge(UserNonce(user=sarah, service=mail, nonce=nonce, continue_url="https://engine.surf.nl",
+                                   issuer_id="https://idp.test", error_status=UserCode.AUP_NOT_AGREED.value))
+        db.session.commit()
+        return self.post("/api/users/attributes_eb", response_status_code=200,
+                         headers={"Authorization": self.app.app_config.engine_block.api_token,
+                                  "Content-Type": "application/json"},
+                         body={"nonce": nonce})
+
+    def _rename_ai_computing(self):
+        collaboration = self.find_entity_by_name(Collaboration, co_ai_computing_name)
+        collaboration.short_name = "ai_renamed"
+        db.session.merge(collaboration)
+        db.session.commit()
+
     def test_authz_eb_missing_key(self):
         res = self.post("/api/users/authz_eb",
                         headers={"Authorization": self.app.app_config.engine_block.api_token,
@@ -317,3 +346,52 @@ class TestUserLoginEB(AbstractTest):
         res = self.client.get("/api/users/interrupt",
                               query_string={"nonce": "bogus"})
         self.assertEqual(404, res.status_code)
+
+    def test_authz_eb_precomputed_entitlements(self):
+        self.add_service_aup_to_user("urn:sarah", service_mail_entity_id)
+        redis_key = f"{ENTITLEMENTS_KEY_PREFIX}{self.find_entity_by_name(User, user_sarah_name).id}"
+        entitlement = f"urn:example:sbs:group:{unihard_short_name}:ai_computing"
+
+        res = self._authz_eb_sarah()
+        self.assertIn(entitlement, res["attributes"]["urn:mace:dir:attribute-def:eduPersonEntitlement"])
+        self.assertTrue(self.app.redis_client.exists(redis_key))
+
+        self._rename_ai_computing()
+        self.assertFalse(self.app.redis_client.exists(redis_key))
+        res = self._authz_eb_sarah()
+        entitlements = res["attributes"]["urn:mace:dir:attribute-def:eduPersonEntitlement"]
+        self.assertNotIn(entitlement, entitlements)
+        self.assertIn(f"urn:example:sbs:group:{unihard_short_name}:ai_renamed", entitlements)
+
+    def test_authz_eb_entitlements_removed_while_computed(self):
+        self.add_service_aup_to_user("urn:sarah", service_mail_entity_id)
+        redis_key = f"{ENTITLEMENTS_KEY_PREFIX}{self.find_entity_by_name(User, user_sarah_name).id}"
+
+        def compute_and_remove(service, user):
+            entitlements = compute_service_entitlements(service, user)
+            # A concurrent commit removes the entitlements of the user before the computed ones are stored
+            remove_entitlements([user.id])
+            return entitlements
+
+        with mock.patch("server.auth.entitlements.compute_service_entitlements", side_effect=compute_and_remove):
+            self.assertEqual("authorized", self._authz_eb_sarah()["msg"])
+        self.assertFalse(self.app.redis_client.exists(redis_key))
+
+        self._authz_eb_sarah()
+        self.assertTrue(self.app.redis_client.exists(redis_key))
+
+    def test_attributes_eb_precomputed_entitlements(self):
+        self.add_service_aup_to_user("urn:sarah", service_mail_entity_id)
+        redis_key = f"{ENTITLEMENTS_KEY_PREFIX}{self.find_entity_by_name(User, user_sarah_name).id}"
+        entitlement = f"urn:example:sbs:group:{unihard_short_name}:ai_computing"
+
+        res = self._attributes_eb_sarah()
+        self.assertIn(entitlement, res["attributes"]["urn:mace:dir:attribute-def:eduPersonEntitlement"])
+        self.assertTrue(self.app.redis_client.exists(redis_key))
+
+        self._rename_ai_computing()
+        self.assertFalse(self.app.redis_client.exists(redis_key))
+        res = self._attributes_eb_sarah()
+        entitlements = res["attributes"]["urn:mace:dir:attribute-def:eduPersonEntitlement"]
+        self.assertNotIn(entitlement, entitlements)
+        self.assertIn(f"urn:example:sbs:group:{unihard_short_name}:ai_renamed", entitlements)
@@ -1,11 +1,18 @@
 import datetime
 
+import mock
+from redis.exceptions import ConnectionError
+from sqlalchemy import text
+
+from server.auth.authz_decisions import _decision_key, remove_authz_decisions
+from server.auth.entitlements import ENTITLEMENTS_KEY_PREFIX, compute_service_entitlements
 from server.auth.user_codes import UserCode
 from server.db.db import db
-from server.db.domain import Collaboration, Service, User, UserLogin
+from server.db.domain import Collaboration, Service, User, UserLogin, Group, CollaborationMembership
 from server.test.abstract_test import AbstractTest
 from server.test.seed import (user_john_name, service_network_entity_id, service_mail_entity_id,
-                              co_ai_computing_name, user_sarah_name, service_mail_name, unihard_short_name)
+                              co_ai_computing_name, user_sarah_name, service_mail_name, unihard_short_name,
+                              user_jane_name, group_ai_researchers)
 from server.tools import dt_now
 
 
@@ -303,3 +310,108 @@ class TestUserSaml(AbstractTest):
         status = res["status"]
         self.assertEqual(UserCode.AUP_NOT_AGREED.value, status["error_status"])
         self.assertEqual("interrupt", status["result"])
+
+    def test_proxy_authz_precomputed_entitlements(self):
+        self.add_service_aup_to_user("urn:jane", service_network_entity_id)
+        self.login_user_2fa("urn:jane")
+        jane = self.find_entity_by_name(User, user_jane_name)
+        redis_key = f"{ENTITLEMENTS_KEY_PREFIX}{jane.id}"
+        body = {"user_id": "urn:jane", "service_id": service_network_entity_id,
+                "issuer_id": "https://idp.uni-franeker.nl/", "uid": "jane"}
+        group_entitlement = f"urn:example:sbs:group:{unihard_short_name}:ai_computing:ai_res"
+
+        res = self.post("/api/users/proxy_authz", response_status_code=200, body=body)
+        self.assertIn(group_entitlement, res["attributes"]["eduPersonEntitlement"])
+        # The login itself does not change the entitlements
+        self.assertTrue(self.app.redis_client.exists(redis_key))
+
+        group = self.find_entity_by_name(Group, group_ai_researchers)
+        group.collaboration_memberships = [m for m in group.collaboration_memberships if m.user_id != jane.id]
+        db.session.merge(group)
+        db.session.commit()
+        self.assertFalse(self.app.redis_client.exists(redis_key))
+
+        res = self.post("/api/users/proxy_authz", response_status_code=200, body=body)
+        self.assertNotIn(group_entitlement, res["attributes"]["eduPersonEntitlement"])
+
+    def test_proxy_authz_cached_decision(self):
+        self.add_service_aup_to_user("urn:sarah", service_mail_entity_id)
+        self.login_user_2fa("urn:sarah")
+        body = {"user_id": "urn:sarah", "service_id": service_mail_entity_id, "issuer_id": "issuer.com",
+                "uid": "sarah"}
+        decision_key = _decision_key("urn:sarah", service_mail_entity_id, "issuer.com")
+        user_logins = UserLogin.query.count()
+
+        first = self.post("/api/users/proxy_authz", response_status_code=200, body=body)
+        self.assertTrue(self.app.redis_client.exists(decision_key))
+
+        # Changes outside of the ORM do not remove the decision, so the second decision can only be the cached one
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        db.session.execute(text("DELETE FROM service_aups WHERE user_id = :user_id"), {"user_id": sarah.id})
+        db.session.commit()
+
+        second = self.post("/api/users/proxy_authz", response_status_code=200, body=body)
+        self.assertEqual("authorized", second["status"]["result"])
+        self.assertDictEqual(first, second)
+        # The decision is cached, the login itself is not
+        self.assertEqual(user_logins + 2, UserLogin.query.count())
+
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        sarah.email = "sarah@changed.org"
+        db.session.merge(sarah)
+        db.session.commit()
+        self.assertFalse(self.app.redis_client.exists(decision_key))
+
+        res = self.post("/api/users/proxy_authz", response_status_code=200, body=body)
+        self.assertEqual("interrupt", res["status"]["result"])
+        self.assertEqual(UserCode.SERVICE_AUP_NOT_AGREED.value, res["status"]["error_status"])
+
+    def test_proxy_authz_cached_decision_membership_change(self):
+        self.add_service_aup_to_user("urn:sarah", service_mail_entity_id)
+        self.login_user_2fa("urn:sarah")
+        body = {"user_id": "urn:sarah", "service_id": service_mail_entity_id, "issuer_id": "issuer.com",
+                "uid": "sarah"}
+        decision_key = _decision_key("urn:sarah", service_mail_entity_id, "issuer.com")
+
+        res = self.post("/api/users/proxy_authz", response_status_code=200, body=body)
+        self.assertEqual("authorized", res["status"]["result"])
+        self.assertTrue(self.app.redis_client.exists(decision_key))
+
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        for membership in CollaborationMembership.query.filter(CollaborationMembership.user_id == sarah.id).all():
+            db.session.delete(membership)
+        db.session.commit()
+        self.assertFalse(self.app.redis_client.exists(decision_key))
+
+        res = self.post("/api/users/proxy_authz", response_status_code=200, body=body)
+        self.assertEqual("unauthorized", res["status"]["result"])
+        self.assertEqual(UserCode.SERVICE_NOT_CONNECTED.value, res["status"]["error_status"])
+
+    def test_proxy_authz_decision_removed_while_computed(self):
+        self.add_service_aup_to_user("urn:sarah", service_mail_entity_id)
+        self.login_user_2fa("urn:sarah")
+        body = {"user_id": "urn:sarah", "service_id": service_mail_entity_id, "issuer_id": "issuer.com",
+                "uid": "sarah"}
+        decision_key = _decision_key("urn:sarah", service_mail_entity_id, "issuer.com")
+
+        def compute_and_remove(service, user):
+            entitlements = compute_service_entitlements(service, user)
+            # A concurrent commit removes the decisions of the user before the computed one is stored
+            remove_authz_decisions(user_ids=[user.id])
+            return entitlements
+
+        with mock.patch("server.auth.entitlements.compute_service_entitlements", side_effect=compute_and_remove):
+            res = self.post("/api/users/proxy_authz", response_status_code=200, body=body)
+        self.assertEqual("authorized", res["status"]["result"])
+        self.assertFalse(self.app.redis_client.exists(decision_key))
+
+        self.post("/api/users/proxy_authz", response_status_code=200, body=body)
+        self.assertTrue(self.app.redis_client.exists(decision_key))
+
+    def test_redis_failure_after_commit(self):
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        sarah.suspended = True
+        with mock.patch("server.auth.entitlements.remove_entitlements", side_effect=ConnectionError("down")), \
+                mock.patch("server.auth.authz_decisions.remove_authz_decisions", side_effect=ConnectionError("down")):
+            self.save_entity(sarah)
+        self.assertTrue(self.find_entity_by_name(User, user_sarah_name).suspended)
@@ -783,6 +783,48 @@ endpoints = [
         "path": "/api/scim/v2/Schemas",
         "status_code": 200
     },
+    {
+        "name": "scim_api.scim_circuit_breakers",
+        "method": "GET",
+        "path": "/api/scim/v2/circuit-breakers",
+        "status_code": 403
+    },
+    {
+        "name": "scim_api.scim_fifo_pool",
+        "method": "GET",
+        "path": "/api/scim/v2/fifo-pool",
+        "status_code": 403
+    },
+    {
+        "name": "scim_api.scim_fifo_pool_prometheus",
+        "method": "GET",
+        "path": "/api/scim/v2/fifo-pool/metrics",
+        "status_code": 403
+    },
+    {
+        "name": "scim_api.scim_outbox",
+        "method": "GET",
+        "path": "/api/scim/v2/outbox",
+        "status_code": 403
+    },
+    {
+        "name": "scim_api.scim_outbox_prometheus",
+        "method": "GET",
+        "path": "/api/scim/v2/outbox/metrics",
+        "status_code": 403
+    },
+    {
+        "name": "scim_api.scim_requests",
+        "method": "GET",
+        "path": "/api/scim/v2/requests",
+        "status_code": 403
+    },
+    {
+        "name": "scim_api.scim_requests_prometheus",
+        "method": "GET",
+        "path": "/api/scim/v2/requests/metrics",
+        "status_code": 403
+    },
     {
         "name": "scim_api.scim_service",
         "method": "GET",
@@ -12,4 +12,4 @@ class TestSchedule(AbstractTest):
         jobs = scheduler.get_jobs()
 
         self.assertTrue(scheduler.running)
-        self.assertEqual(12, len(jobs))
+        self.assertEqual(13, len(jobs))
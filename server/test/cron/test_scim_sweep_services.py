@@ -1,13 +1,16 @@
 import json
+import re
 from time import sleep
 
 import responses
 
 from server.cron.scim_sweep_services import scim_sweep_services
-from server.db.domain import Service
+from server.db.domain import Service, User
 from server.test.abstract_test import AbstractTest
-from server.test.seed import service_network_name
-from server.tools import read_file
+from server.test.scim import TEST_SCIM_SERVER, TEST_SCIM_USERS_ENDPOINT, TEST_SCIM_GROUPS_ENDPOINT, \
+    scim_users_found
+from server.test.seed import service_network_name, service_cloud_name, user_john_name
+from server.tools import read_file, dt_now
 
 
 class TestScimSweepServices(AbstractTest):
@@ -37,6 +40,10 @@ class TestScimSweepServices(AbstractTest):
 
             sweep_result = scim_sweep_services(self.app)
             self.assertEqual(0, len(sweep_result["services"]))
+            # Between the full sweeps only the changes are reconciled
+            self.assertEqual(service_network_name, sweep_result["incremental_services"][0]["name"])
+            service = self.find_entity_by_name(Service, service_network_name)
+            self.assertIsNotNone(service.sweep_scim_last_incremental_run)
 
             service = self.find_entity_by_name(Service, service_network_name)
             service.sweep_scim_last_run = None
@@ -59,3 +66,57 @@ class TestScimSweepServices(AbstractTest):
             sync_results = sweep_result["services"][0]["sync_results"]
             self.assertEqual("400 Bad Request: Invalid response from remote SCIM server (got HTTP status 503)",
                              sync_results)
+
+    def test_schedule_incremental_sweep_failed(self):
+        network = self.find_entity_by_name(Service, service_network_name)
+        network.sweep_scim_last_run = dt_now()
+        self.save_entity(network)
+        # The updated_at is stored in whole seconds
+        sleep(1)
+        john = self.find_entity_by_name(User, user_john_name)
+        john.name = "John Changed"
+        self.save_entity(john)
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=scim_users_found,
+                              content_type="application/json")
+            rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, json={"totalResults": 0, "Resources": []}, status=200)
+            for method in [responses.POST, responses.PUT]:
+                rsps.add(method, re.compile(f"{TEST_SCIM_SERVER}/.*"), status=503, body="Server unavailable")
+            sweep_result = scim_sweep_services(self.app)
+
+            sync_results = sweep_result["incremental_services"][0]["sync_results"]
+            self.assertTrue(sync_results["failed"] > 0)
+            # The changes are reconciled again by the next incremental sweep
+            network = self.find_entity_by_name(Service, service_network_name)
+            self.assertIsNone(network.sweep_scim_last_incremental_run)
+
+    def test_schedule_sweep_shared_endpoint(self):
+        # The network and cloud service share the SCIM endpoint and bearer token, only the cloud service is due
+        network = self.find_entity_by_name(Service, service_network_name)
+        network.sweep_scim_last_run = dt_now()
+        self.save_entity(network)
+        cloud = self.find_entity_by_name(Service, service_cloud_name)
+        cloud.sweep_scim_enabled = True
+        cloud.sweep_scim_daily_rate = 1
+        cloud.sweep_scim_last_run = None
+        self.save_entity(cloud)
+
+        remote_groups = json.loads(read_file("test/scim/sweep/remote_groups_unchanged.json"))
+        remote_users = json.loads(read_file("test/scim/sweep/remote_users_unchanged.json"))
+        user_created = json.loads(read_file("test/scim/user_created.json"))
+        group_created = json.loads(read_file("test/scim/group_created.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=remote_users, status=200)
+            rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, json=remote_groups, status=200)
+            rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, json=user_created, status=201)
+            rsps.add(responses.POST, TEST_SCIM_GROUPS_ENDPOINT, json=group_created, status=201)
+            rsps.add(responses.PUT, re.compile(f"{TEST_SCIM_SERVER}/.*"), json=group_created, status=200)
+            sweep_result = scim_sweep_services(self.app)
+
+            # The remote users and groups of the network service are not deleted by the sweep of the cloud service
+            delete_calls = [call for call in rsps.calls if call.request.method == responses.DELETE]
+            self.assertEqual(0, len(delete_calls))
+            self.assertEqual({service_network_name, service_cloud_name},
+                             {result["name"] for result in sweep_result["services"]})
+            self.assertEqual(0, len(sweep_result["incremental_services"]))
@@ -0,0 +1,52 @@
+import datetime
+
+import mock
+from redis.exceptions import ConnectionError
+
+from server.db.data_version import data_version
+from server.db.domain import User, UserLogin
+from server.test.abstract_test import AbstractTest
+from server.test.seed import user_sarah_name
+from server.tools import dt_now
+
+
+class TestDataVersion(AbstractTest):
+
+    def test_data_change_bumps_version(self):
+        version = data_version()
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        sarah.name = "Sarah Changed"
+        self.save_entity(sarah)
+        self.assertTrue(data_version() > version)
+
+    def test_ignored_attributes_do_not_bump_version(self):
+        version = data_version()
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        sarah.last_login_date = dt_now()
+        sarah.last_accessed_date = dt_now()
+        self.save_entity(sarah)
+        self.assertEqual(version, data_version())
+
+    def test_login_after_inactivity_bumps_version(self):
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        sarah.last_login_date = dt_now() - datetime.timedelta(days=400)
+        self.save_entity(sarah)
+        version = data_version()
+        # The login changes the sram_inactive_days of the PLSC sync
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        sarah.last_login_date = dt_now()
+        self.save_entity(sarah)
+        self.assertTrue(data_version() > version)
+
+    def test_redis_failure_after_commit(self):
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        sarah.name = "Sarah Changed"
+        with mock.patch("server.db.audit_mixin.bump_data_version", side_effect=ConnectionError("down")):
+            self.save_entity(sarah)
+        self.assertEqual("Sarah Changed", self.find_entity_by_name(User, "Sarah Changed").name)
+
+    def test_excluded_models_do_not_bump_version(self):
+        version = data_version()
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        self.save_entity(UserLogin(login_type="user_info", succeeded=True, user_id=sarah.id, user_uid=sarah.uid))
+        self.assertEqual(version, data_version())
@@ -0,0 +1,130 @@
+import contextlib
+import sys
+import time
+
+from sqlalchemy import event, text
+
+from server.api.plsc import _sync_users, internal_sync
+
+JOINED_USERS_QUERY = """
+    SELECT u.id,
+           u.uid,
+           u.name,
+           u.given_name,
+           u.family_name,
+           u.email,
+           u.scoped_affiliation,
+           u.eduperson_principal_name,
+           u.username,
+           u.last_login_date,
+           u.suspended,
+           sk.ssh_value,
+           sa.aup_url,
+           sa.service_id,
+           sa.agreed_at
+    FROM users u
+             LEFT JOIN ssh_keys sk ON sk.user_id = u.id
+             LEFT JOIN service_aups sa ON sa.user_id = u.id
+    """
+
+SPLIT_QUERIES = [
+    "SELECT id FROM users",
+    "SELECT user_id FROM ssh_keys WHERE user_id IS NOT NULL",
+    "SELECT user_id FROM service_aups WHERE user_id IS NOT NULL",
+]
+
+
+def joined_users(conn):
+    """The users of the PLSC sync as they were fetched before: one query joining the ssh_keys and service_aups"""
+    users = {}
+    for row in conn.execute(text(JOINED_USERS_QUERY)):
+        user = users.get(row[0])
+        if user is None:
+            user = users[row[0]] = {"id": row[0], "uid": row[1], "name": row[2], "given_name": row[3],
+                                    "family_name": row[4], "email": row[5], "scoped_affiliation": row[6],
+                                    "eduperson_principal_name": row[7], "username": row[8],
+                                    "status": "suspended" if row[10] else "active", "ssh_keys": [],
+                                    "accepted_aups": []}
+        if row[11] and row[11] not in user["ssh_keys"]:
+            user["ssh_keys"].append(row[11])
+        if row[12]:
+            aup = {"url": row[12], "service_id": row[13], "agreed_at": str(row[14])}
+            if aup not in user["accepted_aups"]:
+                user["accepted_aups"].append(aup)
+    return list(users.values())
+
+
+def _fastest(repeat, func):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def benchmark_users_sync(db, repeat=3):
+    """
+    Compare the number of rows the database transfers and the wall time for the users of the PLSC sync, when
+    joining the users with their ssh_keys and service_aups (before) and with separate queries merged on the
+    user_id (after). Run it after the stress-seed to get meaningful numbers.
+    """
+    with db.engine.connect() as conn:
+        before_rows = len(conn.execute(text(JOINED_USERS_QUERY)).fetchall())
+        after_rows = sum(len(conn.execute(text(sql)).fetchall()) for sql in SPLIT_QUERIES)
+        return {
+            "before": {"rows": before_rows, "seconds": _fastest(repeat, lambda: joined_users(conn))},
+            "after": {"rows": after_rows, "seconds": _fastest(repeat, lambda: list(_sync_users(conn)))},
+        }
+
+
+@contextlib.contextmanager
+def counted_statements(engine):
+    """Count the SQL statements executed on the engine within the context in the yielded list"""
+    statements = []
+
+    def before_cursor_execute(_conn, _cursor, statement, *_args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@contextlib.contextmanager
+def counted_lines(module):
+    """
+    Count the lines of the module executed within the context in the yielded list, a measure of the work of the
+    code that is independent of the speed of the machine
+    """
+    counter = [0]
+    filename = module.__file__
+
+    def trace_line(_frame, event, _arg):
+        if event == "line":
+            counter[0] += 1
+        return trace_line
+
+    def trace_call(frame, _event, _arg):
+        return trace_line if frame.f_code.co_filename == filename else None
+
+    previous = sys.gettrace()
+    sys.settrace(trace_call)
+    try:
+        yield counter
+    finally:
+        sys.settrace(previous)
+
+
+def benchmark_sync(db, repeat=3):
+    """
+    The number of collaboration memberships, the number of SQL statements and the wall time of the full PLSC
+    sync. The number of statements does not depend on the size of the data.
+    """
+    with counted_statements(db.engine) as statements:
+        result = internal_sync()
+    memberships = sum(len(coll["collaboration_memberships"]) for org in result["organisations"]
+                      for coll in org["collaborations"])
+    return {"memberships": memberships, "statements": len(statements), "seconds": _fastest(repeat, internal_sync)}
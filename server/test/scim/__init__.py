@@ -1,4 +1,51 @@
+import json
+import re
+from urllib.parse import urlparse, parse_qs
+
+from server.tools import read_file
+
 TEST_SCIM_SERVER = "http://localhost:8080/api/scim_mock"
 
 TEST_SCIM_USERS_ENDPOINT = f"{TEST_SCIM_SERVER}/Users"
 TEST_SCIM_GROUPS_ENDPOINT = f"{TEST_SCIM_SERVER}/Groups"
+TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT = f"{TEST_SCIM_SERVER}/ServiceProviderConfig"
+TEST_SCIM_BULK_ENDPOINT = f"{TEST_SCIM_SERVER}/Bulk"
+
+
+# Callback for the GET of TEST_SCIM_USERS_ENDPOINT, which finds all users of the (or-combined) externalId filter
+def scim_users_found(request):
+    user_found = json.loads(read_file("test/scim/user_found.json"))
+    query_filter = parse_qs(urlparse(request.url).query)["filter"][0]
+    external_ids = re.findall(r"externalId eq \"([^\"]*)\"", query_filter)
+    resources = [{**user_found["Resources"][0], "externalId": external_id} for external_id in external_ids]
+    return 200, {}, json.dumps({**user_found, "totalResults": len(resources), "Resources": resources})
+
+
+# The ServiceProviderConfig of the remote SCIM servers is cached in redis
+def clear_service_provider_configs(redis_client):
+    for key in redis_client.scan_iter("scim_service_provider_config_*"):
+        redis_client.delete(key)
+
+
+# The fingerprints of the payloads accepted by the remote SCIM servers are stored in redis
+def clear_fingerprints(redis_client):
+    for key in redis_client.scan_iter("scim_fingerprints_*"):
+        redis_client.delete(key)
+
+
+# Callback for the POST of TEST_SCIM_BULK_ENDPOINT, which returns a successful result for each operation
+def scim_bulk_succeeded(request):
+    operations = json.loads(request.body)["Operations"]
+    results = []
+    for operation in operations:
+        result = {"method": operation["method"], "status": "200"}
+        if operation["method"] == "POST":
+            location = f"{TEST_SCIM_SERVER}{operation['path']}/{operation['bulkId']}-id"
+            result.update({"bulkId": operation["bulkId"], "location": location, "status": "201"})
+        elif operation["method"] == "DELETE":
+            result["status"] = "204"
+        else:
+            result["location"] = f"{TEST_SCIM_SERVER}{operation['path']}"
+        results.append(result)
+    return 200, {}, json.dumps({"schemas": ["urn:ietf:params:scim:api:messages:2.0:BulkResponse"],
+                                "Operations": results})
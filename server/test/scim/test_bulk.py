@@ -0,0 +1,53 @@
+import json
+
+import responses
+
+from server.db.domain import Service
+from server.scim.bulk import BulkExecutor
+from server.test.abstract_test import AbstractTest
+from server.test.scim import TEST_SCIM_SERVER, TEST_SCIM_BULK_ENDPOINT, TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT, \
+    clear_service_provider_configs
+from server.test.seed import service_cloud_name
+
+
+class TestBulk(AbstractTest):
+
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        self.add_bearer_token_to_services()
+        clear_service_provider_configs(self.app.redis_client)
+        self.addCleanup(clear_service_provider_configs, self.app.redis_client)
+
+    @responses.activate
+    def test_results_matched_by_bulk_id_method_and_path(self):
+        def results_reversed(request):
+            operations = json.loads(request.body)["Operations"]
+            self.assertEqual(4, len(operations))
+            results = [
+                {"method": "PUT", "location": f"{TEST_SCIM_SERVER}/Users/d"},
+                {"method": "POST", "bulkId": "c", "status": "201", "location": f"{TEST_SCIM_SERVER}/Users/c-id"},
+                {"method": "DELETE", "location": f"{TEST_SCIM_SERVER}/Users/b", "status": "204"},
+                {"method": "PUT", "location": f"{TEST_SCIM_SERVER}/Users/a", "status": "200"}
+            ]
+            return 200, {}, json.dumps({"schemas": ["urn:ietf:params:scim:api:messages:2.0:BulkResponse"],
+                                        "Operations": results})
+
+        handled = []
+
+        def on_success(name):
+            return lambda response: handled.append((name, response.status_code, response.json().get("id")))
+
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT,
+                     json={"bulk": {"supported": True, "maxOperations": 10, "maxPayloadSize": 1048576}}, status=200)
+            rsps.add_callback(responses.POST, TEST_SCIM_BULK_ENDPOINT, callback=results_reversed,
+                              content_type="application/scim+json")
+            executor = BulkExecutor(self.find_entity_by_name(Service, service_cloud_name))
+            executor.submit("PUT", f"{TEST_SCIM_SERVER}/Users/a", on_success("a"), "a", json={})
+            executor.submit("DELETE", f"{TEST_SCIM_SERVER}/Users/b", on_success("b"), "b")
+            executor.submit("POST", f"{TEST_SCIM_SERVER}/Users", on_success("c"), "c", json={}, bulk_id="c")
+            executor.submit("PUT", f"{TEST_SCIM_SERVER}/Users/d", on_success("d"), "d", json={})
+            executor.join()
+
+        # The operation without a status failed
+        self.assertListEqual([("a", 200, "a"), ("b", 204, "b"), ("c", 201, "c-id")], handled)
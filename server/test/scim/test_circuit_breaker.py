@@ -0,0 +1,112 @@
+import unittest
+
+import requests
+import responses
+
+from server.scim.circuit_breaker import CircuitBreaker, CIRCUIT_CLOSED, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN, \
+    configure_circuit_breakers, circuit_breaker_statistics, CircuitOpenError
+from server.scim.session import scim_session, scim_request_metrics, reset_scim_request_metrics, \
+    prometheus_request_metrics
+from server.test.scim import TEST_SCIM_SERVER, TEST_SCIM_USERS_ENDPOINT
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.breaker = CircuitBreaker("https://scim.example.org", window_size=10, minimum_calls=4,
+                                      failure_rate_threshold=50, open_seconds=30, clock=lambda: self.now)
+
+    def _call(self, success: bool) -> bool:
+        allowed = self.breaker.allow_request()
+        if allowed:
+            self.breaker.record(success)
+        return allowed
+
+    def test_opens_on_failure_rate(self):
+        for success in [False, False, False]:
+            self._call(success)
+        # Not enough calls yet
+        self.assertEqual(CIRCUIT_CLOSED, self.breaker.state)
+        self._call(True)
+        self.assertEqual(CIRCUIT_OPEN, self.breaker.state)
+        self.assertFalse(self._call(True))
+        statistics = self.breaker.statistics()
+        self.assertEqual(75, statistics["failure_rate"])
+        self.assertEqual(30, statistics["retry_in_seconds"])
+        self.assertEqual(1, statistics["rejected_count"])
+
+    def test_stays_closed_below_threshold(self):
+        for success in [True, False, True, True, False, True, True]:
+            self.assertTrue(self._call(success))
+        self.assertEqual(CIRCUIT_CLOSED, self.breaker.state)
+
+    def test_half_open_probe(self):
+        for _ in range(4):
+            self._call(False)
+        self.now += 30
+        self.assertEqual(CIRCUIT_HALF_OPEN, self.breaker.state)
+        # Only one probe at the time
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+        self.assertTrue(self.breaker.is_open())
+        self.breaker.record(False)
+        self.assertEqual(CIRCUIT_OPEN, self.breaker.state)
+        self.assertEqual(2, self.breaker.statistics()["opened_count"])
+
+        self.now += 30
+        self.assertTrue(self._call(True))
+        self.assertEqual(CIRCUIT_CLOSED, self.breaker.state)
+        self.assertEqual(0, self.breaker.statistics()["calls"])
+
+    @responses.activate
+    def test_scim_session_fails_fast(self):
+        configure_circuit_breakers({"enabled": True, "minimum_calls": 2, "open_seconds": 300})
+        try:
+            responses.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, status=503)
+            session = scim_session(TEST_SCIM_SERVER)
+            for _ in range(2):
+                self.assertEqual(503, session.get(TEST_SCIM_USERS_ENDPOINT).status_code)
+            with self.assertRaises(CircuitOpenError):
+                session.get(TEST_SCIM_USERS_ENDPOINT)
+            self.assertTrue(issubclass(CircuitOpenError, requests.ConnectionError))
+            self.assertEqual(2, len(responses.calls))
+            statistics = circuit_breaker_statistics()
+            self.assertEqual(1, len(statistics))
+            self.assertEqual(TEST_SCIM_SERVER, statistics[0]["endpoint"])
+            self.assertEqual(CIRCUIT_OPEN, statistics[0]["state"])
+        finally:
+            configure_circuit_breakers({"enabled": False})
+
+    @responses.activate
+    def test_scim_session_request_metrics(self):
+        reset_scim_request_metrics()
+        configure_circuit_breakers({"enabled": True, "minimum_calls": 3, "open_seconds": 300})
+        try:
+            responses.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, status=200)
+            responses.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, status=503)
+            responses.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, body=requests.ConnectionError("unreachable"))
+            session = scim_session(TEST_SCIM_SERVER)
+            session.get(TEST_SCIM_USERS_ENDPOINT)
+            session.get(TEST_SCIM_USERS_ENDPOINT)
+            for error in [requests.ConnectionError, CircuitOpenError]:
+                with self.assertRaises(error):
+                    session.get(TEST_SCIM_USERS_ENDPOINT)
+
+            metrics = scim_request_metrics()
+            self.assertEqual(1, len(metrics))
+            self.assertEqual(TEST_SCIM_SERVER, metrics[0]["endpoint"])
+            self.assertEqual(4, metrics[0]["requests"])
+            self.assertEqual(1, metrics[0]["success"])
+            self.assertEqual(1, metrics[0]["failure"])
+            self.assertEqual(1, metrics[0]["error"])
+            self.assertEqual(1, metrics[0]["rejected"])
+            # The rejected request is not sent
+            self.assertEqual(3, metrics[0]["seconds"]["count"])
+
+            text = prometheus_request_metrics(metrics)
+            self.assertIn(f'scim_requests_rejected_total{{endpoint="{TEST_SCIM_SERVER}"}} 1', text)
+            self.assertIn(f'scim_requests_seconds_bucket{{endpoint="{TEST_SCIM_SERVER}",le="+Inf"}} 3', text)
+        finally:
+            configure_circuit_breakers({"enabled": False})
+            reset_scim_request_metrics()
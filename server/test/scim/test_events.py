@@ -12,7 +12,8 @@ from server.scim.events import broadcast_user_changed, broadcast_user_deleted, b
     broadcast_organisation_deleted, broadcast_group_changed, broadcast_service_added, \
     broadcast_service_deleted, broadcast_group_deleted
 from server.test.abstract_test import AbstractTest
-from server.test.scim import TEST_SCIM_USERS_ENDPOINT, TEST_SCIM_GROUPS_ENDPOINT
+from server.test.scim import TEST_SCIM_USERS_ENDPOINT, TEST_SCIM_GROUPS_ENDPOINT, scim_users_found, \
+    TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT, clear_service_provider_configs, clear_fingerprints
 from server.test.seed import user_sarah_name, co_research_name, group_ai_researchers, unifra_name, service_cloud_name, \
     user_peter_name
 from server.tools import read_file
@@ -33,6 +34,7 @@ class TestEvents(AbstractTest):
     def setUp(self):
         super(TestEvents, self).setUp()
         self.add_bearer_token_to_services()
+        clear_service_provider_configs(self.app.redis_client)
 
     @responses.activate
     def test_apply_user_change_create(self):
@@ -44,6 +46,27 @@ class TestEvents(AbstractTest):
             rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, json=user_created, status=201)
             broadcast_user_changed(sarah.id).result()
 
+    @responses.activate
+    def test_apply_user_change_unchanged_fingerprint(self):
+        peter = self.find_entity_by_name(User, user_peter_name)
+        no_user_found = json.loads(read_file("test/scim/no_user_found.json"))
+        user_created = json.loads(read_file("test/scim/user_created.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=no_user_found, status=200)
+            rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, json=user_created, status=201)
+            broadcast_user_changed(peter.id).result()
+            # The remote SCIM server already accepted the same user
+            broadcast_user_changed(peter.id).result()
+            self.assertEqual(2, len(rsps.calls))
+
+            peter = self.find_entity_by_name(User, user_peter_name)
+            peter.email = "changed@example.com"
+            self.save_entity(peter)
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=no_user_found, status=200)
+            rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, json=user_created, status=201)
+            broadcast_user_changed(peter.id).result()
+            self.assertEqual(4, len(rsps.calls))
+
     @responses.activate
     def test_apply_user_change_create_provisioning_error(self):
         sarah = self.find_entity_by_name(User, user_sarah_name)
@@ -79,12 +102,12 @@ class TestEvents(AbstractTest):
     @responses.activate
     def test_apply_user_change_delete(self):
         sarah = self.find_entity_by_name(User, user_sarah_name)
-        user_found = json.loads(read_file("test/scim/user_found.json"))
         group_found = json.loads(read_file("test/scim/group_found.json"))
         group_created = json.loads(read_file("test/scim/group_created.json"))
         with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
             rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, json=group_found, status=200)
-            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=user_found, status=200)
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=scim_users_found,
+                              content_type="application/json")
             rsps.add(responses.DELETE,
                      f"{TEST_SCIM_USERS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
                      status=201)
@@ -112,16 +135,108 @@ class TestEvents(AbstractTest):
     def test_apply_group_change_update_existing_users(self):
         group_found = json.loads(read_file("test/scim/group_found.json"))
         group_created = json.loads(read_file("test/scim/group_created.json"))
-        user_found = json.loads(read_file("test/scim/user_found.json"))
         collaboration = self.find_entity_by_name(Collaboration, co_research_name)
         with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
             rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, json=group_found, status=200)
             # We mock that all members are already known in the remote SCIM DB
-            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=user_found, status=200)
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=scim_users_found,
+                              content_type="application/json")
             rsps.add(responses.PUT, f"{TEST_SCIM_GROUPS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
                      json=group_created, status=201)
             broadcast_collaboration_changed(collaboration.id).result()
 
+    @responses.activate
+    def test_apply_group_change_patch_members(self):
+        group_found = json.loads(read_file("test/scim/group_found.json"))
+        collaboration = self.find_entity_by_name(Collaboration, co_research_name)
+        members = [m for m in collaboration.collaboration_memberships if m.is_active()]
+        self.addCleanup(clear_service_provider_configs, self.app.redis_client)
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT, json={"patch": {"supported": True}},
+                     status=200)
+            rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, json=group_found, status=200)
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=scim_users_found,
+                              content_type="application/json")
+            rsps.add(responses.PATCH, f"{TEST_SCIM_GROUPS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
+                     status=204)
+            broadcast_collaboration_changed(collaboration.id).result()
+
+            # The collaboration is the last one patched, after its groups
+            patch_calls = [call for call in rsps.calls if call.request.method == responses.PATCH]
+            operations = json.loads(patch_calls[-1].request.body)["Operations"]
+            self.assertEqual("replace", operations[0]["op"])
+            self.assertEqual(collaboration.name, operations[0]["value"]["displayName"])
+            self.assertEqual("add", operations[1]["op"])
+            self.assertEqual(len(members), len(operations[1]["value"]))
+
+            # The PATCH support of the remote SCIM server is cached
+            clear_fingerprints(self.app.redis_client)
+            broadcast_collaboration_changed(collaboration.id).result()
+            config_calls = [call for call in rsps.calls if call.request.url.endswith("/ServiceProviderConfig")]
+            self.assertEqual(1, len(config_calls))
+
+    @responses.activate
+    def test_apply_group_change_patch_rejected(self):
+        group_found = json.loads(read_file("test/scim/group_found.json"))
+        group_created = json.loads(read_file("test/scim/group_created.json"))
+        collaboration = self.find_entity_by_name(Collaboration, co_research_name)
+        self.addCleanup(clear_service_provider_configs, self.app.redis_client)
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT, json={"patch": {"supported": True}},
+                     status=200)
+            rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, json=group_found, status=200)
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=scim_users_found,
+                              content_type="application/json")
+            rsps.add(responses.PATCH, f"{TEST_SCIM_GROUPS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
+                     status=501)
+            rsps.add(responses.PUT, f"{TEST_SCIM_GROUPS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
+                     json=group_created, status=201)
+            broadcast_collaboration_changed(collaboration.id).result()
+            self.assertListEqual([False], self._cached_patch_support())
+
+    @responses.activate
+    def test_apply_group_change_patch_no_target(self):
+        group_found = json.loads(read_file("test/scim/group_found.json"))
+        group_created = json.loads(read_file("test/scim/group_created.json"))
+        collaboration = self.find_entity_by_name(Collaboration, co_research_name)
+        self.addCleanup(clear_service_provider_configs, self.app.redis_client)
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT, json={"patch": {"supported": True}},
+                     status=200)
+            rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, json=group_found, status=200)
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=scim_users_found,
+                              content_type="application/json")
+            rsps.add(responses.PATCH, f"{TEST_SCIM_GROUPS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
+                     json={"status": "400", "scimType": "noTarget"}, status=400)
+            rsps.add(responses.PUT, f"{TEST_SCIM_GROUPS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
+                     json=group_created, status=201)
+            broadcast_collaboration_changed(collaboration.id).result()
+            self.assertListEqual([False], self._cached_patch_support())
+
+    @responses.activate
+    def test_apply_group_change_patch_invalid_value(self):
+        group_found = json.loads(read_file("test/scim/group_found.json"))
+        collaboration = self.find_entity_by_name(Collaboration, co_research_name)
+        self.addCleanup(clear_service_provider_configs, self.app.redis_client)
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT, json={"patch": {"supported": True}},
+                     status=200)
+            rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, json=group_found, status=200)
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=scim_users_found,
+                              content_type="application/json")
+            rsps.add(responses.PATCH, f"{TEST_SCIM_GROUPS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
+                     json={"status": "400", "scimType": "invalidValue"}, status=400)
+            broadcast_collaboration_changed(collaboration.id).result()
+
+            # An error of the group itself is no reason to stop using PATCH
+            put_calls = [call for call in rsps.calls if call.request.method == responses.PUT]
+            self.assertEqual(0, len(put_calls))
+            self.assertListEqual([True], self._cached_patch_support())
+
+    def _cached_patch_support(self):
+        return [json.loads(self.app.redis_client.get(key))["patch"]["supported"]
+                for key in self.app.redis_client.scan_iter("scim_service_provider_config_*")]
+
     @responses.activate
     def test_apply_group_change_delete_existing_users(self):
         group_found = json.loads(read_file("test/scim/group_found.json"))
@@ -1,7 +1,7 @@
 import threading
 import unittest
 
-from server.scim.fifo_pool import FifoPool
+from server.scim.fifo_pool import FifoPool, prometheus_metrics
 
 
 class TestFifoPool(unittest.TestCase):
@@ -78,3 +78,42 @@ class TestFifoPool(unittest.TestCase):
         self.assertTrue(done.wait(timeout=2), "Task after exception did not run")
         pool.shutdown(wait=True)
         self.assertEqual(["ok"], output)
+
+    def test_metrics(self):
+        pool = FifoPool(max_workers=1)
+        release = threading.Event()
+
+        def blocking():
+            self.assertTrue(release.wait(timeout=2), "Timed out waiting to release the blocking task")
+
+        def failing():
+            raise ValueError("failure")
+
+        pool.submit("endpoint-a", blocking)
+        pool.submit("endpoint-a", failing)
+        last = pool.submit("endpoint-a", len, "abc")
+
+        metrics = pool.metrics()
+        self.assertEqual(1, len(metrics))
+        self.assertEqual("endpoint-a", metrics[0]["key"])
+        self.assertEqual(2, metrics[0]["depth"])
+        self.assertEqual(3, metrics[0]["submitted"])
+        self.assertIsNotNone(metrics[0]["oldest_pending_age_seconds"])
+
+        release.set()
+        self.assertEqual(3, last.result(timeout=2))
+        pool.shutdown(wait=True)
+
+        metrics = pool.metrics()[0]
+        self.assertEqual(0, metrics["depth"])
+        self.assertIsNone(metrics["oldest_pending_age_seconds"])
+        self.assertEqual(2, metrics["completed"])
+        self.assertEqual(1, metrics["failed"])
+        self.assertEqual(3, metrics["wait_seconds"]["count"])
+        self.assertEqual(3, metrics["run_seconds"]["count"])
+        self.assertEqual(3, metrics["run_seconds"]["buckets"]["+Inf"])
+
+        text = prometheus_metrics([metrics])
+        self.assertIn('scim_fifo_pool_failed_total{key="endpoint-a"} 1', text)
+        self.assertIn('scim_fifo_pool_run_seconds_bucket{key="endpoint-a",le="+Inf"} 3', text)
+        self.assertIn('scim_fifo_pool_oldest_pending_age_seconds{key="endpoint-a"} 0', text)
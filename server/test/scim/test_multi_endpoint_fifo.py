@@ -66,6 +66,7 @@ def scim_remote_host(index: int) -> str:
 def _install_async_scim_pool(app: Flask) -> None:
     os.environ.pop("SCIM_FIFO_SYNC", None)
     os.environ["SCIM_FIFO_WORKERS"] = str(SCIM_FIFO_WORKERS)
+    os.environ["SCIM_FINGERPRINTS"] = "0"
     with app.app_context():
         reset_scim_fifo_pool(app)
 
@@ -301,6 +302,7 @@ class TestScimMultiEndpointFifo(AbstractTest):
             ensure_scim_pool_idle(cls.app)
         os.environ["SCIM_FIFO_SYNC"] = "1"
         os.environ["SCIM_DISABLED"] = "1"
+        os.environ.pop("SCIM_FINGERPRINTS", None)
         super().tearDownClass()
 
     def setUp(self):
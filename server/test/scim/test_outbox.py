@@ -0,0 +1,191 @@
+import datetime
+import json
+import os
+
+import responses
+
+from server.cron.scim_outbox import scim_outbox
+from server.db.db import db
+from server.db.domain import User, ScimOutboxMessage
+from server.scim.circuit_breaker import configure_circuit_breakers, circuit_breaker
+from server.scim.events import broadcast_user_changed
+from server.scim.outbox import outbox_statistics, OUTBOX_PENDING, OUTBOX_DEAD_LETTER, enqueue_outbox_message, \
+    deliver_outbox
+from server.scim.scim import apply_user_change
+from server.test.abstract_test import AbstractTest
+from server.test.scim import TEST_SCIM_USERS_ENDPOINT, TEST_SCIM_SERVER
+from server.test.seed import user_peter_name
+from server.tools import read_file, dt_now
+
+
+class TestOutbox(AbstractTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestOutbox, cls).setUpClass()
+        del os.environ["SCIM_DISABLED"]
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestOutbox, cls).tearDownClass()
+        os.environ["SCIM_DISABLED"] = "1"
+
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+        self.add_bearer_token_to_services()
+
+    @staticmethod
+    def _messages():
+        # End the transaction to see the changes of the delivery
+        db.session.commit()
+        return ScimOutboxMessage.query.order_by(ScimOutboxMessage.id).all()
+
+    @responses.activate
+    def test_delivered_message_is_removed(self):
+        peter = self.find_entity_by_name(User, user_peter_name)
+        no_user_found = json.loads(read_file("test/scim/no_user_found.json"))
+        user_created = json.loads(read_file("test/scim/user_created.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=no_user_found, status=200)
+            rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, json=user_created, status=201)
+            broadcast_user_changed(peter.id).result()
+        self.assertListEqual([], self._messages())
+        self.assertListEqual([], outbox_statistics())
+
+    @responses.activate
+    def test_retry_with_backoff_and_dead_letter(self):
+        peter = self.find_entity_by_name(User, user_peter_name)
+        no_user_found = json.loads(read_file("test/scim/no_user_found.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=no_user_found, status=200)
+            rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, status=503)
+            broadcast_user_changed(peter.id).result()
+
+        messages = self._messages()
+        self.assertEqual(1, len(messages))
+        message = messages[0]
+        self.assertEqual(OUTBOX_PENDING, message.status)
+        self.assertEqual(1, message.attempts)
+        self.assertEqual("apply_user_change", message.task)
+        self.assertGreater(message.next_attempt_at, dt_now())
+
+        statistics = outbox_statistics()
+        self.assertEqual(1, len(statistics))
+        self.assertEqual(TEST_SCIM_SERVER, statistics[0]["endpoint"])
+        self.assertEqual(1, statistics[0]["depth"])
+        self.assertEqual(0, statistics[0]["dead_letters"])
+
+        # Not yet due
+        self.assertListEqual([], scim_outbox(self.app)["endpoints"])
+
+        message.next_attempt_at = dt_now() - datetime.timedelta(seconds=1)
+        message.attempts = self.app.app_config.scim_outbox.max_attempts - 1
+        db.session.merge(message)
+        db.session.commit()
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=no_user_found, status=200)
+            rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, status=503)
+            self.assertListEqual([TEST_SCIM_SERVER], scim_outbox(self.app)["endpoints"])
+
+        messages = self._messages()
+        self.assertEqual(OUTBOX_DEAD_LETTER, messages[0].status)
+        self.assertEqual(0, outbox_statistics()[0]["depth"])
+        self.assertEqual(1, outbox_statistics()[0]["dead_letters"])
+
+    @responses.activate
+    def test_failed_message_blocks_later_messages(self):
+        peter = self.find_entity_by_name(User, user_peter_name)
+        no_user_found = json.loads(read_file("test/scim/no_user_found.json"))
+        user_created = json.loads(read_file("test/scim/user_created.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=no_user_found, status=200)
+            rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, status=429)
+            broadcast_user_changed(peter.id).result()
+            # The second change waits for the first one to be delivered
+            broadcast_user_changed(peter.id).result()
+            self.assertEqual(2, len(rsps.calls))
+        self.assertEqual(2, len(self._messages()))
+
+        message = self._messages()[0]
+        message.next_attempt_at = dt_now() - datetime.timedelta(seconds=1)
+        db.session.merge(message)
+        db.session.commit()
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=no_user_found, status=200)
+            rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, json=user_created, status=201)
+            scim_outbox(self.app)
+            # The second change is skipped, as the remote SCIM server already accepted the same user
+            self.assertEqual(2, len(rsps.calls))
+        self.assertListEqual([], self._messages())
+
+    @responses.activate
+    def test_identical_pending_message_is_coalesced(self):
+        peter = self.find_entity_by_name(User, user_peter_name)
+        no_user_found = json.loads(read_file("test/scim/no_user_found.json"))
+        user_created = json.loads(read_file("test/scim/user_created.json"))
+        self.app.app_config.scim_outbox.coalesce = True
+        try:
+            with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+                rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=no_user_found, status=200)
+                rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, status=429)
+                broadcast_user_changed(peter.id).result()
+            self.assertEqual(1, len(self._messages()))
+
+            with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+                rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=no_user_found, status=200)
+                rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, json=user_created, status=201)
+                # The failed change is skipped instead of blocking the newer identical one
+                broadcast_user_changed(peter.id).result()
+                self.assertEqual(2, len(rsps.calls))
+            self.assertListEqual([], self._messages())
+            self.assertEqual(1, outbox_statistics()[0]["coalesced"])
+        finally:
+            self.app.app_config.scim_outbox.coalesce = False
+
+    def test_only_adjacent_identical_messages_are_coalesced(self):
+        delivered = []
+        tasks = {"apply_user_change": lambda app, user_id, service_ids: delivered.append(("user", user_id)) or True,
+                 "apply_group_change": lambda app, group_id, service_ids: delivered.append(("group", group_id)) or True}
+        for task, argument in [("apply_user_change", 1), ("apply_group_change", 2), ("apply_user_change", 1),
+                               ("apply_user_change", 1)]:
+            enqueue_outbox_message(TEST_SCIM_SERVER, task, [argument], [1])
+        db.session.commit()
+        self.app.app_config.scim_outbox.coalesce = True
+        try:
+            self.assertEqual(3, deliver_outbox(self.app, TEST_SCIM_SERVER, tasks))
+        finally:
+            self.app.app_config.scim_outbox.coalesce = False
+        # The first user change is not moved past the group change
+        self.assertListEqual([("user", 1), ("group", 2), ("user", 1)], delivered)
+        self.assertListEqual([], self._messages())
+        self.assertEqual(1, outbox_statistics()[0]["coalesced"])
+
+    @responses.activate
+    def test_open_circuit_parks_messages(self):
+        peter = self.find_entity_by_name(User, user_peter_name)
+        configure_circuit_breakers({"enabled": True, "minimum_calls": 1, "open_seconds": 300})
+        try:
+            circuit_breaker(TEST_SCIM_SERVER).record(False)
+            with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+                broadcast_user_changed(peter.id).result()
+                self.assertEqual(0, len(rsps.calls))
+            messages = self._messages()
+            self.assertEqual(1, len(messages))
+            # An open circuit does not count as a failed attempt
+            self.assertEqual(0, messages[0].attempts)
+            self.assertEqual(OUTBOX_PENDING, messages[0].status)
+        finally:
+            configure_circuit_breakers(self.app.app_config.get("scim_circuit_breaker"))
+
+    def test_open_circuit_fails_fast_on_apply(self):
+        peter = self.find_entity_by_name(User, user_peter_name)
+        configure_circuit_breakers({"enabled": True, "minimum_calls": 1, "open_seconds": 300})
+        try:
+            circuit_breaker(TEST_SCIM_SERVER).record(False)
+            with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+                # Every SCIM request goes through the circuit breaker of the endpoint, not only the outbox delivery
+                delivered = apply_user_change(self.app, peter.id)
+                self.assertFalse(delivered)
+                self.assertEqual(0, len(rsps.calls))
+        finally:
+            configure_circuit_breakers(self.app.app_config.get("scim_circuit_breaker"))
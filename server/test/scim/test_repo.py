@@ -0,0 +1,96 @@
+import time
+import uuid
+
+from sqlalchemy import event
+
+from server.db.db import db
+from server.db.domain import Service, Collaboration, Group, User, CollaborationMembership, SshKey
+from server.scim.group_template import find_groups_template
+from server.scim.repo import all_scim_groups_by_service, all_scim_users_by_service, paged_scim_groups, \
+    paged_scim_users, scim_users_query, changed_scim_objects_by_service
+from server.scim.sweep import services_sharing_remote_state
+from server.scim.user_template import find_users_template
+from server.test.abstract_test import AbstractTest
+from server.test.seed import service_network_name, co_ai_computing_name, group_ai_researchers, service_cloud_name, \
+    user_sarah_name, user_roger_name, co_research_name
+from server.tools import dt_now
+
+
+class TestRepo(AbstractTest):
+
+    def _statement_count(self, render):
+        db.session.expunge_all()
+        service = self.find_entity_by_name(Service, service_network_name)
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            render(service)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+        return len(statements)
+
+    def _add_members(self, count: int):
+        collaboration = self.find_entity_by_name(Collaboration, co_ai_computing_name)
+        group = self.find_entity_by_name(Group, group_ai_researchers)
+        for i in range(count):
+            user = User(uid=f"urn:repo_{i}", name=f"Repo {i}", email=f"repo_{i}@example.org", username=f"repo_{i}",
+                        external_id=str(uuid.uuid4()), created_by="test", updated_by="test")
+            user.ssh_keys.append(SshKey(ssh_value=f"ssh-rsa repo_{i}"))
+            membership = CollaborationMembership(role="member", user=user, collaboration=collaboration,
+                                                 created_by="test", updated_by="test")
+            group.collaboration_memberships.append(membership)
+            db.session.add(user)
+        db.session.commit()
+
+    def test_sweep_objects_constant_statements(self):
+        def render(service):
+            find_groups_template(all_scim_groups_by_service(service))
+            find_users_template(all_scim_users_by_service(service))
+
+        statement_count = self._statement_count(render)
+        self._add_members(10)
+        self.assertEqual(statement_count, self._statement_count(render))
+
+    def test_paged_objects_constant_statements(self):
+        def render(service):
+            groups, total_results = paged_scim_groups(service, 1, None)
+            find_groups_template(groups, total_results)
+            users, total_results = paged_scim_users(scim_users_query(service), 1, None)
+            find_users_template(users, total_results)
+
+        statement_count = self._statement_count(render)
+        self._add_members(10)
+        self.assertEqual(statement_count, self._statement_count(render))
+
+    def test_changed_objects_deletions_scoped(self):
+        self.add_bearer_token_to_services()
+        cloud = self.find_entity_by_name(Service, service_cloud_name)
+        cloud.sweep_scim_enabled = True
+        self.save_entity(cloud)
+        since = dt_now()
+        # The audit logs are stored in whole seconds
+        time.sleep(1)
+        sarah = self.find_entity_by_name(User, user_sarah_name)
+        roger = self.find_entity_by_name(User, user_roger_name)
+        sarah_external_id = sarah.external_id
+        for user, collaboration_name in [(sarah, co_ai_computing_name), (roger, co_research_name)]:
+            db.session.delete(CollaborationMembership.query
+                              .join(CollaborationMembership.collaboration)
+                              .filter(CollaborationMembership.user_id == user.id)
+                              .filter(Collaboration.name == collaboration_name)
+                              .one())
+        db.session.commit()
+
+        network = self.find_entity_by_name(Service, service_network_name)
+        # Roger left a collaboration of the cloud service only
+        deleted_user_external_ids = changed_scim_objects_by_service(network, since)["deleted_user_external_ids"]
+        self.assertListEqual([sarah_external_id], deleted_user_external_ids)
+        # Sarah is still a member of a collaboration of the cloud service, which shares the remote SCIM state
+        owners = services_sharing_remote_state(network)
+        self.assertEqual(2, len(owners))
+        deleted_user_external_ids = changed_scim_objects_by_service(network, since, owners)["deleted_user_external_ids"]
+        self.assertListEqual([], deleted_user_external_ids)
@@ -1,9 +1,11 @@
 import json
+from urllib.parse import urlparse, parse_qs
 
 import responses
 
 from server.db.domain import Collaboration, Service
-from server.test.scim import TEST_SCIM_USERS_ENDPOINT
+from server.test.scim import TEST_SCIM_USERS_ENDPOINT, scim_users_found, TEST_SCIM_BULK_ENDPOINT, \
+    TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT, clear_service_provider_configs, scim_bulk_succeeded
 from server.scim.scim import membership_user_scim_objects
 from server.test.abstract_test import AbstractTest
 from server.test.seed import co_research_name, service_cloud_name
@@ -28,3 +30,60 @@ class TestScim(AbstractTest):
             service = self.find_entity_by_name(Service, service_cloud_name)
             identifiers = membership_user_scim_objects(service, collaboration)
             self.assertListEqual([], identifiers)
+
+    @responses.activate
+    def test_membership_user_scim_objects_batched(self):
+        self.add_bearer_token_to_services()
+        service = self.find_entity_by_name(Service, service_cloud_name)
+        collaboration = self.find_entity_by_name(Collaboration, co_research_name)
+        members = [m for m in collaboration.collaboration_memberships if m.is_active()]
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=scim_users_found,
+                              content_type="application/json")
+            scim_objects = membership_user_scim_objects(service, collaboration)
+            self.assertEqual(len(members), len(scim_objects))
+            self.assertEqual(1, len(rsps.calls))
+            # The remote users are cached for the rest of the broadcast
+            membership_user_scim_objects(service, collaboration)
+            self.assertEqual(1, len(rsps.calls))
+
+    @responses.activate
+    def test_membership_user_scim_objects_or_filter_rejected(self):
+        def or_filter_rejected(request):
+            query_filter = parse_qs(urlparse(request.url).query)["filter"][0]
+            if " or " in query_filter:
+                return 400, {}, json.dumps({"scimType": "invalidFilter", "status": "400"})
+            return scim_users_found(request)
+
+        self.add_bearer_token_to_services()
+        service = self.find_entity_by_name(Service, service_cloud_name)
+        collaboration = self.find_entity_by_name(Collaboration, co_research_name)
+        members = [m for m in collaboration.collaboration_memberships if m.is_active()]
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=or_filter_rejected,
+                              content_type="application/json")
+            scim_objects = membership_user_scim_objects(service, collaboration)
+            self.assertEqual(len(members), len(scim_objects))
+            self.assertEqual(1 + len(members), len(rsps.calls))
+
+    @responses.activate
+    def test_membership_user_scim_objects_bulk(self):
+        self.add_bearer_token_to_services()
+        clear_service_provider_configs(self.app.redis_client)
+        self.addCleanup(clear_service_provider_configs, self.app.redis_client)
+        service = self.find_entity_by_name(Service, service_cloud_name)
+        collaboration = self.find_entity_by_name(Collaboration, co_research_name)
+        members = [m for m in collaboration.collaboration_memberships if m.is_active()]
+        no_user_found = json.loads(read_file("test/scim/no_user_found.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT,
+                     json={"bulk": {"supported": True, "maxOperations": 2, "maxPayloadSize": 1048576}}, status=200)
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=no_user_found, status=200)
+            rsps.add_callback(responses.POST, TEST_SCIM_BULK_ENDPOINT, callback=scim_bulk_succeeded,
+                              content_type="application/scim+json")
+            scim_objects = membership_user_scim_objects(service, collaboration)
+            # The unknown users are provisioned in bulk requests of at most maxOperations
+            bulk_calls = [call for call in rsps.calls if call.request.url == TEST_SCIM_BULK_ENDPOINT]
+            self.assertEqual((len(members) + 1) // 2, len(bulk_calls))
+            self.assertListEqual(sorted(f"{m.user.external_id}-id" for m in members),
+                                 sorted(scim_object["value"] for scim_object in scim_objects))
@@ -1,5 +1,10 @@
 import json
+import re
+import time
+from urllib.parse import urlparse, parse_qs
+
 import responses
+from responses import matchers
 
 from datetime import timedelta
 from werkzeug.exceptions import BadRequest
@@ -7,17 +12,25 @@ from werkzeug.exceptions import BadRequest
 from server.api.base import application_base_url
 from server.db.domain import Service, Group, User, Collaboration
 
-from server.scim import SCIM_GROUPS
+from server.db.db import db
+from server.scim import SCIM_GROUPS, SCIM_USERS, EXTERNAL_ID_POST_FIX
+from server.scim.bulk import bulk_id_reference
+from server.scim.fingerprint import group_fingerprint, store_fingerprints, stored_fingerprints
 from server.scim.group_template import create_group_template, scim_member_object
 from server.scim.repo import all_scim_groups_by_service
-from server.scim.sweep import perform_sweep, _all_remote_scim_objects, _group_changed, _user_changed
+from server.scim.sweep import perform_sweep, perform_incremental_sweep, _all_remote_scim_objects, _group_changed, \
+    _user_changed, SweepExecutor, sweep_concurrency, perform_endpoint_sweep, group_services_by_remote_state, \
+    _group_fingerprint
 from server.scim.schema_template import get_scim_schema_sram_group
 from server.scim.user_template import create_user_template, find_user_by_id_template
 
-from server.test.scim import TEST_SCIM_SERVER, TEST_SCIM_USERS_ENDPOINT, TEST_SCIM_GROUPS_ENDPOINT
+from server.test.scim import TEST_SCIM_SERVER, TEST_SCIM_USERS_ENDPOINT, TEST_SCIM_GROUPS_ENDPOINT, \
+    TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT, TEST_SCIM_BULK_ENDPOINT, clear_service_provider_configs, \
+    scim_bulk_succeeded, scim_users_found
 from server.test.abstract_test import AbstractTest
-from server.test.seed import service_network_name, group_ai_researchers, user_john_name, co_ai_computing_name
-from server.tools import read_file
+from server.test.seed import service_network_name, group_ai_researchers, user_john_name, co_ai_computing_name, \
+    group_ai_researchers_identifier, service_cloud_name
+from server.tools import read_file, dt_now
 
 
 class TestSweep(AbstractTest):
@@ -40,7 +53,8 @@ class TestSweep(AbstractTest):
             self.assertDictEqual({
                 "users": {"deleted": [], "created": [], "updated": []},
                 "groups": {"deleted": [], "created": [], "updated": []},
-                "scim_url": TEST_SCIM_SERVER
+                "scim_url": TEST_SCIM_SERVER,
+                "failed": 0
             }, sync_results)
 
     @responses.activate
@@ -79,6 +93,185 @@ class TestSweep(AbstractTest):
             self.assertEqual(1, len(sync_results["groups"]["created"]))
             self.assertEqual(2, len(sync_results["groups"]["updated"]))
 
+    @responses.activate
+    def test_sweep_services_sharing_endpoint(self):
+        network = self.find_entity_by_name(Service, service_network_name)
+        cloud = self.find_entity_by_name(Service, service_cloud_name)
+        self.assertIn([network, cloud], group_services_by_remote_state([network, cloud]))
+
+        remote_groups = json.loads(read_file("test/scim/sweep/remote_groups_unchanged.json"))
+        remote_users = json.loads(read_file("test/scim/sweep/remote_users_unchanged.json"))
+        user_created = json.loads(read_file("test/scim/user_created.json"))
+        group_created = json.loads(read_file("test/scim/group_created.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=remote_users, status=200)
+            rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, json=remote_groups, status=200)
+            rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, json=user_created, status=201)
+            rsps.add(responses.POST, TEST_SCIM_GROUPS_ENDPOINT, json=group_created, status=201)
+            rsps.add(responses.PUT, re.compile(f"{TEST_SCIM_SERVER}/.*"), json=group_created, status=200)
+
+            results = perform_endpoint_sweep([network, cloud])
+
+            # The remote state is fetched once for both services
+            get_calls = [call for call in rsps.calls if call.request.method == responses.GET]
+            self.assertEqual(2, len(get_calls))
+            # The remote objects of the network service are not deleted by the sweep of the cloud service
+            delete_calls = [call for call in rsps.calls if call.request.method == responses.DELETE]
+            self.assertEqual(0, len(delete_calls))
+            self.assertEqual(0, len(results[network.id]["groups"]["created"]))
+            self.assertTrue(len(results[cloud.id]["groups"]["created"]) > 0)
+
+    @responses.activate
+    def test_sweep_scoped_to_service(self):
+        network = self.find_entity_by_name(Service, service_network_name)
+        cloud = self.find_entity_by_name(Service, service_cloud_name)
+        cloud.sweep_scim_enabled = True
+        self.save_entity(cloud)
+        cloud = self.find_entity_by_name(Service, service_cloud_name)
+        store_fingerprints(network, {(SCIM_USERS, "network-user"): "fingerprint"})
+
+        remote_groups = json.loads(read_file("test/scim/sweep/remote_groups_unchanged.json"))
+        remote_users = json.loads(read_file("test/scim/sweep/remote_users_unchanged.json"))
+        user_created = json.loads(read_file("test/scim/user_created.json"))
+        group_created = json.loads(read_file("test/scim/group_created.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=remote_users, status=200)
+            rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, json=remote_groups, status=200)
+            rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, json=user_created, status=201)
+            rsps.add(responses.POST, TEST_SCIM_GROUPS_ENDPOINT, json=group_created, status=201)
+            rsps.add(responses.PUT, re.compile(f"{TEST_SCIM_SERVER}/.*"), json=group_created, status=200)
+
+            results = perform_sweep(cloud)
+
+            # The remote objects of the network service are kept
+            self.assertNotIn(responses.DELETE, {call.request.method for call in rsps.calls})
+            self.assertTrue(len(results["groups"]["created"]) > 0)
+        # The fingerprints of the network service are not replaced
+        self.assertEqual("fingerprint", stored_fingerprints(network, SCIM_USERS, ["network-user"])["network-user"])
+
+    @responses.activate
+    def test_sweep_changes_bulk(self):
+        clear_service_provider_configs(self.app.redis_client)
+        self.addCleanup(clear_service_provider_configs, self.app.redis_client)
+        service = self.find_entity_by_name(Service, service_network_name)
+        remote_groups = json.loads(read_file("test/scim/sweep/remote_groups_changes.json"))
+        remote_users = json.loads(read_file("test/scim/sweep/remote_users_changes.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.GET, TEST_SCIM_SERVICE_PROVIDER_CONFIG_ENDPOINT,
+                     json={"bulk": {"supported": True, "maxOperations": 3, "maxPayloadSize": 1048576}}, status=200)
+            rsps.add(responses.GET, TEST_SCIM_USERS_ENDPOINT, json=remote_users, status=200)
+            rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, json=remote_groups, status=200)
+            rsps.add_callback(responses.POST, TEST_SCIM_BULK_ENDPOINT, callback=scim_bulk_succeeded,
+                              content_type="application/scim+json")
+
+            sync_results = perform_sweep(service)
+            self.assertEqual(1, len(sync_results["users"]["deleted"]))
+            self.assertEqual(2, len(sync_results["users"]["created"]))
+            self.assertEqual(1, len(sync_results["users"]["updated"]))
+            self.assertEqual(1, len(sync_results["groups"]["deleted"]))
+            self.assertEqual(1, len(sync_results["groups"]["created"]))
+            self.assertEqual(2, len(sync_results["groups"]["updated"]))
+
+            bulk_requests = [json.loads(call.request.body) for call in rsps.calls
+                             if call.request.url == TEST_SCIM_BULK_ENDPOINT]
+            self.assertTrue(all(len(bulk_request["Operations"]) <= 3 for bulk_request in bulk_requests))
+            # A new user is referenced by its bulkId in the same bulk request and by its id in later ones
+            for bulk_request in bulk_requests:
+                bulk_ids = {operation.get("bulkId") for operation in bulk_request["Operations"]}
+                for operation in bulk_request["Operations"]:
+                    for member in operation.get("data", {}).get("members", []):
+                        if member["value"].startswith("bulkId:"):
+                            self.assertIn(member["value"][len("bulkId:"):], bulk_ids)
+
+    @responses.activate
+    def test_incremental_sweep_no_changes(self):
+        service = self.find_entity_by_name(Service, service_network_name)
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            sync_results = perform_incremental_sweep(service, dt_now() + timedelta(minutes=1))
+            self.assertEqual(0, len(rsps.calls))
+            self.assertDictEqual({
+                "users": {"deleted": [], "created": [], "updated": []},
+                "groups": {"deleted": [], "created": [], "updated": []},
+                "scim_url": TEST_SCIM_SERVER,
+                "failed": 0
+            }, sync_results)
+
+    @responses.activate
+    def test_incremental_sweep_changed_user(self):
+        since = dt_now()
+        # The updated_at is stored in whole seconds
+        time.sleep(1)
+        john = self.find_entity_by_name(User, user_john_name)
+        john.name = "John Changed"
+        self.save_entity(john)
+
+        service = self.find_entity_by_name(Service, service_network_name)
+        user_created = json.loads(read_file("test/scim/user_created.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=scim_users_found,
+                              content_type="application/json")
+            rsps.add(responses.PUT, f"{TEST_SCIM_USERS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
+                     json=user_created, status=200)
+            sync_results = perform_incremental_sweep(service, since)
+            self.assertEqual(1, len(sync_results["users"]["updated"]))
+            self.assertEqual(0, len(sync_results["users"]["created"]))
+            self.assertEqual(0, len(sync_results["groups"]["updated"]))
+
+    @responses.activate
+    def test_incremental_sweep_unchanged_fingerprint(self):
+        since = dt_now()
+        time.sleep(1)
+        john = self.find_entity_by_name(User, user_john_name)
+        john.name = "John Changed"
+        self.save_entity(john)
+
+        service = self.find_entity_by_name(Service, service_network_name)
+        user_created = json.loads(read_file("test/scim/user_created.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=scim_users_found,
+                              content_type="application/json")
+            rsps.add(responses.PUT, f"{TEST_SCIM_USERS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
+                     json=user_created, status=200)
+            perform_incremental_sweep(service, since)
+            calls = len(rsps.calls)
+
+            # The remote SCIM server already accepted the changed user
+            sync_results = perform_incremental_sweep(service, since)
+            self.assertEqual(calls, len(rsps.calls))
+            self.assertEqual(0, len(sync_results["users"]["updated"]))
+
+    @responses.activate
+    def test_incremental_sweep_deleted_group(self):
+        def groups_found(request):
+            query_filter = parse_qs(urlparse(request.url).query)["filter"][0]
+            identifier = re.findall(r"externalId eq \"([^\"]*)\"", query_filter)[0]
+            if identifier != f"{group_ai_researchers_identifier}{EXTERNAL_ID_POST_FIX}":
+                return 200, {}, read_file("test/scim/no_user_found.json")
+            return 200, {}, read_file("test/scim/group_found.json")
+
+        since = dt_now()
+        time.sleep(1)
+        db.session.delete(self.find_entity_by_name(Group, group_ai_researchers))
+        db.session.commit()
+
+        service = self.find_entity_by_name(Service, service_network_name)
+        group_created = json.loads(read_file("test/scim/group_created.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            rsps.add_callback(responses.GET, TEST_SCIM_USERS_ENDPOINT, callback=scim_users_found,
+                              content_type="application/json")
+            rsps.add_callback(responses.GET, TEST_SCIM_GROUPS_ENDPOINT, callback=groups_found,
+                              content_type="application/json")
+            rsps.add(responses.PUT, f"{TEST_SCIM_USERS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
+                     json={}, status=200)
+            rsps.add(responses.POST, TEST_SCIM_GROUPS_ENDPOINT, json=group_created, status=201)
+            rsps.add(responses.DELETE, f"{TEST_SCIM_GROUPS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1",
+                     status=204)
+            sync_results = perform_incremental_sweep(service, since)
+            self.assertListEqual([f"{TEST_SCIM_GROUPS_ENDPOINT}/8d85ea05-fc5c-4222-8efd-130ff7938ee1"],
+                                 sync_results["groups"]["deleted"])
+            # The collaboration of the deleted group is reconciled as well
+            self.assertTrue(len(sync_results["groups"]["created"]) > 0)
+
     @responses.activate
     def test_sweep_orphaned_users_groups(self):
         service = self.find_entity_by_name(Service, service_network_name)
@@ -121,6 +314,21 @@ class TestSweep(AbstractTest):
             scim_objects = _all_remote_scim_objects(service, SCIM_GROUPS)
             self.assertEqual(3, len(scim_objects))
 
+    @responses.activate
+    def test_paginated_scim_results_page_size(self):
+        service = self.find_entity_by_name(Service, service_network_name)
+        self.app.app_config.scim_sweep.page_size = 2
+        try:
+            with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+                for start_index, resources in [(1, [1, 2]), (3, [3, 4]), (5, [5])]:
+                    rsps.add(responses.GET, TEST_SCIM_GROUPS_ENDPOINT,
+                             json={"totalResults": 5, "Resources": resources}, status=200,
+                             match=[matchers.query_param_matcher({"startIndex": str(start_index), "count": "2"})])
+                scim_objects = _all_remote_scim_objects(service, SCIM_GROUPS)
+                self.assertListEqual([1, 2, 3, 4, 5], scim_objects)
+        finally:
+            self.app.app_config.scim_sweep.page_size = 100
+
     @responses.activate
     def test_error_scim_results(self):
         def all_remote():
@@ -209,6 +417,18 @@ class TestSweep(AbstractTest):
         remote_group, remote_scim_users = self._construct_group_changed_parameters(group)
         self.assertFalse(_group_changed(group, remote_group, remote_scim_users))
 
+    def test_group_fingerprint_requires_provisioned_members(self):
+        group = self.find_entity_by_name(Group, group_ai_researchers)
+        external_ids = [m.user.external_id for m in group.collaboration_memberships if m.is_active()]
+        remote_users = {external_id: {"id": external_id} for external_id in external_ids}
+        self.assertEqual(group_fingerprint(group), _group_fingerprint(group, remote_users))
+
+        # A member of which the create failed is still referenced by its bulkId
+        remote_users[external_ids[0]] = {"id": bulk_id_reference(external_ids[0])}
+        self.assertIsNone(_group_fingerprint(group, remote_users))
+        del remote_users[external_ids[0]]
+        self.assertIsNone(_group_fingerprint(group, remote_users))
+
     def test_user_changed(self):
         user = self.find_entity_by_name(User, user_john_name)
         remote_user = create_user_template(user)
@@ -228,3 +448,25 @@ class TestSweep(AbstractTest):
         user.suspended = False
         user.ssh_keys = []
         self.assertTrue(_user_changed(user, remote_user))
+
+    def test_sweep_concurrency(self):
+        service = self.find_entity_by_name(Service, service_network_name)
+        self.assertEqual(4, sweep_concurrency(service))
+        service.sweep_scim_concurrency = 16
+        self.assertEqual(16, sweep_concurrency(service))
+        service.sweep_scim_concurrency = -1
+        self.assertEqual(1, sweep_concurrency(service))
+
+    @responses.activate
+    def test_sweep_concurrent_requests_in_order(self):
+        service = self.find_entity_by_name(Service, service_network_name)
+        user_created = json.loads(read_file("test/scim/user_created.json"))
+        with responses.RequestsMock(assert_all_requests_are_fired=True) as rsps:
+            rsps.add(responses.POST, TEST_SCIM_USERS_ENDPOINT, json=user_created, status=201)
+            handled = []
+            with SweepExecutor(service, 4) as executor:
+                for i in range(10):
+                    executor.submit("POST", TEST_SCIM_USERS_ENDPOINT, lambda _, i=i: handled.append(i), "test")
+                executor.join()
+            self.assertListEqual(list(range(10)), handled)
+            self.assertEqual(10, len(rsps.calls))
@@ -13,7 +13,9 @@ from server.db.domain import (User,
                               OrganisationMembership,
                               CollaborationMembership,
                               ServiceMembership,
-                              Group)
+                              Group,
+                              SshKey,
+                              ServiceAup)
 from server.tools import dt_now
 from .seed import persist_instance, clean_db, read_image
 
@@ -46,6 +48,7 @@ def stress_seed(db, app_config):
     num_collaborations = stress_config.get('num_collaborations', 200)
     num_services = stress_config.get('num_services', 30)
     num_groups = stress_config.get('num_groups', 5)
+    num_ssh_keys = stress_config.get('num_ssh_keys', 3)
     probability = stress_config.get('probability', 0.5)
 
     logger.debug(
@@ -199,6 +202,21 @@ def stress_seed(db, app_config):
     batch(db, service_memberships, 50)
     logger.info(f"Created {len(service_memberships)} service memberships")
 
+    logger.debug("Creating ssh keys and service aups...")
+    ssh_keys_and_aups = []
+
+    for user in users:
+        # Add 0-num_ssh_keys keys and accept the AUP of random services for each user
+        for i in range(randint(0, num_ssh_keys)):
+            ssh_key = SshKey(ssh_value=f"ssh-ed25519 {uuid.uuid4().hex} {user.username}-{i}", user=user)
+            ssh_keys_and_aups.append(ssh_key)
+        for service in sample(services, int(len(services) * probability)):
+            service_aup = ServiceAup(aup_url=service.accepted_user_policy, user=user, service=service)
+            ssh_keys_and_aups.append(service_aup)
+
+    batch(db, ssh_keys_and_aups, 100)
+    logger.info(f"Created {len(ssh_keys_and_aups)} ssh keys and service aups")
+
     # Create collaborations in batches to avoid memory issues
     logger.debug(f"Creating {num_collaborations} collaborations...")
 
@@ -1,7 +1,8 @@
+import datetime
 import tempfile
 from unittest import TestCase
 
-from server.tools import read_file, inactivity, YEAR, WEEK, MONTH
+from server.tools import read_file, inactivity, YEAR, WEEK, MONTH, sram_inactive_days, dt_today
 
 
 class TestTools(TestCase):
@@ -31,3 +32,9 @@ class TestTools(TestCase):
         self.assertEqual(7, res)
         res = inactivity(WEEK - 2)
         self.assertEqual(1, res)
+
+    def test_sram_inactive_days(self):
+        today = dt_today()
+        self.assertEqual(1, sram_inactive_days(today - datetime.timedelta(days=2), today))
+        self.assertEqual(30, sram_inactive_days((today - datetime.timedelta(days=40)).replace(tzinfo=None), today))
+        self.assertTrue(sram_inactive_days(None, today) > 24 * YEAR)
@@ -43,3 +43,11 @@ def inactivity(inactive_days):
         return res(inactive_days, WEEK)
     else:
         return 1
+
+
+def sram_inactive_days(last_login_date, today: datetime = None) -> int:
+    """The rounded days since the last login - since 2000 if the user never logged in - of the PLSC sync"""
+    last_login_date = last_login_date or datetime(2000, 1, 1)
+    if last_login_date.tzinfo is None:
+        last_login_date = last_login_date.replace(tzinfo=timezone.utc)
+    return inactivity(((today or dt_today()) - last_login_date).days)